@@ -0,0 +1,99 @@
+"""
+Async database mode
+Обработчики работают через AsyncSession (asyncpg/aiosqlite), не блокируя event loop
+"""
+
+import asyncio
+import os
+from typing import Optional
+
+from fastapi.routing import APIRoute
+from sqlalchemy.util import await_only, greenlet_spawn
+
+ASYNC_DRIVERS = {
+    "postgres": "postgresql+asyncpg",
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def async_url(url: str) -> str:
+    scheme, rest = url.split("://", 1)
+    return f"{ASYNC_DRIVERS[scheme.split('+')[0]]}://{rest}"
+
+
+async def _settle(awaited) -> None:
+    # The suspended coroutine reads the result itself once it is resumed
+    if awaited is None:
+        await asyncio.sleep(0)
+        return
+    try:
+        await asyncio.wait([awaited])
+    except asyncio.CancelledError:
+        awaited.cancel()
+        raise
+
+
+def _drive(coroutine):
+    """Step ``coroutine`` from inside a SQLAlchemy greenlet.
+
+    Every future the coroutine waits on is awaited by the outer task through
+    await_only, so sync ORM calls made anywhere in the coroutine can switch
+    out to the event loop as well.
+    """
+    value, error = None, None
+    while True:
+        try:
+            awaited = coroutine.throw(error) if error is not None else coroutine.send(value)
+        except StopIteration as stop:
+            return stop.value
+        error = None
+        try:
+            await_only(_settle(awaited))
+        except BaseException as raised:
+            error = raised
+
+
+class GreenletRoute(APIRoute):
+    """Runs dependency resolution and the endpoint inside a greenlet.
+
+    Handlers keep the plain ``Session`` API (``db.query(...)``, ``db.commit()``)
+    while the I/O underneath goes through the async driver.
+    """
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+
+        async def greenlet_handler(request):
+            return await greenlet_spawn(_drive, handler(request))
+
+        return greenlet_handler
+
+
+class AsyncDatabase:
+    def __init__(self, url: str, **engine_options):
+        from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+        self.engine = create_async_engine(async_url(url), **engine_options)
+        self.sessionmaker = async_sessionmaker(self.engine, autoflush=False)
+
+    async def get_db(self):
+        # The sync facade of the AsyncSession; only usable inside GreenletRoute requests
+        session = self.sessionmaker()
+        try:
+            yield session.sync_session
+        finally:
+            await session.close()
+
+    def install(self, app) -> None:
+        app.router.route_class = GreenletRoute
+
+    async def dispose(self) -> None:
+        await self.engine.dispose()
+
+
+def create_async_database(url: str, **engine_options) -> Optional[AsyncDatabase]:
+    """AsyncDatabase when DATABASE_ASYNC=1, otherwise None and the sync Session stays in use."""
+    if os.getenv("DATABASE_ASYNC", "0") != "1":
+        return None
+    return AsyncDatabase(url, **engine_options)
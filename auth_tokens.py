@@ -0,0 +1,191 @@
+"""
+Refresh tokens and token revocation
+Ротация refresh-токенов и список отозванных сессий, синхронизируемый из БД в память каждого воркера
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import secrets
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table
+from sqlalchemy import delete, insert, select, update
+
+logger = logging.getLogger(__name__)
+
+metadata = MetaData()
+
+# Only the SHA-256 of a refresh token is stored; every token belongs to a session
+# (the chain of rotations started by one login) and is used at most once.
+refresh_tokens = Table(
+    "refresh_tokens",
+    metadata,
+    Column("token_hash", String(64), primary_key=True),
+    Column("session_id", String(36), nullable=False, index=True),
+    Column("user_id", String, nullable=False),
+    Column("expires_at", DateTime, nullable=False, index=True),
+    Column("used_at", DateTime),
+)
+
+# Revoked sessions, kept until the last access token minted for them has expired
+token_revocations = Table(
+    "token_revocations",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("session_id", String(36), nullable=False),
+    Column("expires_at", DateTime, nullable=False, index=True),
+    Column("revoked_at", DateTime, nullable=False, index=True),
+)
+
+
+class InvalidRefreshToken(Exception):
+    def __init__(self, reused_session: Optional[str] = None):
+        super().__init__()
+        # Set when a spent token was presented again; the caller should revoke that session
+        self.reused_session = reused_session
+
+
+def _digest(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+class RefreshTokens:
+    """Opaque refresh tokens with rotation and reuse detection.
+
+    ``rotate`` spends a token and returns its successor in the same session.
+    Presenting an already spent token means it leaked (or the client raced
+    itself); the whole session is then revoked, so neither the thief nor the
+    client can continue it.
+    """
+
+    def __init__(self, engine, ttl: timedelta = timedelta(days=30)):
+        self.engine = engine
+        self.ttl = ttl
+
+    def issue(self, user_id: str, session_id: Optional[str] = None) -> Tuple[str, str]:
+        """Returns (refresh_token, session_id); a new session unless ``session_id`` is given."""
+        session_id = session_id or str(uuid.uuid4())
+        token = secrets.token_urlsafe(32)
+        now = datetime.utcnow()
+        with self.engine.begin() as connection:
+            # Cheap to do here and keeps the table to live sessions only
+            connection.execute(delete(refresh_tokens).where(refresh_tokens.c.expires_at < now))
+            connection.execute(insert(refresh_tokens).values(
+                token_hash=_digest(token), session_id=session_id, user_id=user_id, expires_at=now + self.ttl,
+            ))
+        return token, session_id
+
+    def rotate(self, token: str) -> Tuple[str, str, str]:
+        """Returns (user_id, session_id, new_refresh_token) or raises InvalidRefreshToken."""
+        token_hash = _digest(token)
+        now = datetime.utcnow()
+        with self.engine.begin() as connection:
+            row = connection.execute(
+                select(refresh_tokens).where(refresh_tokens.c.token_hash == token_hash)
+            ).first()
+            if row is None or row.expires_at < now:
+                raise InvalidRefreshToken()
+            # The used_at guard makes two concurrent rotations of one token resolve to a single winner
+            spent = connection.execute(
+                update(refresh_tokens)
+                .where(refresh_tokens.c.token_hash == token_hash, refresh_tokens.c.used_at.is_(None))
+                .values(used_at=now)
+            ).rowcount
+        if not spent:
+            logger.warning("Refresh token reused in session %s", row.session_id)
+            raise InvalidRefreshToken(reused_session=row.session_id)
+        new_token, _ = self.issue(row.user_id, row.session_id)
+        return row.user_id, row.session_id, new_token
+
+    def revoke_session(self, session_id: str) -> None:
+        with self.engine.begin() as connection:
+            connection.execute(delete(refresh_tokens).where(refresh_tokens.c.session_id == session_id))
+
+
+class RevocationList:
+    """In-memory copy of token_revocations, refreshed every ``sync_interval`` seconds.
+
+    Checking a token is a set lookup, no query. Revocations made by this
+    worker apply immediately; those made by other workers once the next sync
+    picks them up. Entries drop out when they expire, so the set only holds
+    ids of sessions revoked within the last access token lifetime.
+    """
+
+    # Rows committed late (slow transactions, clock skew between workers) are still picked up
+    OVERLAP = timedelta(seconds=60)
+
+    def __init__(self, engine, sync_interval: float = 5.0):
+        self.engine = engine
+        self.sync_interval = sync_interval
+        self._revoked: Dict[str, datetime] = {}
+        self._synced_until: Optional[datetime] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stats = {"syncs": 0, "failed_syncs": 0, "last_sync": None}
+
+    def is_revoked(self, session_id: Optional[str]) -> bool:
+        return session_id is not None and session_id in self._revoked
+
+    def revoke(self, session_id: str, expires_at: datetime) -> None:
+        now = datetime.utcnow()
+        with self.engine.begin() as connection:
+            connection.execute(delete(token_revocations).where(token_revocations.c.expires_at < now))
+            connection.execute(insert(token_revocations).values(session_id=session_id, expires_at=expires_at, revoked_at=now))
+        self._revoked[session_id] = expires_at
+
+    def sync(self) -> None:
+        query = select(token_revocations.c.session_id, token_revocations.c.expires_at, token_revocations.c.revoked_at)
+        now = datetime.utcnow()
+        if self._synced_until is None:
+            query = query.where(token_revocations.c.expires_at >= now)
+        else:
+            query = query.where(token_revocations.c.revoked_at >= self._synced_until - self.OVERLAP)
+        with self.engine.connect() as connection:
+            rows = connection.execute(query).all()
+
+        # Updated in place: revoke() may add entries from the event loop while this runs in a thread
+        for row in rows:
+            if row.expires_at >= now:
+                self._revoked[row.session_id] = row.expires_at
+            if self._synced_until is None or row.revoked_at > self._synced_until:
+                self._synced_until = row.revoked_at
+        if self._synced_until is None:
+            self._synced_until = now
+        for session_id, expires_at in list(self._revoked.items()):
+            if expires_at < now:
+                self._revoked.pop(session_id, None)
+
+    async def start(self) -> None:
+        await asyncio.to_thread(self.sync)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            try:
+                await asyncio.to_thread(self.sync)
+                self._stats["syncs"] += 1
+                self._stats["last_sync"] = datetime.utcnow().isoformat()
+            except Exception:
+                logger.exception("Failed to sync token revocations")
+                self._stats["failed_syncs"] += 1
+
+    def metrics(self) -> dict:
+        return {**self._stats, "revoked": len(self._revoked), "sync_interval": self.sync_interval}
+
+
+def create_refresh_tokens(engine) -> RefreshTokens:
+    return RefreshTokens(engine, ttl=timedelta(days=float(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "30"))))
+
+
+def create_revocation_list(engine) -> RevocationList:
+    return RevocationList(engine, sync_interval=float(os.getenv("TOKEN_REVOCATION_SYNC_SECONDS", "5")))
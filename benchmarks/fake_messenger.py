@@ -0,0 +1,84 @@
+"""
+Fake messenger API
+Локальная имитация Telegram Bot API и Meta Graph API для проверки исходящих ответов без реальных платформ
+
+    uvicorn benchmarks.fake_messenger:app --port 9000
+    TELEGRAM_API_URL=http://127.0.0.1:9000 WHATSAPP_API_URL=http://127.0.0.1:9000 \\
+        INSTAGRAM_API_URL=http://127.0.0.1:9000 uvicorn main:app
+
+or in-process: MessengerClient(transport=httpx.ASGITransport(app=fake_messenger.app), base_urls=...).
+
+Every send is recorded (GET /sent, DELETE /sent). A chat that gets messages
+faster than FAKE_CHAT_INTERVAL seconds apart is answered with 429 and a
+retry_after of FAKE_RETRY_AFTER, the way Telegram's flood control does.
+"""
+
+import os
+import time
+import uuid
+from collections import defaultdict
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+CHAT_INTERVAL = float(os.getenv("FAKE_CHAT_INTERVAL", "0"))
+RETRY_AFTER = int(os.getenv("FAKE_RETRY_AFTER", "1"))
+
+app = FastAPI(title="Fake messenger API")
+sent = []
+last_sent = defaultdict(float)
+
+
+def record(platform: str, bot: str, chat_id: str, text: str):
+    now = time.monotonic()
+    key = (platform, bot, chat_id)
+    if CHAT_INTERVAL and now - last_sent[key] < CHAT_INTERVAL:
+        return False
+    last_sent[key] = now
+    sent.append({"platform": platform, "bot": bot, "chat_id": chat_id, "text": text, "at": time.time()})
+    return True
+
+
+@app.post("/bot{token}/sendMessage")
+async def telegram_send_message(token: str, request: Request):
+    body = await request.json()
+    if not record("telegram", token, str(body.get("chat_id")), body.get("text")):
+        return JSONResponse({
+            "ok": False,
+            "error_code": 429,
+            "description": f"Too Many Requests: retry after {RETRY_AFTER}",
+            "parameters": {"retry_after": RETRY_AFTER},
+        }, status_code=429)
+    return {"ok": True, "result": {"message_id": len(sent), "chat": {"id": body.get("chat_id")}, "text": body.get("text")}}
+
+
+@app.post("/me/messages")
+async def instagram_send_message(request: Request):
+    body = await request.json()
+    recipient = (body.get("recipient") or {}).get("id")
+    if not record("instagram", request.headers.get("authorization", ""), str(recipient), (body.get("message") or {}).get("text")):
+        return JSONResponse({"error": {"message": "Rate limited", "code": 4}}, status_code=429,
+                            headers={"Retry-After": str(RETRY_AFTER)})
+    return {"recipient_id": recipient, "message_id": f"m_{uuid.uuid4().hex}"}
+
+
+@app.post("/{phone_number_id}/messages")
+async def whatsapp_send_message(phone_number_id: str, request: Request):
+    body = await request.json()
+    if not record("whatsapp", phone_number_id, str(body.get("to")), (body.get("text") or {}).get("body")):
+        return JSONResponse({"error": {"message": "Rate limit hit", "code": 130429}}, status_code=429,
+                            headers={"Retry-After": str(RETRY_AFTER)})
+    return {"messaging_product": "whatsapp", "contacts": [{"wa_id": body.get("to")}],
+            "messages": [{"id": f"wamid.{uuid.uuid4().hex}"}]}
+
+
+@app.get("/sent")
+async def get_sent():
+    return sent
+
+
+@app.delete("/sent")
+async def clear_sent():
+    sent.clear()
+    last_sent.clear()
+    return {"success": True}
@@ -0,0 +1,236 @@
+"""
+Bot registry
+Активные боты в памяти воркера (с разобранным config) для маршрутизации вебхуков без запросов к БД
+"""
+
+import json
+import logging
+import os
+import select
+import itertools
+import threading
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import select as sql_select
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class BotEntry:
+    id: int
+    user_id: str
+    platform: str
+    token: Optional[str]
+    config: dict = field(default_factory=dict)
+
+
+def _parse_config(raw: Optional[str]) -> dict:
+    try:
+        config = json.loads(raw) if raw else {}
+    except ValueError:
+        return {}
+    return config if isinstance(config, dict) else {}
+
+
+class BotRegistry:
+    """Every active bot, loaded at startup and kept current by invalidation.
+
+    A bot missing from the registry is unknown or inactive, so webhooks for
+    it can be refused without a query. ``invalidate`` reloads one bot here
+    and, on PostgreSQL, sends NOTIFY so the other workers reload it too; a
+    listener thread per worker receives those. A full reload every
+    ``reload_interval`` seconds covers anything missed (listener reconnects,
+    PgBouncer, SQLite).
+
+    The same channel carries invalidations of per-worker caches: ``on_bot_change``
+    callbacks get the bot id after every refresh, ``on_user_change`` callbacks the
+    user id passed to ``invalidate_user``, in every worker. Without a listener
+    only the calling worker hears of them.
+    """
+
+    CHANNEL = "bot_registry"
+
+    USER_PREFIX = "user:"
+
+    def __init__(
+        self,
+        engine,
+        bot_table,
+        reload_interval: float = 60.0,
+        listen: bool = True,
+        on_bot_change: Optional[List[Callable[[int], None]]] = None,
+        on_user_change: Optional[List[Callable[[str], None]]] = None,
+    ):
+        self.engine = engine
+        self.bots_table = bot_table
+        self.reload_interval = reload_interval
+        self.listen = listen and engine.dialect.name == "postgresql"
+        self.on_bot_change = on_bot_change or []
+        self.on_user_change = on_user_change or []
+        self._bots: Dict[int, BotEntry] = {}
+        # Guards the in-memory state only, never held across a query. Every load takes a
+        # sequence number before querying, and a load never overwrites one that started later.
+        self._lock = threading.Lock()
+        self._sequence = itertools.count(1)
+        self._loaded_version = 0
+        self._refreshed: Dict[int, int] = {}
+        self._stopping = threading.Event()
+        self._threads = []
+        self._stats = {"reloads": 0, "refreshes": 0, "notifications": 0, "listener_errors": 0}
+
+    def get(self, bot_id: int) -> Optional[BotEntry]:
+        return self._bots.get(bot_id)
+
+    def _entry(self, row) -> Optional[BotEntry]:
+        if row is None or not row.is_active:
+            return None
+        return BotEntry(id=row.id, user_id=row.user_id, platform=row.platform, token=row.token,
+                        config=_parse_config(row.config))
+
+    def _query(self):
+        table = self.bots_table
+        return sql_select(table.c.id, table.c.user_id, table.c.platform, table.c.token, table.c.is_active, table.c.config)
+
+    def reload(self) -> None:
+        version = next(self._sequence)
+        with self.engine.connect() as connection:
+            rows = connection.execute(self._query().where(self.bots_table.c.is_active.is_(True))).all()
+        bots = {row.id: self._entry(row) for row in rows}
+        with self._lock:
+            if version < self._loaded_version:
+                return
+            for bot_id, refreshed in list(self._refreshed.items()):
+                if refreshed > version:
+                    # Refreshed after this query started: the refresh is at least as new
+                    entry = self._bots.get(bot_id)
+                    if entry is None:
+                        bots.pop(bot_id, None)
+                    else:
+                        bots[bot_id] = entry
+                else:
+                    del self._refreshed[bot_id]
+            self._bots = bots
+            self._loaded_version = version
+            self._stats["reloads"] += 1
+
+    def refresh(self, bot_id: int) -> None:
+        version = next(self._sequence)
+        with self.engine.connect() as connection:
+            row = connection.execute(self._query().where(self.bots_table.c.id == bot_id)).first()
+        entry = self._entry(row)
+        with self._lock:
+            if version < max(self._loaded_version, self._refreshed.get(bot_id, 0)):
+                return
+            self._refreshed[bot_id] = version
+            if entry is None:
+                self._bots.pop(bot_id, None)
+            else:
+                self._bots[bot_id] = entry
+            self._stats["refreshes"] += 1
+        for callback in self.on_bot_change:
+            callback(bot_id)
+
+    def invalidate(self, bot_id: int) -> None:
+        """Call after committing a change to a bot. Blocking: async handlers run it in a thread."""
+        self.refresh(bot_id)
+        self._notify(str(bot_id))
+
+    def invalidate_user(self, user_id: str) -> None:
+        """Call after committing a change to what a user's bots answer from (knowledge files).
+
+        Blocking, like ``invalidate``.
+        """
+        self._user_changed(user_id)
+        self._notify(f"{self.USER_PREFIX}{user_id}")
+
+    def _user_changed(self, user_id: str) -> None:
+        for callback in self.on_user_change:
+            callback(user_id)
+
+    def _notify(self, payload: str) -> None:
+        if self.listen:
+            with self.engine.begin() as connection:
+                connection.execute(text("SELECT pg_notify(:channel, :payload)"),
+                                   {"channel": self.CHANNEL, "payload": payload})
+
+    # Background threads: a blocking LISTEN loop does not fit the event loop's thread pool
+    def start(self) -> None:
+        self.reload()
+        self._stopping.clear()
+        self._threads = [threading.Thread(target=self._reload_loop, name="bot-registry-reload", daemon=True)]
+        if self.listen:
+            self._threads.append(threading.Thread(target=self._listen_loop, name="bot-registry-listen", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self) -> None:
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout=2)
+        self._threads = []
+
+    def _reload_loop(self) -> None:
+        while not self._stopping.wait(self.reload_interval):
+            try:
+                self.reload()
+            except Exception:
+                logger.exception("Bot registry reload failed")
+
+    def _listen_loop(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                self._listen()
+            except Exception:
+                logger.exception("Bot registry listener failed, reconnecting")
+                self._stats["listener_errors"] += 1
+                self._stopping.wait(1)
+
+    def _listen(self) -> None:
+        # A dedicated driver connection, kept out of the pool for as long as it listens
+        raw = self.engine.raw_connection()
+        raw.detach()
+        connection = raw.driver_connection
+        try:
+            connection.autocommit = True
+            connection.cursor().execute(f"LISTEN {self.CHANNEL}")
+            # Changes made while not listening were missed
+            self.reload()
+            while not self._stopping.is_set():
+                if select.select([connection], [], [], 1.0) == ([], [], []):
+                    continue
+                connection.poll()
+                payloads = set()
+                while connection.notifies:
+                    payloads.add(connection.notifies.pop(0).payload)
+                for payload in payloads:
+                    self._stats["notifications"] += 1
+                    if payload.startswith(self.USER_PREFIX):
+                        self._user_changed(payload[len(self.USER_PREFIX):])
+                    else:
+                        self.refresh(int(payload))
+        finally:
+            raw.close()
+
+    def metrics(self) -> dict:
+        return {**self._stats, "bots": len(self._bots), "listening": self.listen,
+                "reload_interval": self.reload_interval}
+
+
+def create_bot_registry(
+    engine,
+    bot_table,
+    on_bot_change: Optional[List[Callable[[int], None]]] = None,
+    on_user_change: Optional[List[Callable[[str], None]]] = None,
+) -> BotRegistry:
+    return BotRegistry(
+        engine,
+        bot_table,
+        reload_interval=float(os.getenv("BOT_REGISTRY_RELOAD_SECONDS", "60")),
+        # PgBouncer in transaction mode does not keep LISTEN sessions
+        listen=os.getenv("DB_PGBOUNCER", "0") != "1",
+        on_bot_change=on_bot_change,
+        on_user_change=on_user_change,
+    )
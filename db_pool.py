@@ -0,0 +1,125 @@
+"""
+Database connection pool configuration
+Настройка пула соединений из окружения (в т.ч. режим PgBouncer) и метрики пула
+"""
+
+import os
+import threading
+import time
+import uuid
+
+from sqlalchemy import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+
+
+class WaitStats:
+    """How long checkouts waited for a connection, and how many gave up."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.timeouts = 0
+
+    def record(self, seconds: float, timed_out: bool) -> None:
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def as_dict(self) -> dict:
+        return {
+            "checkouts": self.count,
+            "avg_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "max_ms": round(self.max * 1000, 3),
+            "timeouts": self.timeouts,
+        }
+
+
+class _TimedCheckout:
+    wait_stats: WaitStats
+
+    def _do_get(self):
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except PoolTimeout:
+            timed_out = True
+            raise
+        finally:
+            self.wait_stats.record(time.perf_counter() - started, timed_out)
+
+
+def _timed_pool_class(base):
+    # A class per engine: Pool.recreate() builds a new instance of the same class, so the stats carry over
+    return type(f"Timed{base.__name__}", (_TimedCheckout, base), {"wait_stats": WaitStats()})
+
+
+def _env_flag(name: str):
+    value = os.getenv(name)
+    return None if value is None else value == "1"
+
+
+def pool_options(url: str, asyncio: bool = False, **defaults) -> dict:
+    """Engine keyword arguments for ``url`` from DB_POOL_* settings, layered over ``defaults``.
+
+    DB_PGBOUNCER=1 disables client-side pooling (NullPool), because PgBouncer
+    in transaction mode already pools. It also turns off asyncpg's prepared
+    statement caches, which do not survive connections being swapped under
+    the client.
+    """
+    options = dict(defaults)
+    settings = {
+        "pool_size": os.getenv("DB_POOL_SIZE"),
+        "max_overflow": os.getenv("DB_MAX_OVERFLOW"),
+        "pool_timeout": os.getenv("DB_POOL_TIMEOUT"),
+        "pool_recycle": os.getenv("DB_POOL_RECYCLE"),
+    }
+    pre_ping = _env_flag("DB_POOL_PRE_PING")
+    if pre_ping is not None:
+        options["pool_pre_ping"] = pre_ping
+
+    if os.getenv("DB_PGBOUNCER", "0") == "1":
+        options["poolclass"] = NullPool
+        options.pop("pool_recycle", None)
+        if asyncio:
+            options["connect_args"] = {
+                "statement_cache_size": 0,
+                "prepared_statement_cache_size": 0,
+                "prepared_statement_name_func": lambda: f"__asyncpg_{uuid.uuid4()}__",
+            }
+        return options
+
+    for key, value in settings.items():
+        if value is not None:
+            options[key] = float(value) if key == "pool_timeout" else int(value)
+
+    # In-memory SQLite keeps its single-connection pool
+    parsed = make_url(url)
+    if parsed.get_backend_name() != "sqlite" or parsed.database not in (None, "", ":memory:"):
+        options["poolclass"] = _timed_pool_class(AsyncAdaptedQueuePool if asyncio else QueuePool)
+    return options
+
+
+def pool_status(engine) -> dict:
+    pool = getattr(engine, "sync_engine", engine).pool
+    status = {"pool_class": type(pool).__name__, "pid": os.getpid()}
+    if isinstance(pool, QueuePool):
+        status.update({
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            # Negative while the core pool is not yet fully opened
+            "overflow": pool.overflow(),
+            "max_overflow": pool._max_overflow,
+            "timeout": pool.timeout(),
+        })
+    wait_stats = getattr(pool, "wait_stats", None)
+    if wait_stats is not None:
+        status["wait"] = wait_stats.as_dict()
+    return status
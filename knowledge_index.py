@@ -0,0 +1,395 @@
+"""
+Knowledge retrieval index
+Поиск по фрагментам базы знаний: BM25 + плотные векторы (hashing trick) в memory-mapped матрице
+"""
+
+import fcntl
+import json
+import math
+import os
+import pickle
+import re
+import threading
+import zlib
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import select
+
+from knowledge_processing import knowledge_chunks
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Journal rows tolerated before folding into a new generation, however small the base
+JOURNAL_MIN_ROWS = 256
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall(text.lower())
+
+
+def embed(text: str, dim: int) -> np.ndarray:
+    """Signed feature hashing of words and character trigrams, L2-normalised.
+
+    Uses crc32 rather than hash() so vectors are identical across processes and restarts.
+    """
+    vector = np.zeros(dim, dtype=np.float32)
+    tokens = tokenize(text)
+    features = tokens + [token[i:i + 3] for token in tokens if len(token) > 3 for i in range(len(token) - 2)]
+    for feature in features:
+        code = zlib.crc32(feature.encode("utf-8"))
+        vector[code % dim] += 1.0 if code & 0x80000000 else -1.0
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm else vector
+
+
+class UserIndex:
+    """One user's index, kept on disk under ``path``:
+
+    meta.json        rows (content_hash, chunk_index, text, length), dead row ids, generation
+    postings.pkl     term -> ([row ids], [term frequencies])
+    journal-N.jsonl  chunks added and blobs removed since generation N was written
+    vectors.f32      row-major float32 matrix, appended to and read through np.memmap
+
+    Updates append one line to the journal (and the new rows to vectors.f32);
+    once the journal outgrows the base, or a third of the rows are dead, it is
+    folded into a new generation with the dead rows dropped, so N adds cost
+    O(N) writes in total rather than a full rewrite each.
+
+    Writers take an exclusive flock on the directory so uvicorn workers sharing
+    it stay consistent; readers reload under a shared flock when meta.json is
+    replaced or the journal grows, so the files are always read from the same
+    generation.
+    """
+
+    def __init__(self, path: Path, dim: int):
+        self.path = path
+        self.dim = dim
+        self.rows: List[list] = []
+        self.dead: set = set()
+        self.postings: Dict[str, Tuple[list, list]] = {}
+        self.vectors: Optional[np.ndarray] = None
+        self.generation = 0
+        self._base_rows = 0
+        self._journal_offset = 0
+        self._arrays: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._lengths = np.zeros(0, dtype=np.float32)
+        self._dead_mask = np.zeros(0, dtype=bool)
+        self._loaded_version = None
+        self._lock = threading.Lock()
+
+    @property
+    def exists(self) -> bool:
+        return (self.path / "meta.json").exists()
+
+    # Persistence
+    @contextmanager
+    def _file_lock(self, shared: bool = False):
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.path / "lock", "w") as handle:
+            fcntl.flock(handle, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def _meta_version(self):
+        # meta.json is replaced, never rewritten in place, so a new inode means new contents
+        try:
+            status = os.stat(self.path / "meta.json")
+        except FileNotFoundError:
+            return None
+        return status.st_ino, status.st_mtime_ns
+
+    def _journal_path(self, generation: Optional[int] = None) -> Path:
+        return self.path / f"journal-{self.generation if generation is None else generation}.jsonl"
+
+    def _journal_size(self) -> int:
+        try:
+            return os.stat(self._journal_path()).st_size
+        except FileNotFoundError:
+            return 0
+
+    def refresh(self) -> None:
+        if self._meta_version() == self._loaded_version and self._journal_size() == self._journal_offset:
+            return
+        # Writers append to the journal and replace postings.pkl, meta.json and (on
+        # compaction) vectors.f32; the shared lock keeps us from mixing two generations
+        with self._file_lock(shared=True):
+            self._load()
+
+    def _load(self) -> None:
+        # Caller holds the file lock, shared or exclusive
+        version = self._meta_version()
+        changed = version != self._loaded_version
+        if changed:
+            if version is None:
+                self.rows, self.dead, self.postings, self.generation = [], set(), {}, 0
+            else:
+                with open(self.path / "meta.json") as handle:
+                    meta = json.load(handle)
+                with open(self.path / "postings.pkl", "rb") as handle:
+                    self.postings = pickle.load(handle)
+                self.rows, self.dead = meta["rows"], set(meta["dead"])
+                self.generation = meta.get("generation", 0)
+            self._loaded_version = version
+            self._base_rows = len(self.rows)
+            self._journal_offset = 0
+        if version is not None and self._read_journal():
+            changed = True
+        if changed:
+            self._reindex_arrays()
+
+    def _read_journal(self) -> bool:
+        try:
+            with open(self._journal_path(), "rb") as handle:
+                handle.seek(self._journal_offset)
+                data = handle.read()
+        except FileNotFoundError:
+            return False
+        # A line without its newline was cut short by a writer that died; the next writer truncates it
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            self._apply(json.loads(line))
+        self._journal_offset += end
+        return end > 0
+
+    def _apply(self, entry: dict) -> None:
+        if "remove" in entry:
+            self.dead.update(index for index, row in enumerate(self.rows) if row[0] == entry["remove"])
+            return
+        for row in entry["add"]:
+            row_id = len(self.rows)
+            self.rows.append(row)
+            for term, frequency in Counter(tokenize(row[2])).items():
+                rows, frequencies = self.postings.setdefault(term, ([], []))
+                rows.append(row_id)
+                frequencies.append(frequency)
+
+    def _reindex_arrays(self) -> None:
+        count = len(self.rows)
+        self._arrays = {}
+        self._lengths = np.array([row[3] for row in self.rows], dtype=np.float32)
+        self._dead_mask = np.zeros(count, dtype=bool)
+        if self.dead:
+            self._dead_mask[list(self.dead)] = True
+        vectors_path = self.path / "vectors.f32"
+        if count and vectors_path.exists():
+            self.vectors = np.memmap(vectors_path, dtype=np.float32, mode="r", shape=(count, self.dim))
+        else:
+            self.vectors = None
+
+    def _append(self, entry: dict, vectors: Optional[np.ndarray] = None) -> None:
+        # Caller holds the exclusive file lock and has just loaded, so the in-memory state is current
+        if vectors is not None and len(vectors):
+            with open(self.path / "vectors.f32", "ab") as handle:
+                # Drop any tail left by a writer that died before journaling its rows
+                handle.truncate(len(self.rows) * self.dim * 4)
+                vectors.astype(np.float32).tofile(handle)
+        line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+        with open(self._journal_path(), "ab") as handle:
+            handle.truncate(self._journal_offset)
+            handle.write(line)
+        self._journal_offset += len(line)
+        self._apply(entry)
+        self._reindex_arrays()
+
+    def _write(self, vectors: Optional[np.ndarray] = None) -> None:
+        """Write the in-memory state as the next generation; ``vectors`` replaces vectors.f32 when given."""
+        if vectors is not None:
+            temp = self.path / "vectors.f32.tmp"
+            vectors.tofile(temp)
+            os.replace(temp, self.path / "vectors.f32")
+
+        previous, generation = self.generation, self.generation + 1
+        for name, payload, mode in (
+            ("postings.pkl", pickle.dumps(self.postings, protocol=pickle.HIGHEST_PROTOCOL), "wb"),
+            ("meta.json", json.dumps(
+                {"rows": self.rows, "dead": sorted(self.dead), "generation": generation}, ensure_ascii=False
+            ), "w"),
+        ):
+            temp = self.path / f"{name}.tmp"
+            with open(temp, mode) as handle:
+                handle.write(payload)
+            os.replace(temp, self.path / name)
+        # The old journal is already folded in; once meta.json names the new generation it is never read again
+        self._journal_path(previous).unlink(missing_ok=True)
+        self.generation = generation
+        self._loaded_version = self._meta_version()
+        self._base_rows = len(self.rows)
+        self._journal_offset = 0
+        self._reindex_arrays()
+
+    # Updates
+    def create(self) -> None:
+        with self._lock, self._file_lock():
+            if not self.exists:
+                self._write()
+
+    def add(self, content_hash: str, chunks: List[str]) -> None:
+        with self._lock, self._file_lock():
+            self._load()
+            if any(row[0] == content_hash for index, row in enumerate(self.rows) if index not in self.dead):
+                return
+            rows = []
+            vectors = np.zeros((len(chunks), self.dim), dtype=np.float32)
+            for offset, text in enumerate(chunks):
+                rows.append([content_hash, offset, text, len(tokenize(text))])
+                vectors[offset] = embed(text, self.dim)
+            self._append({"add": rows}, vectors)
+            # Folding only once the journal outgrows the base keeps rewrites geometric
+            if len(self.rows) - self._base_rows > max(self._base_rows, JOURNAL_MIN_ROWS):
+                self._compact()
+
+    def remove(self, content_hash: str) -> None:
+        with self._lock, self._file_lock():
+            self._load()
+            removed = {index for index, row in enumerate(self.rows) if row[0] == content_hash}
+            if not removed - self.dead:
+                return
+            self._append({"remove": content_hash})
+            if len(self.dead) * 3 > len(self.rows):
+                self._compact()
+
+    def _compact(self) -> None:
+        """Fold the journal into a new generation and drop dead rows; nothing is re-embedded."""
+        if not self.dead:
+            self._write()
+            return
+        keep = [index for index in range(len(self.rows)) if index not in self.dead]
+        vectors = np.zeros((0, self.dim), np.float32)
+        if self.vectors is not None and keep:
+            vectors = np.array(self.vectors[keep])
+        self.rows = [self.rows[index] for index in keep]
+        self.dead = set()
+        self.postings = {}
+        for row_id, row in enumerate(self.rows):
+            for term, frequency in Counter(tokenize(row[2])).items():
+                rows, frequencies = self.postings.setdefault(term, ([], []))
+                rows.append(row_id)
+                frequencies.append(frequency)
+        self._write(vectors)
+
+    # Queries
+    def _posting_arrays(self, term: str):
+        arrays = self._arrays.get(term)
+        if arrays is None:
+            posting = self.postings.get(term)
+            if posting is None:
+                return None
+            rows, frequencies = np.array(posting[0], dtype=np.int64), np.array(posting[1], dtype=np.float32)
+            # Tombstoned rows stay in the postings until compaction but must not count towards document frequency
+            alive = ~self._dead_mask[rows]
+            arrays = self._arrays[term] = (rows[alive], frequencies[alive])
+        return arrays
+
+    def search(self, query: str, k: int = 5, alpha: float = 0.5) -> List[dict]:
+        with self._lock:
+            self.refresh()
+            count = len(self.rows)
+            alive = count - len(self.dead)
+            if not alive:
+                return []
+
+            bm25 = np.zeros(count, dtype=np.float32)
+            average_length = float(self._lengths[~self._dead_mask].mean()) or 1.0
+            for term in set(tokenize(query)):
+                arrays = self._posting_arrays(term)
+                if arrays is None:
+                    continue
+                rows, frequencies = arrays
+                idf = math.log(1 + (alive - len(rows) + 0.5) / (len(rows) + 0.5))
+                lengths = self._lengths[rows]
+                bm25[rows] += idf * frequencies * (BM25_K1 + 1) / (
+                    frequencies + BM25_K1 * (1 - BM25_B + BM25_B * lengths / average_length)
+                )
+
+            scores = alpha * (bm25 / bm25.max() if bm25.max() > 0 else bm25)
+            if self.vectors is not None:
+                dense = self.vectors @ embed(query, self.dim)
+                scores += (1 - alpha) * np.clip(dense, 0, None)
+            scores[self._dead_mask] = -np.inf
+
+            k = min(k, alive)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [
+                {
+                    "content_hash": self.rows[row][0],
+                    "chunk_index": self.rows[row][1],
+                    "text": self.rows[row][2],
+                    "score": round(float(scores[row]), 4),
+                }
+                for row in top if scores[row] > 0
+            ]
+
+
+class KnowledgeIndex:
+    """Per-user indexes under ``root``, updated incrementally as blobs are processed or deleted."""
+
+    def __init__(self, engine, file_table, root: str = "indexes", dim: int = 256):
+        self.engine = engine
+        self.files = file_table
+        self.root = Path(root)
+        self.dim = dim
+        self._indexes: Dict[str, UserIndex] = {}
+        self._lock = threading.Lock()
+
+    def _index(self, user_id: str) -> UserIndex:
+        with self._lock:
+            index = self._indexes.get(user_id)
+            if index is None:
+                safe_name = re.sub(r"[^A-Za-z0-9_-]", "_", user_id)
+                index = self._indexes[user_id] = UserIndex(self.root / safe_name, self.dim)
+        if not index.exists:
+            self._build(user_id, index)
+        return index
+
+    def _chunks(self, content_hash: str) -> List[str]:
+        with self.engine.connect() as connection:
+            rows = connection.execute(
+                select(knowledge_chunks.c.content).where(knowledge_chunks.c.content_hash == content_hash)
+                .order_by(knowledge_chunks.c.chunk_index)
+            )
+            return [row.content for row in rows]
+
+    def _build(self, user_id: str, index: UserIndex) -> None:
+        # First use for this user: seed from everything already processed
+        with self.engine.connect() as connection:
+            hashes = [row.content_hash for row in connection.execute(
+                select(self.files.c.content_hash).where(
+                    self.files.c.user_id == user_id,
+                    self.files.c.is_processed == True,
+                    self.files.c.content_hash.isnot(None),
+                ).distinct()
+            )]
+        for content_hash in hashes:
+            index.add(content_hash, self._chunks(content_hash))
+        index.create()
+
+    def add_blob(self, content_hash: str, user_ids: List[str]) -> None:
+        chunks = None
+        for user_id in user_ids:
+            index = self._index(user_id)
+            if chunks is None:
+                chunks = self._chunks(content_hash)
+            index.add(content_hash, chunks)
+
+    def remove_blob(self, user_id: str, content_hash: str) -> None:
+        self._index(user_id).remove(content_hash)
+
+    def search(self, user_id: str, query: str, k: int = 5) -> List[dict]:
+        return self._index(user_id).search(query, k)
+
+
+def create_knowledge_index(engine, file_table) -> KnowledgeIndex:
+    return KnowledgeIndex(
+        engine,
+        file_table,
+        root=os.getenv("KNOWLEDGE_INDEX_DIR", "indexes"),
+        dim=int(os.getenv("KNOWLEDGE_INDEX_DIM", "256")),
+    )
@@ -0,0 +1,402 @@
+"""
+Knowledge file processing
+Извлечение текста из файлов базы знаний, нарезка на фрагменты и отметка is_processed
+"""
+
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import re
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+from xml.etree import ElementTree
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, Text, UniqueConstraint
+from sqlalchemy import and_, delete, insert, or_, select, text, update
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+metadata = MetaData()
+
+# Chunks belong to a blob, not to a file record: identical uploads share them
+knowledge_chunks = Table(
+    "knowledge_chunks",
+    metadata,
+    Column("id", Integer, primary_key=True, autoincrement=True),
+    Column("content_hash", String(64), nullable=False, index=True),
+    Column("chunk_index", Integer, nullable=False),
+    Column("content", Text, nullable=False),
+    UniqueConstraint("content_hash", "chunk_index", name="uq_knowledge_chunks_hash_index"),
+)
+
+TEXT_EXTENSIONS = {".txt", ".md", ".markdown", ".csv", ".json", ".html", ".htm", ".xml", ".yaml", ".yml"}
+DOCX_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+class UnsupportedFormat(Exception):
+    pass
+
+
+# Extraction (runs in worker processes)
+def _read_docx(path: str) -> str:
+    with zipfile.ZipFile(path) as archive:
+        root = ElementTree.fromstring(archive.read("word/document.xml"))
+    paragraphs = []
+    for paragraph in root.iter(f"{DOCX_NAMESPACE}p"):
+        paragraphs.append("".join(node.text or "" for node in paragraph.iter(f"{DOCX_NAMESPACE}t")))
+    return "\n\n".join(paragraphs)
+
+
+def _read_pdf(path: str) -> str:
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise UnsupportedFormat("PDF extraction requires the pypdf package")
+    return "\n\n".join(page.extract_text() or "" for page in PdfReader(path).pages)
+
+
+def extract_text(path: str, mime_type: str, original_name: str) -> str:
+    extension = Path(original_name or "").suffix.lower()
+    if extension == ".docx" or mime_type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
+        return _read_docx(path)
+    if extension == ".pdf" or mime_type == "application/pdf":
+        return _read_pdf(path)
+    if extension in TEXT_EXTENSIONS or (mime_type or "").startswith("text/"):
+        with open(path, "r", encoding="utf-8", errors="replace") as handle:
+            return handle.read()
+    raise UnsupportedFormat(f"Cannot extract text from {mime_type or extension or 'unknown'} files")
+
+
+def chunk_text(text: str, chunk_chars: int = 1000, overlap: int = 150) -> List[str]:
+    """Pack paragraphs into chunks of about ``chunk_chars``; long paragraphs are split on words."""
+    paragraphs = [re.sub(r"\s+", " ", part).strip() for part in re.split(r"\n\s*\n", text)]
+    chunks: List[str] = []
+    current = ""
+    for paragraph in filter(None, paragraphs):
+        while len(paragraph) > chunk_chars:
+            cut = paragraph.rfind(" ", 0, chunk_chars)
+            cut = cut if cut > chunk_chars // 2 else chunk_chars
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(paragraph[:cut].strip())
+            paragraph = paragraph[max(cut - overlap, 0):].strip()
+        if current and len(current) + len(paragraph) + 1 > chunk_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current} {paragraph}".strip()
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def process_file(path: str, mime_type: str, original_name: str, need_hash: bool) -> Tuple[List[str], Optional[str]]:
+    """Worker-process entry point: returns the file's chunks and, if asked, its sha256."""
+    content_hash = None
+    if need_hash:
+        digest = hashlib.sha256()
+        with open(path, "rb") as handle:
+            for block in iter(lambda: handle.read(1024 * 1024), b""):
+                digest.update(block)
+        content_hash = digest.hexdigest()
+    return chunk_text(extract_text(path, mime_type, original_name)), content_hash
+
+
+def forget_blob(connection, content_hash: str) -> None:
+    connection.execute(delete(knowledge_chunks).where(knowledge_chunks.c.content_hash == content_hash))
+
+
+def lock_blob(connection, content_hash: str) -> None:
+    """Hold the blob's lock until ``connection``'s transaction ends.
+
+    Uploads, deletes, claims and stores of the same content take it first, so
+    the blob file, its chunks and the records sharing it change one at a time.
+    Blocks: call it off the event loop.
+    """
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": int(content_hash[:15], 16)})
+    else:
+        # SQLite has a single writer: any write takes the database lock for the whole transaction
+        connection.execute(
+            update(knowledge_chunks).where(knowledge_chunks.c.content_hash == content_hash)
+            .values(content_hash=content_hash)
+        )
+
+
+# Pipeline (runs in the API process)
+class KnowledgeProcessor:
+    """Feeds unprocessed knowledge files to a process pool and stores the resulting chunks.
+
+    Files are identified by id and claimed in the database (``processing_started_at``)
+    before they are processed, so uvicorn workers sharing the table never process
+    the same file twice. Anything unprocessed and unclaimed is picked up by
+    ``start()`` and by a rescan every ``claim_timeout`` seconds; a claim older
+    than that belongs to a worker that died and is taken over. Files whose text
+    cannot be extracted get ``processing_error`` and are not retried.
+    ``on_processed`` callbacks receive (content_hash, user_ids) once chunks are stored.
+    """
+
+    def __init__(
+        self,
+        engine,
+        file_table,
+        workers: int = 1,
+        on_processed: Optional[List[Callable]] = None,
+        claim_timeout: float = 600.0,
+    ):
+        self.engine = engine
+        self.files = file_table
+        self.workers = workers
+        self.on_processed = on_processed or []
+        self.claim_timeout = claim_timeout
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._queued: set = set()
+        self._active: Dict[int, dict] = {}
+        self._claims: Dict[int, tuple] = {}
+        self._recheck: set = set()
+        self._recent: deque = deque(maxlen=50)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._tasks: List[asyncio.Task] = []
+        self._stats = {"processed": 0, "failed": 0, "bytes": 0, "seconds": 0.0, "chunks": 0}
+
+    async def start(self) -> None:
+        """Must run before anything in this process starts a thread.
+
+        The pool forks all of its processes on the first submit, right here; a
+        fork taken while other threads hold locks can deadlock the children, and
+        spawn would re-import the app module in every child instead.
+        """
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("fork"))
+        await asyncio.wrap_future(self._executor.submit(os.getpid))
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+        self._tasks.append(asyncio.create_task(self._rescan_loop()))
+
+    async def _rescan_loop(self) -> None:
+        # Also picks up files whose claim expired because the worker holding it died
+        while True:
+            try:
+                for file_id in await asyncio.to_thread(self._unprocessed_ids):
+                    self.submit(file_id)
+            except Exception:
+                logger.exception("Could not look for unprocessed knowledge files")
+            await asyncio.sleep(self.claim_timeout)
+
+    async def stop(self) -> None:
+        interrupted = list(self._claims.values())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if interrupted:
+            # Unfinished files stay unprocessed; without the claim any worker resumes them right away
+            await asyncio.to_thread(self._release, interrupted)
+
+    def submit(self, file_id: int) -> None:
+        if file_id in self._active:
+            # Claimed again once this run ends: a deleted record's id can come back (SQLite)
+            self._recheck.add(file_id)
+            return
+        if file_id in self._queued:
+            return
+        self._queued.add(file_id)
+        self.queue.put_nowait(file_id)
+
+    def _claimable(self, now: datetime):
+        files = self.files.c
+        return (
+            files.is_processed.isnot(True),
+            files.processing_error.is_(None),
+            or_(files.processing_started_at.is_(None),
+                files.processing_started_at < now - timedelta(seconds=self.claim_timeout)),
+        )
+
+    def _unprocessed_ids(self) -> List[int]:
+        with self.engine.connect() as connection:
+            rows = connection.execute(
+                select(self.files.c.id).where(*self._claimable(datetime.utcnow())).order_by(self.files.c.id)
+            )
+            return [row.id for row in rows]
+
+    def _claim(self, file_id: int):
+        """The file's record if this worker now owns it, None if it is done or owned elsewhere.
+
+        Unclaimed records with the same content are claimed along with it: the
+        bytes are processed once and ``_store`` marks every record sharing them.
+        """
+        now = datetime.utcnow()
+        files = self.files.c
+        with self.engine.begin() as connection:
+            content_hash = connection.execute(select(files.content_hash).where(files.id == file_id)).scalar()
+            if content_hash is not None:
+                lock_blob(connection, content_hash)
+            claimed = connection.execute(
+                update(self.files).where(files.id == file_id, *self._claimable(now))
+                .values(processing_started_at=now)
+            ).rowcount
+            if not claimed:
+                return None
+            if content_hash is not None:
+                connection.execute(
+                    update(self.files).where(files.content_hash == content_hash, *self._claimable(now))
+                    .values(processing_started_at=now)
+                )
+            return connection.execute(select(self.files).where(files.id == file_id)).first()
+
+    def _release(self, claims: List[Tuple[int, Optional[str], datetime]], error: Optional[str] = None) -> List[int]:
+        """Drop claims taken by ``_claim``, given as (file_id, content_hash, claimed_at).
+
+        Returns the ids of the other records that were claimed along with them.
+        Only rows still carrying that claim time are touched: a claim that
+        expired and was taken over by another worker is not ours to drop.
+        """
+        files = self.files.c
+        released: List[int] = []
+        with self.engine.begin() as connection:
+            for file_id, content_hash, claimed_at in claims:
+                if error is not None:
+                    connection.execute(
+                        update(self.files).where(files.id == file_id, files.processing_started_at == claimed_at)
+                        .values(processing_error=error)
+                    )
+                claimed = and_(
+                    files.id == file_id if content_hash is None else files.content_hash == content_hash,
+                    files.processing_started_at == claimed_at,
+                )
+                released += [row.id for row in connection.execute(select(files.id).where(claimed, files.id != file_id))]
+                connection.execute(update(self.files).where(claimed).values(processing_started_at=None))
+        return released
+
+    def _store(self, file_id: int, content_hash: str, chunks: List[str]) -> List[str]:
+        with self.engine.begin() as connection:
+            lock_blob(connection, content_hash)
+            connection.execute(
+                update(self.files).where(self.files.c.id == file_id, self.files.c.content_hash.is_(None))
+                .values(content_hash=content_hash)
+            )
+            if connection.execute(select(self.files.c.id).where(self.files.c.content_hash == content_hash)).first() is None:
+                # Every record was deleted while the text was extracted, and the blob with them
+                return []
+            forget_blob(connection, content_hash)
+            if chunks:
+                connection.execute(insert(knowledge_chunks), [
+                    {"content_hash": content_hash, "chunk_index": index, "content": chunk}
+                    for index, chunk in enumerate(chunks)
+                ])
+            connection.execute(
+                update(self.files).where(self.files.c.content_hash == content_hash)
+                .values(is_processed=True, processing_started_at=None)
+            )
+            rows = connection.execute(
+                select(self.files.c.user_id).where(self.files.c.content_hash == content_hash).distinct()
+            )
+            return [row.user_id for row in rows]
+
+    async def _worker(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            file_id = await self.queue.get()
+            self._queued.discard(file_id)
+            try:
+                record = await asyncio.to_thread(self._claim, file_id)
+            except Exception:
+                logger.exception("Could not claim knowledge file %s", file_id)
+                continue
+            if record is None:
+                continue
+
+            job = {"file_id": file_id, "name": record.original_name, "bytes": record.file_size, "started_at": time.time()}
+            self._active[file_id] = job
+            self._claims[file_id] = (file_id, record.content_hash, record.processing_started_at)
+            try:
+                try:
+                    chunks, computed_hash = await loop.run_in_executor(
+                        self._executor, process_file, record.file_path, record.mime_type,
+                        record.original_name, record.content_hash is None
+                    )
+                except (asyncio.CancelledError, BrokenProcessPool):
+                    # Not the file's fault: the claim expires and the rescan retries it
+                    raise
+                except Exception as error:
+                    # Same bytes, same result: retrying an unreadable file only wastes the pool.
+                    # Records that shared the claim may carry a name the text can be extracted by
+                    released = await asyncio.to_thread(
+                        self._release, [self._claims[file_id]], f"{type(error).__name__}: {error}"
+                    )
+                    for other_id in released:
+                        self.submit(other_id)
+                    raise
+                content_hash = record.content_hash or computed_hash
+                try:
+                    user_ids = await asyncio.to_thread(self._store, file_id, content_hash, chunks)
+                except IntegrityError:
+                    # Another worker stored the same blob's chunks concurrently
+                    user_ids = []
+                for callback in self.on_processed:
+                    await asyncio.to_thread(callback, content_hash, user_ids)
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                logger.warning("Failed to process knowledge file %s: %s", file_id, error)
+                self._finish(job, status="failed", error=str(error))
+            else:
+                self._finish(job, status="processed", chunks=len(chunks))
+            finally:
+                self._active.pop(file_id, None)
+                self._claims.pop(file_id, None)
+                if file_id in self._recheck:
+                    self._recheck.discard(file_id)
+                    self.submit(file_id)
+
+    def _finish(self, job: dict, status: str, chunks: int = 0, error: Optional[str] = None) -> None:
+        seconds = time.time() - job["started_at"]
+        self._stats[status] += 1
+        if status == "processed":
+            self._stats["bytes"] += job["bytes"]
+            self._stats["seconds"] += seconds
+            self._stats["chunks"] += chunks
+        self._recent.append({
+            "file_id": job["file_id"],
+            "name": job["name"],
+            "status": status,
+            "chunks": chunks,
+            "seconds": round(seconds, 3),
+            "bytes_per_second": int(job["bytes"] / seconds) if seconds > 0 else None,
+            "error": error,
+        })
+
+    def metrics(self) -> dict:
+        seconds = self._stats["seconds"]
+        return {
+            "queued": self.queue.qsize(),
+            "in_progress": [
+                {**job, "elapsed": round(time.time() - job["started_at"], 3)} for job in self._active.values()
+            ],
+            "processed": self._stats["processed"],
+            "failed": self._stats["failed"],
+            "chunks": self._stats["chunks"],
+            "bytes_per_second": int(self._stats["bytes"] / seconds) if seconds > 0 else None,
+            "recent": list(self._recent),
+        }
+
+
+def create_knowledge_processor(engine, file_table, on_processed: Optional[List[Callable]] = None) -> KnowledgeProcessor:
+    return KnowledgeProcessor(
+        engine,
+        file_table,
+        workers=int(os.getenv("KNOWLEDGE_PROCESSING_WORKERS", "1")),
+        on_processed=on_processed,
+        claim_timeout=float(os.getenv("KNOWLEDGE_PROCESSING_CLAIM_SECONDS", "600")),
+    )
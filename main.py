@@ -1,26 +1,58 @@
-from fastapi import FastAPI, Depends, HTTPException, File, UploadFile
+from fastapi import FastAPI, Depends, HTTPException, File, UploadFile, Request, Response, Query, Header
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import create_engine, Column, String, Integer, Boolean, DateTime, Text, ForeignKey
+from sqlalchemy import create_engine, Column, String, Integer, Boolean, DateTime, Text, ForeignKey, Index, select
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session, relationship
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, case
 from pydantic import BaseModel
 from datetime import datetime, timedelta
-from typing import Optional, List
+from typing import Optional, List, Tuple
 import jwt
-import bcrypt
 import os
 import uuid
+import asyncio
+import time
+import json
+import hashlib
 from pathlib import Path
+import stats_rollup
+from ttl_cache import TTLCache
+from schema_upgrade import ensure_columns, ensure_indexes
+import knowledge_processing
+import auth_tokens
+import message_log_partitions
+from knowledge_processing import create_knowledge_processor
+from knowledge_index import create_knowledge_index
+from response_cache import create_response_cache
+from async_db import create_async_database
+from db_pool import pool_options, pool_status
+import metrics
+from profiling import ProfilingMiddleware, create_request_profiler
+from password_hashing import HasherBusy, create_password_hasher
+from auth_tokens import InvalidRefreshToken, create_refresh_tokens, create_revocation_list
+from upload_storage import UploadTooLarge, blob_path, iter_upload, publish_blob, remove_file, save_stream
+from message_log_export import EXPORT_FORMATS, ExportLimitExceeded, ExportResponse, create_export_throttle, stream_export
+from message_log_query import MessageLogFilters, apply_filters, decode_cursor, encode_cursor, newest_first, newest_per_bot
+from message_log_partitions import create_message_log_partitions
+from message_log_writer import create_message_log_writer
+from messenger_client import create_messenger_client
+from bot_registry import create_bot_registry
+from webhook_dedup import create_webhook_deduplicator
+from webhook_queue import WebhookItem, QueueFull, create_webhook_queue, extract_messages, validate_update
 
 # Database setup
 DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable is required")
 
-engine = create_engine(DATABASE_URL)
+engine = create_engine(DATABASE_URL, **pool_options(DATABASE_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+async_db = create_async_database(DATABASE_URL, **pool_options(DATABASE_URL, asyncio=True))
+metrics.instrument_engine(engine)
+if async_db is not None:
+    metrics.instrument_engine(async_db.engine.sync_engine)
 Base = declarative_base()
 
 # Database Models
@@ -32,6 +64,7 @@ class User(Base):
     first_name = Column(String)
     last_name = Column(String)
     profile_image_url = Column(String)
+    password_hash = Column(String)
     created_at = Column(DateTime, default=func.now())
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
     
@@ -66,6 +99,9 @@ class KnowledgeFile(Base):
     file_size = Column(Integer, nullable=False)
     mime_type = Column(String, nullable=False)
     is_processed = Column(Boolean, default=False)
+    content_hash = Column(String(64), index=True)  # sha256, shared blob key
+    processing_started_at = Column(DateTime)  # claimed by a worker's knowledge processor
+    processing_error = Column(Text)  # text could not be extracted; not retried
     created_at = Column(DateTime, default=func.now())
     
     user = relationship("User", back_populates="knowledge_files")
@@ -82,10 +118,20 @@ class MessageLog(Base):
     response_text = Column(Text)
     response_time = Column(Integer)  # in milliseconds
     is_auto_response = Column(Boolean, default=True)
+    is_cached = Column(Boolean, default=False)  # answered from the response cache, left out of latency stats
     created_at = Column(DateTime, default=func.now())
     
     bot = relationship("Bot", back_populates="message_logs")
 
+    # Keyset pagination over one bot's history is a single index range scan
+    __table_args__ = (
+        Index("ix_message_logs_bot_created_id", bot_id, created_at.desc(), id.desc()),
+        # Redelivered webhooks: the log writer skips rows that collide here
+        Index("uq_message_logs_bot_platform_message", bot_id, platform, message_id, unique=True),
+    )
+
+stats_rollup.track(MessageLog)
+
 # Pydantic Models
 class UserCreate(BaseModel):
     id: str
@@ -114,6 +160,9 @@ class BotResponse(BaseModel):
     created_at: datetime
     updated_at: datetime
 
+    class Config:
+        from_attributes = True
+
 class MessageLogCreate(BaseModel):
     bot_id: int
     platform: str
@@ -123,11 +172,57 @@ class MessageLogCreate(BaseModel):
     response_text: Optional[str] = None
     response_time: Optional[int] = None
     is_auto_response: bool = True
+    is_cached: bool = False
+
+class MessageLogResponse(BaseModel):
+    id: int
+    bot_id: Optional[int]
+    platform: str
+    message_id: Optional[str]
+    sender_id: Optional[str]
+    message_text: Optional[str]
+    response_text: Optional[str]
+    response_time: Optional[int]
+    is_auto_response: Optional[bool]
+    is_cached: Optional[bool] = None
+    created_at: Optional[datetime]
+
+    class Config:
+        from_attributes = True
 
 class StatsResponse(BaseModel):
     total_messages: int
     active_bots: int
     avg_response_time: int
+    p50_response_time: Optional[int] = None
+    p95_response_time: Optional[int] = None
+    p99_response_time: Optional[int] = None
+
+class TimeseriesPoint(BaseModel):
+    bucket: datetime
+    bot_id: int
+    platform: str
+    message_count: int
+    auto_response_ratio: float
+    avg_response_time: Optional[int]
+    p50_response_time: Optional[int]
+    p95_response_time: Optional[int]
+    p99_response_time: Optional[int]
+
+class TimeseriesResponse(BaseModel):
+    interval: str
+    since: datetime
+    until: datetime
+    points: List[TimeseriesPoint]
+
+class MessageLogPage(BaseModel):
+    items: List[MessageLogResponse]
+    next_cursor: Optional[str]
+
+class DashboardResponse(BaseModel):
+    stats: StatsResponse
+    bots: List[BotResponse]
+    recent_activity: List[MessageLogResponse]
 
 class UserRegister(BaseModel):
     firstName: str
@@ -155,6 +250,10 @@ class Token(BaseModel):
     access_token: str
     token_type: str
     user: UserResponse
+    refresh_token: Optional[str] = None
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 # FastAPI app
 app = FastAPI(title="AI Assistant API", version="1.0.0")
@@ -167,6 +266,15 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(metrics.MetricsMiddleware)
+
+# Request profiling is only installed when configured
+profiler = create_request_profiler()
+if profiler is not None:
+    app.add_middleware(ProfilingMiddleware, profiler=profiler)
+    profiler.instrument_engine(engine)
+    if async_db is not None:
+        profiler.instrument_engine(async_db.engine.sync_engine)
 
 # Security
 security = HTTPBearer()
@@ -179,18 +287,56 @@ def get_db():
     finally:
         db.close()
 
+if async_db is not None:
+    # Handlers keep the Session API; its I/O goes through AsyncSession without blocking the loop
+    async_db.install(app)
+    get_db = async_db.get_db
+
 # Authentication utilities
 SECRET_KEY = os.getenv("SESSION_SECRET", "your-secret-key-change-this")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+TRUST_TOKEN_SECONDS = int(os.getenv("AUTH_TRUST_TOKEN_SECONDS", "0"))
+
+# Authenticated user profiles, keyed by user id
+user_cache = TTLCache(
+    maxsize=int(os.getenv("USER_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("USER_CACHE_TTL", "60"))
+)
+
+refresh_tokens = create_refresh_tokens(engine)
+revocation_list = create_revocation_list(engine)
+
+password_hasher = create_password_hasher()
 
-def hash_password(password: str) -> str:
-    import bcrypt
-    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+def password_hashing_busy() -> HTTPException:
+    return HTTPException(status_code=429, detail="Too many sign-ins in progress, retry shortly", headers={"Retry-After": "1"})
 
-def verify_password(password: str, hashed_password: str) -> bool:
-    import bcrypt
-    return bcrypt.checkpw(password.encode('utf-8'), hashed_password.encode('utf-8'))
+async def hash_password(password: str) -> str:
+    try:
+        return await password_hasher.hash(password)
+    except HasherBusy:
+        raise password_hashing_busy()
+
+async def verify_password(password: str, hashed_password: str) -> bool:
+    try:
+        return await password_hasher.verify(password, hashed_password)
+    except HasherBusy:
+        raise password_hashing_busy()
+
+async def authenticate_password(db: Session, user: User, password: str) -> bool:
+    stored = user.password_hash
+    # Hand the pooled connection back while bcrypt runs; user stays usable detached
+    db.close()
+    if stored is not None and not await verify_password(password, stored):
+        return False
+    if stored is None or password_hasher.needs_rehash(stored):
+        # Accounts created before passwords were stored get one on first login;
+        # older hashes are upgraded when BCRYPT_ROUNDS changes
+        new_hash = await hash_password(password)
+        db.query(User).filter(User.id == user.id).update({User.password_hash: new_hash})
+        db.commit()
+    return True
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -198,32 +344,70 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "iat": datetime.utcnow()})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 def verify_token(token: str):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        if user_id is None:
-            return None
-        return user_id
     except jwt.PyJWTError:
         return None
+    if payload.get("sub") is None:
+        return None
+    # Logged out sessions: an in-memory lookup, synced from the database in the background
+    if revocation_list.is_revoked(payload.get("sid")):
+        return None
+    return payload
+
+def load_user_profile(db: Session, user_id: str) -> Optional[UserResponse]:
+    profile = user_cache.get(user_id)
+    if profile is None:
+        user = db.query(User).filter(User.id == user_id).first()
+        if user is None:
+            return None
+        profile = UserResponse.from_orm(user)
+        user_cache.set(user_id, profile)
+    return profile
 
 def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
-    token = credentials.credentials
-    user_id = verify_token(token)
-    if user_id is None:
+    payload = verify_token(credentials.credentials)
+    if payload is None:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
-    
-    user = db.query(User).filter(User.id == user_id).first()
-    if user is None:
+    user_id = payload["sub"]
+
+    # Within the trust window a valid signature is enough, no user lookup
+    if TRUST_TOKEN_SECONDS and time.time() - payload.get("iat", 0) < TRUST_TOKEN_SECONDS:
+        return user_id
+
+    if load_user_profile(db, user_id) is None:
         raise HTTPException(status_code=401, detail="User not found")
-    
     return user_id
 
+if async_db is not None:
+    # Under GreenletRoute the lookup runs in the request's greenlet instead of a threadpool hop
+    _get_current_user = get_current_user
+
+    async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
+        return _get_current_user(credentials, db)
+
+def session_token(user: UserResponse, session_id: str, refresh_token: str) -> Token:
+    access_token = create_access_token(
+        data={"sub": user.id, "sid": session_id},
+        expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    )
+    return Token(access_token=access_token, token_type="bearer", user=user, refresh_token=refresh_token)
+
+async def open_session(user: User) -> Token:
+    refresh_token, session_id = await asyncio.to_thread(refresh_tokens.issue, user.id)
+    return session_token(UserResponse.from_orm(user), session_id, refresh_token)
+
+async def revoke_session(session_id: str) -> None:
+    await asyncio.to_thread(refresh_tokens.revoke_session, session_id)
+    # Access tokens already minted for the session are refused until the last of them expires
+    expires_at = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    await asyncio.to_thread(revocation_list.revoke, session_id, expires_at)
+
 # Authentication routes
 @app.post("/auth/register", response_model=Token)
 async def register(user_data: UserRegister, db: Session = Depends(get_db)):
@@ -231,61 +415,67 @@ async def register(user_data: UserRegister, db: Session = Depends(get_db)):
     existing_user = db.query(User).filter(User.email == user_data.email).first()
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
+    # Hand the pooled connection back while bcrypt runs
+    db.close()
+    hashed_password = await hash_password(user_data.password)
     
     # Create new user
-    hashed_password = hash_password(user_data.password)
     user_id = str(uuid.uuid4())
     
     user = User(
         id=user_id,
         email=user_data.email,
         first_name=user_data.firstName,
-        last_name=user_data.lastName
+        last_name=user_data.lastName,
+        password_hash=hashed_password
     )
     db.add(user)
     db.commit()
     db.refresh(user)
+    user_cache.set(user.id, UserResponse.from_orm(user))
     
-    # Create access token
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.id}, expires_delta=access_token_expires
-    )
-    
-    return Token(
-        access_token=access_token,
-        token_type="bearer",
-        user=UserResponse.from_orm(user)
-    )
+    return await open_session(user)
 
 @app.post("/auth/login", response_model=Token)
 async def login(login_data: UserLogin, db: Session = Depends(get_db)):
     user = db.query(User).filter(User.email == login_data.email).first()
     if not user:
         raise HTTPException(status_code=401, detail="Invalid email or password")
+    if not await authenticate_password(db, user, login_data.password):
+        raise HTTPException(status_code=401, detail="Invalid email or password")
     
-    # For demo purposes, accept any password for existing users
-    # In production, you would verify the password hash
-    
-    # Create access token
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.id}, expires_delta=access_token_expires
-    )
-    
-    return Token(
-        access_token=access_token,
-        token_type="bearer",
-        user=UserResponse.from_orm(user)
-    )
+    user_cache.set(user.id, UserResponse.from_orm(user))
+    return await open_session(user)
+
+@app.post("/auth/refresh", response_model=Token)
+async def refresh_session(refresh_data: RefreshRequest, db: Session = Depends(get_db)):
+    try:
+        user_id, session_id, refresh_token = await asyncio.to_thread(refresh_tokens.rotate, refresh_data.refresh_token)
+    except InvalidRefreshToken as error:
+        if error.reused_session is not None:
+            await revoke_session(error.reused_session)
+        raise HTTPException(status_code=401, detail="Invalid refresh token")
+    profile = load_user_profile(db, user_id)
+    if profile is None:
+        raise HTTPException(status_code=401, detail="User not found")
+    return session_token(profile, session_id, refresh_token)
+
+@app.post("/auth/logout")
+async def logout(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    payload = verify_token(credentials.credentials)
+    if payload is None:
+        raise HTTPException(status_code=401, detail="Invalid authentication credentials")
+    if payload.get("sid") is not None:
+        await revoke_session(payload["sid"])
+    return {"message": "Logged out"}
 
 # Routes
 @app.get("/user", response_model=UserResponse)
 async def get_user(current_user: str = Depends(get_current_user), db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == current_user).first()
-    if not user:
+    profile = load_user_profile(db, current_user)
+    if not profile:
         raise HTTPException(status_code=404, detail="User not found")
-    return user
+    return profile
 
 @app.get("/bots", response_model=List[BotResponse])
 async def get_bots(current_user: str = Depends(get_current_user), db: Session = Depends(get_db)):
@@ -298,6 +488,7 @@ async def create_bot(bot_data: BotCreate, current_user: str = Depends(get_curren
     db.add(bot)
     db.commit()
     db.refresh(bot)
+    await asyncio.to_thread(bot_registry.invalidate, bot.id)
     return bot
 
 @app.put("/bots/{bot_id}", response_model=BotResponse)
@@ -311,6 +502,7 @@ async def update_bot(bot_id: int, bot_data: dict, current_user: str = Depends(ge
     
     db.commit()
     db.refresh(bot)
+    await asyncio.to_thread(bot_registry.invalidate, bot_id)
     return bot
 
 @app.delete("/bots/{bot_id}")
@@ -319,8 +511,10 @@ async def delete_bot(bot_id: int, current_user: str = Depends(get_current_user),
     if not bot:
         raise HTTPException(status_code=404, detail="Bot not found")
     
+    stats_rollup.forget_bot(db.connection(), bot_id)
     db.delete(bot)
     db.commit()
+    await asyncio.to_thread(bot_registry.invalidate, bot_id)
     return {"success": True}
 
 @app.get("/knowledge-files")
@@ -328,116 +522,525 @@ async def get_knowledge_files(current_user: str = Depends(get_current_user), db:
     files = db.query(KnowledgeFile).filter(KnowledgeFile.user_id == current_user).all()
     return files
 
+MAX_UPLOAD_BYTES = int(os.getenv("KNOWLEDGE_FILE_MAX_BYTES", str(50 * 1024 * 1024)))
+knowledge_index = create_knowledge_index(engine, KnowledgeFile.__table__)
+response_cache = create_response_cache()
+# Cached answers go stale with the bot or its owner's knowledge; the registry passes
+# both kinds of invalidation on to every worker
+bot_registry = create_bot_registry(
+    engine, Bot.__table__,
+    on_bot_change=[response_cache.invalidate_bot], on_user_change=[response_cache.invalidate_user]
+)
+
+def forget_cached_answers(content_hash: str, user_ids: List[str]):
+    # Answers come from the owner's knowledge files and go stale with them
+    for user_id in user_ids:
+        bot_registry.invalidate_user(user_id)
+
+knowledge_processor = create_knowledge_processor(
+    engine, KnowledgeFile.__table__, on_processed=[knowledge_index.add_blob, forget_cached_answers]
+)
+
+def register_knowledge_file(temp_path: Path, knowledge_file: KnowledgeFile) -> KnowledgeFile:
+    # Under the blob's lock: a delete of the last reference cannot remove the file
+    # or its chunks between the checks below and the commit
+    with SessionLocal() as db:
+        knowledge_processing.lock_blob(db.connection(), knowledge_file.content_hash)
+        # Identical bytes are stored once and shared by every record with the same hash
+        publish_blob(temp_path, Path(knowledge_file.file_path))
+        siblings = db.query(KnowledgeFile.is_processed, KnowledgeFile.processing_started_at).filter(
+            KnowledgeFile.content_hash == knowledge_file.content_hash,
+            KnowledgeFile.processing_error.is_(None)
+        ).all()
+        if any(sibling.is_processed for sibling in siblings):
+            knowledge_file.is_processed = True
+        elif siblings:
+            # Still being processed: share that claim, the result marks this record too.
+            # Submitted anyway; the claim keeps the worker from processing it a second time
+            claims = [sibling.processing_started_at for sibling in siblings if sibling.processing_started_at]
+            knowledge_file.processing_started_at = max(claims) if claims else None
+        db.add(knowledge_file)
+        db.commit()
+        db.refresh(knowledge_file)
+        return knowledge_file
+
+async def store_knowledge_file(user_id: str, chunks, original_name: Optional[str], mime_type: Optional[str]):
+    upload_dir = Path("uploads")
+    temp_dir = upload_dir / "tmp"
+    temp_dir.mkdir(parents=True, exist_ok=True)
+    temp_path = temp_dir / str(uuid.uuid4())
+
+    # Written chunk by chunk, never buffered whole in memory
+    try:
+        file_size, content_hash = await save_stream(chunks, temp_path, MAX_UPLOAD_BYTES)
+    except UploadTooLarge:
+        raise HTTPException(status_code=413, detail="File is too large")
+
+    knowledge_file = await asyncio.to_thread(register_knowledge_file, temp_path, KnowledgeFile(
+        user_id=user_id,
+        file_name=content_hash,
+        original_name=original_name or "unknown",
+        file_path=str(blob_path(upload_dir, content_hash)),
+        file_size=file_size,
+        mime_type=mime_type or "application/octet-stream",
+        content_hash=content_hash,
+        is_processed=False
+    ))
+    if knowledge_file.is_processed:
+        # Chunks already exist for this content, only this user's index needs them
+        await asyncio.to_thread(knowledge_index.add_blob, content_hash, [user_id])
+        await asyncio.to_thread(bot_registry.invalidate_user, user_id)
+    else:
+        knowledge_processor.submit(knowledge_file.id)
+    return knowledge_file
+
+@app.get("/knowledge-files/processing")
+async def get_knowledge_processing(current_user: str = Depends(get_current_user)):
+    return knowledge_processor.metrics()
+
+@app.get("/knowledge-files/search")
+async def search_knowledge_files(
+    q: str = Query(..., min_length=1),
+    k: int = Query(5, ge=1, le=50),
+    current_user: str = Depends(get_current_user)
+):
+    results = await asyncio.to_thread(knowledge_index.search, current_user, q, k)
+    return {"query": q, "results": results}
+
 @app.post("/knowledge-files")
 async def upload_knowledge_file(
     file: UploadFile = File(...),
-    current_user: str = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: str = Depends(get_current_user)
 ):
-    # Create uploads directory if it doesn't exist
-    upload_dir = Path("uploads")
-    upload_dir.mkdir(exist_ok=True)
-    
-    # Generate unique filename
-    file_extension = Path(file.filename or "").suffix
-    unique_filename = f"{uuid.uuid4()}{file_extension}"
-    file_path = upload_dir / unique_filename
-    
-    # Save file
-    content = await file.read()
-    with open(file_path, "wb") as f:
-        f.write(content)
-    
-    # Save to database
-    knowledge_file = KnowledgeFile(
-        user_id=current_user,
-        file_name=unique_filename,
-        original_name=file.filename,
-        file_path=str(file_path),
-        file_size=len(content),
-        mime_type=file.content_type or "application/octet-stream"
-    )
-    db.add(knowledge_file)
-    db.commit()
-    db.refresh(knowledge_file)
-    
-    return knowledge_file
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="File is too large")
+    return await store_knowledge_file(current_user, iter_upload(file), file.filename, file.content_type)
+
+@app.post("/knowledge-files/stream")
+async def stream_knowledge_file(
+    request: Request,
+    filename: str = Query(...),
+    current_user: str = Depends(get_current_user)
+):
+    # Raw request body, read straight off the socket: oversized uploads are cut off mid-transfer
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="File is too large")
+    return await store_knowledge_file(current_user, request.stream(), filename, request.headers.get("content-type"))
+
+def drop_knowledge_file(user_id: str, file_id: int) -> Optional[Tuple[Optional[str], bool]]:
+    """(content_hash, whether the user still has that content) or None if there is no such file."""
+    with SessionLocal() as db:
+        file_record = db.query(KnowledgeFile.content_hash, KnowledgeFile.file_path).filter(
+            KnowledgeFile.id == file_id,
+            KnowledgeFile.user_id == user_id
+        ).first()
+        if not file_record:
+            return None
+        content_hash = file_record.content_hash
+        if content_hash is not None:
+            # Uploads of the same bytes wait: they must see either the record or no blob at all
+            knowledge_processing.lock_blob(db.connection(), content_hash)
+        if not db.query(KnowledgeFile).filter(KnowledgeFile.id == file_id).delete():
+            return None
+
+        user_keeps = content_hash is not None and db.query(KnowledgeFile.id).filter(
+            KnowledgeFile.content_hash == content_hash,
+            KnowledgeFile.user_id == user_id
+        ).first() is not None
+        # The blob goes away with its last reference
+        if content_hash is None or db.query(KnowledgeFile.id).filter(KnowledgeFile.content_hash == content_hash).first() is None:
+            remove_file(Path(file_record.file_path))
+            if content_hash is not None:
+                knowledge_processing.forget_blob(db.connection(), content_hash)
+        db.commit()
+        return content_hash, user_keeps
 
 @app.delete("/knowledge-files/{file_id}")
-async def delete_knowledge_file(file_id: int, current_user: str = Depends(get_current_user), db: Session = Depends(get_db)):
-    file_record = db.query(KnowledgeFile).filter(
-        KnowledgeFile.id == file_id, 
-        KnowledgeFile.user_id == current_user
-    ).first()
-    
-    if not file_record:
+async def delete_knowledge_file(file_id: int, current_user: str = Depends(get_current_user)):
+    dropped = await asyncio.to_thread(drop_knowledge_file, current_user, file_id)
+    if dropped is None:
         raise HTTPException(status_code=404, detail="File not found")
-    
-    # Delete file from filesystem
-    file_path_str = str(file_record.file_path)
-    if os.path.exists(file_path_str):
-        os.remove(file_path_str)
-    
-    # Delete from database
-    db.delete(file_record)
-    db.commit()
+
+    content_hash, user_keeps = dropped
+    if content_hash is not None and not user_keeps:
+        await asyncio.to_thread(knowledge_index.remove_blob, current_user, content_hash)
+        await asyncio.to_thread(bot_registry.invalidate_user, current_user)
     return {"success": True}
 
-@app.get("/stats", response_model=StatsResponse)
-async def get_stats(current_user: str = Depends(get_current_user), db: Session = Depends(get_db)):
-    # Get user's bots
-    user_bots = db.query(Bot).filter(Bot.user_id == current_user).all()
-    bot_ids = [bot.id for bot in user_bots]
-    
-    # Count total messages
-    total_messages = db.query(MessageLog).filter(MessageLog.bot_id.in_(bot_ids)).count() if bot_ids else 0
-    
-    # Count active bots
-    active_bots = db.query(Bot).filter(Bot.user_id == current_user, Bot.is_active == True).count()
-    
-    # Calculate average response time
-    avg_response_time = db.query(func.avg(MessageLog.response_time)).filter(
-        MessageLog.bot_id.in_(bot_ids)
-    ).scalar() or 0
-    
+def load_user_stats(db: Session, user_id: str) -> StatsResponse:
+    bot_stats = stats_rollup.bot_stats
+    active_bots, total_messages, response_time_sum, response_time_count = db.query(
+        func.coalesce(func.sum(case((Bot.is_active == True, 1), else_=0)), 0),
+        func.coalesce(func.sum(bot_stats.c.message_count), 0),
+        func.coalesce(func.sum(bot_stats.c.response_time_sum), 0),
+        func.coalesce(func.sum(bot_stats.c.response_time_count), 0),
+    ).select_from(Bot).outerjoin(bot_stats, bot_stats.c.bot_id == Bot.id).filter(Bot.user_id == user_id).one()
+    # Percentiles from the merged per-bot sketches: a few hundred bins, no log scan
+    sketch = stats_rollup.load_sketch(db.connection(), select(Bot.id).where(Bot.user_id == user_id))
+
     return StatsResponse(
         total_messages=total_messages,
         active_bots=active_bots,
-        avg_response_time=int(avg_response_time)
+        avg_response_time=int(response_time_sum / response_time_count) if response_time_count else 0,
+        **stats_rollup.response_time_percentiles(sketch)
     )
 
+@app.get("/stats", response_model=StatsResponse)
+async def get_stats(current_user: str = Depends(get_current_user), db: Session = Depends(get_db)):
+    # Served from the bot_stats rollup instead of scanning message_logs
+    return load_user_stats(db, current_user)
+
+@app.post("/stats/rebuild", response_model=StatsResponse)
+async def rebuild_stats(current_user: str = Depends(get_current_user), db: Session = Depends(get_db)):
+    bot_ids = [bot_id for (bot_id,) in db.query(Bot.id).filter(Bot.user_id == current_user)]
+    stats_rollup.rebuild(db.connection(), bot_ids)
+    db.commit()
+    return load_user_stats(db, current_user)
+
+@app.get("/stats/timeseries", response_model=TimeseriesResponse)
+async def get_stats_timeseries(
+    interval: str = Query("day", pattern="^(hour|day)$"),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    bot_id: Optional[int] = None,
+    platform: Optional[str] = None,
+    current_user: str = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    # Read from the hourly/daily rollups: one row per bucket, bot and platform
+    until = stats_rollup.utc_naive(until) or datetime.utcnow()
+    since = stats_rollup.utc_naive(since) or until - timedelta(days=2 if interval == "hour" else 30)
+    if since >= until or until - since > stats_rollup.MAX_TIMESERIES_SPAN[interval]:
+        raise HTTPException(status_code=400, detail="Invalid time range for this interval")
+
+    bots = db.query(Bot.id).filter(Bot.user_id == current_user)
+    if bot_id is not None:
+        bots = bots.filter(Bot.id == bot_id)
+    bot_ids = [row.id for row in bots]
+    points = stats_rollup.load_timeseries(db.connection(), interval, bot_ids, since, until, platform)
+    return TimeseriesResponse(interval=interval, since=since, until=until, points=points)
+
+@app.get("/stats/response-times")
+async def get_response_time_percentiles(
+    bot_id: Optional[List[int]] = Query(None),
+    current_user: str = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    # Any subset of the user's bots (all by default), merged from their sketches
+    bots = select(Bot.id).where(Bot.user_id == current_user)
+    if bot_id:
+        bots = bots.where(Bot.id.in_(bot_id))
+    sketch = stats_rollup.load_sketch(db.connection(), bots)
+    return {"count": sketch.count, **stats_rollup.response_time_percentiles(sketch)}
+
+def load_recent_activity(db: Session, user_id: str, bot_ids: Optional[List[int]] = None, limit: int = 10):
+    if bot_ids is None:
+        bot_ids = [bot_id for (bot_id,) in db.query(Bot.id).filter(Bot.user_id == user_id)]
+    if not bot_ids:
+        return []
+    query = db.query(MessageLog).filter(MessageLog.id.in_(newest_per_bot(MessageLog, bot_ids, limit)))
+    return newest_first(query, MessageLog).limit(limit).all()
+
+def etag_response(request: Request, content) -> Response:
+    body = json.dumps(jsonable_encoder(content), separators=(",", ":")).encode("utf-8")
+    etag = '"%s"' % hashlib.sha1(body).hexdigest()
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 @app.get("/recent-activity")
 async def get_recent_activity(current_user: str = Depends(get_current_user), db: Session = Depends(get_db)):
-    # Get user's bots
-    user_bots = db.query(Bot).filter(Bot.user_id == current_user).all()
-    bot_ids = [bot.id for bot in user_bots]
-    
-    # Get recent messages
-    recent_messages = db.query(MessageLog).filter(
-        MessageLog.bot_id.in_(bot_ids)
-    ).order_by(MessageLog.created_at.desc()).limit(10).all() if bot_ids else []
-    
-    return recent_messages
+    return load_recent_activity(db, current_user)
+
+@app.get("/message-logs", response_model=MessageLogPage)
+async def list_message_logs(
+    cursor: Optional[str] = None,
+    limit: int = Query(50, ge=1, le=500),
+    filters: MessageLogFilters = Depends(),
+    current_user: str = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    after = None
+    if cursor:
+        after = decode_cursor(cursor)
+        if after is None:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    bot_ids = [bot_id for (bot_id,) in db.query(Bot.id).filter(Bot.user_id == current_user)]
+    if filters.bot_id is not None:
+        bot_ids = [bot_id for bot_id in bot_ids if bot_id == filters.bot_id]
+    if not bot_ids:
+        return MessageLogPage(items=[], next_cursor=None)
+
+    query = db.query(MessageLog).filter(MessageLog.id.in_(newest_per_bot(MessageLog, bot_ids, limit + 1, filters, after)))
+    logs = newest_first(query, MessageLog).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(logs) > limit:
+        logs = logs[:limit]
+        next_cursor = encode_cursor(logs[-1].created_at, logs[-1].id)
+    return MessageLogPage(items=[MessageLogResponse.from_orm(log) for log in logs], next_cursor=next_cursor)
+
+export_throttle = create_export_throttle()
+
+@app.get("/message-logs/export")
+async def export_message_logs(
+    fmt: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$"),
+    gzip: bool = False,
+    filters: MessageLogFilters = Depends(),
+    current_user: str = Depends(get_current_user)
+):
+    columns = [column.name for column in MessageLog.__table__.columns]
+    statement = select(*MessageLog.__table__.columns).join(Bot, Bot.id == MessageLog.bot_id).where(Bot.user_id == current_user)
+    statement = apply_filters(statement, MessageLog, filters).order_by(MessageLog.created_at, MessageLog.id)
+
+    try:
+        export_throttle.acquire(current_user)
+    except ExportLimitExceeded:
+        raise HTTPException(status_code=429, detail="Another export is already running")
+
+    filename = f"message_logs.{fmt}.gz" if gzip else f"message_logs.{fmt}"
+    return ExportResponse(
+        stream_export(SessionLocal, statement, columns, fmt, gzip, export_throttle),
+        export_throttle,
+        current_user,
+        media_type="application/gzip" if gzip else EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@app.get("/dashboard", response_model=DashboardResponse)
+async def get_dashboard(request: Request, current_user: str = Depends(get_current_user), db: Session = Depends(get_db)):
+    # Bots with their rollup counters and sketch bins in one query, recent messages in a second
+    bot_stats = stats_rollup.bot_stats
+    rows = db.query(
+        Bot, bot_stats.c.message_count, bot_stats.c.response_time_sum, bot_stats.c.response_time_count,
+        stats_rollup.sketch_bins(Bot.id).label("sketch_bins")
+    ).outerjoin(bot_stats, bot_stats.c.bot_id == Bot.id).filter(Bot.user_id == current_user).order_by(Bot.id).all()
+
+    response_time_sum = sum(row.response_time_sum or 0 for row in rows)
+    response_time_count = sum(row.response_time_count or 0 for row in rows)
+    sketch = stats_rollup.merge_sketch_bins(row.sketch_bins for row in rows)
+    dashboard = DashboardResponse(
+        stats=StatsResponse(
+            total_messages=sum(row.message_count or 0 for row in rows),
+            active_bots=sum(1 for row in rows if row.Bot.is_active),
+            avg_response_time=int(response_time_sum / response_time_count) if response_time_count else 0,
+            **stats_rollup.response_time_percentiles(sketch)
+        ),
+        bots=[BotResponse.from_orm(row.Bot) for row in rows],
+        recent_activity=[
+            MessageLogResponse.from_orm(log) for log in load_recent_activity(db, current_user, [row.Bot.id for row in rows])
+        ]
+    )
+    return etag_response(request, dashboard)
 
 # Webhook endpoints for external integrations
+# Retired months stay in the totals rebuilds start from
+log_partitions = create_message_log_partitions(engine, MessageLog.__table__, on_retire=[stats_rollup.carry_over])
+message_log_writer = create_message_log_writer(
+    engine, MessageLog.__table__, before_write=log_partitions.claim, after_write=[stats_rollup.record_messages]
+)
+
+AUTO_RESPONSE_MIN_SCORE = float(os.getenv("AUTO_RESPONSE_MIN_SCORE", "0.3"))
+
+def generate_response(bot_id: int, question: str):
+    # Best matching chunk of the bot owner's knowledge files, or None when nothing fits
+    bot = bot_registry.get(bot_id)
+    if bot is None:
+        return None, None
+    results = knowledge_index.search(bot.user_id, question, 1)
+    if not results or results[0]["score"] < AUTO_RESPONSE_MIN_SCORE:
+        return bot.user_id, None
+    return bot.user_id, results[0]["text"]
+
+messenger = create_messenger_client()
+
+def send_reply(platform: str, bot_id: int, chat_id: str, text: str):
+    bot = bot_registry.get(bot_id)
+    if bot is not None and bot.token:
+        # Queued on the outbound client; rate limits and retries never hold up this worker
+        messenger.dispatch(platform, bot_id, bot.token, chat_id, text, sender_id=bot.config.get("phone_number_id"))
+
+async def answer_message(bot_id: int, question: Optional[str]) -> Tuple[Optional[str], bool]:
+    """The answer, if any, and whether it came from the response cache."""
+    if not question:
+        return None, False
+    answer = response_cache.get(bot_id, question)
+    metrics.observe_response_cache(answer is not None)
+    if answer is not None:
+        return answer, True
+    epoch = response_cache.epoch
+    user_id, answer = await asyncio.to_thread(generate_response, bot_id, question)
+    if answer is not None:
+        response_cache.set(bot_id, user_id, question, answer, epoch)
+    return answer, False
+
+async def process_webhook_update(item: WebhookItem):
+    # Runs on a queue worker, outside the HTTP request
+    received = time.perf_counter()
+    try:
+        for message in extract_messages(item.platform, item.update):
+            started = time.perf_counter()
+            response_text, cached = await answer_message(item.bot_id, message["message_text"])
+            message_log_writer.add(MessageLogCreate(
+                bot_id=item.bot_id,
+                platform=item.platform,
+                response_text=response_text,
+                response_time=int((time.perf_counter() - started) * 1000) if response_text else None,
+                is_auto_response=response_text is not None,
+                # Near-zero times of cache hits would drag the latency rollups down
+                is_cached=cached,
+                **message
+            ))
+            if response_text is not None and message.get("chat_id"):
+                send_reply(item.platform, item.bot_id, message["chat_id"], response_text)
+    finally:
+        metrics.observe_webhook(item.platform, time.perf_counter() - received)
+
+webhook_queue = create_webhook_queue(process_webhook_update)
+webhook_dedup = create_webhook_deduplicator()
+
+def enqueue_webhook(platform: str, bot_id: int, update: dict):
+    # Unknown and inactive bots are not in the registry: refused without a query
+    bot = bot_registry.get(bot_id)
+    if bot is None or bot.platform != platform:
+        raise HTTPException(status_code=404, detail="Bot not found")
+    if not validate_update(platform, update):
+        raise HTTPException(status_code=400, detail="Invalid update payload")
+    keys = webhook_dedup.keys(platform, bot_id, update)
+    if webhook_dedup.is_duplicate(keys):
+        # Still a 2xx, or the platform keeps retrying
+        return {"status": "duplicate"}
+    try:
+        webhook_queue.submit(platform, bot_id, update)
+    except QueueFull:
+        raise HTTPException(status_code=503, detail="Webhook queue is full", headers={"Retry-After": "1"})
+    # Only accepted updates count as seen, so a 503 retry is processed normally
+    webhook_dedup.remember(keys)
+    return {"status": "success"}
+
 @app.post("/webhooks/telegram/{bot_id}")
-async def telegram_webhook(bot_id: int, update: dict, db: Session = Depends(get_db)):
+async def telegram_webhook(bot_id: int, update: dict):
     # Process Telegram webhook
-    return {"status": "success"}
+    return enqueue_webhook("telegram", bot_id, update)
 
 @app.post("/webhooks/whatsapp/{bot_id}")
-async def whatsapp_webhook(bot_id: int, update: dict, db: Session = Depends(get_db)):
+async def whatsapp_webhook(bot_id: int, update: dict):
     # Process WhatsApp webhook
-    return {"status": "success"}
+    return enqueue_webhook("whatsapp", bot_id, update)
 
 @app.post("/webhooks/instagram/{bot_id}")
-async def instagram_webhook(bot_id: int, update: dict, db: Session = Depends(get_db)):
+async def instagram_webhook(bot_id: int, update: dict):
     # Process Instagram webhook
-    return {"status": "success"}
+    return enqueue_webhook("instagram", bot_id, update)
+
+@app.get("/webhooks/queue")
+async def get_webhook_queue_metrics(current_user: str = Depends(get_current_user)):
+    return {**webhook_queue.metrics(), "dedup": webhook_dedup.metrics()}
+
+@app.get("/webhooks/bot-registry")
+async def get_bot_registry_metrics(current_user: str = Depends(get_current_user)):
+    return bot_registry.metrics()
+
+@app.get("/webhooks/outbound")
+async def get_outbound_metrics(current_user: str = Depends(get_current_user)):
+    return messenger.metrics()
+
+@app.get("/webhooks/response-cache")
+async def get_response_cache_stats(current_user: str = Depends(get_current_user)):
+    return response_cache.stats()
+
+@app.get("/message-logs/writer")
+async def get_message_log_writer_metrics(current_user: str = Depends(get_current_user)):
+    return message_log_writer.metrics()
+
+@app.get("/message-logs/partitions")
+async def get_message_log_partitions(current_user: str = Depends(get_current_user)):
+    return log_partitions.metrics()
+
+@app.get("/db/pool")
+async def get_db_pool_metrics(current_user: str = Depends(get_current_user)):
+    # Per worker process; multiply by the worker count when sizing against max_connections
+    pools = {"sync": pool_status(engine)}
+    if async_db is not None:
+        pools["async"] = pool_status(async_db.engine)
+    return pools
+
+@app.get("/metrics")
+async def get_metrics():
+    content, content_type = metrics.render()
+    return Response(content=content, media_type=content_type)
+
+@app.get("/debug/profiles")
+async def get_request_profiles(
+    x_profile_token: Optional[str] = Header(None),
+    current_user: str = Depends(get_current_user)
+):
+    # Profiles hold every tenant's paths and SQL: readable with the admin token only
+    if profiler is None or profiler.token is None:
+        raise HTTPException(status_code=404, detail="Not found")
+    if not profiler.is_admin(x_profile_token):
+        raise HTTPException(status_code=403, detail="Profiling token required")
+    return list(reversed(profiler.profiles))
+
+# Background workers
+@app.on_event("startup")
+async def start_background_workers():
+    # First: its process pool forks, which is only safe before any thread has started
+    await knowledge_processor.start()
+    await asyncio.to_thread(bot_registry.start)
+    await message_log_writer.start()
+    await log_partitions.start()
+    await webhook_queue.start()
+    await revocation_list.start()
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    await revocation_list.stop()
+    await webhook_queue.stop()
+    await messenger.stop()
+    await asyncio.to_thread(bot_registry.stop)
+    await log_partitions.stop()
+    await message_log_writer.stop()
+    await knowledge_processor.stop()
+    if async_db is not None:
+        await async_db.dispose()
+    metrics.shutdown()
+    password_hasher.shutdown()
 
 # Create tables
+log_partitions.prepare()
 Base.metadata.create_all(bind=engine)
+ensure_columns(engine, User.__table__)
+ensure_columns(engine, KnowledgeFile.__table__)
+ensure_columns(engine, MessageLog.__table__)
+stats_rollup.metadata.create_all(bind=engine)
+knowledge_processing.metadata.create_all(bind=engine)
+auth_tokens.metadata.create_all(bind=engine)
+message_log_partitions.metadata.create_all(bind=engine)
+
+if os.getenv("STATS_REBUILD_ON_STARTUP") == "1":
+    with engine.begin() as connection:
+        stats_rollup.rebuild(connection)
+
+def migrate():
+    """Indexes added to tables that already exist: a slow build, run once per deploy.
+
+    ``python main.py migrate`` runs only this; starting the server this way runs it first.
+    Fresh databases get every index from create_all above.
+    """
+    ensure_indexes(engine, KnowledgeFile.__table__)
+    if not log_partitions.partitioned:
+        # A partitioned message_logs gets its indexes with the table and cannot hold the unique one
+        ensure_indexes(engine, MessageLog.__table__)
 
 if __name__ == "__main__":
+    import sys
+    migrate()
+    if sys.argv[1:] == ["migrate"]:
+        sys.exit(0)
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,138 @@
+"""
+Message log export
+Потоковая выгрузка истории сообщений в NDJSON/CSV с постоянным потреблением памяти
+"""
+
+import csv
+import io
+import json
+import os
+import threading
+import time
+import zlib
+from datetime import datetime
+from typing import Dict, Iterator, List
+
+from starlette.responses import StreamingResponse
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+class ExportLimitExceeded(Exception):
+    pass
+
+
+class ExportThrottle:
+    """Per-user cap on concurrent exports plus an optional rows/second ceiling."""
+
+    def __init__(self, max_concurrent: int = 1, rows_per_second: int = 0):
+        self.max_concurrent = max_concurrent
+        self.rows_per_second = rows_per_second
+        self._active: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, user_id: str) -> None:
+        with self._lock:
+            if self._active.get(user_id, 0) >= self.max_concurrent:
+                raise ExportLimitExceeded()
+            self._active[user_id] = self._active.get(user_id, 0) + 1
+
+    def release(self, user_id: str) -> None:
+        with self._lock:
+            remaining = self._active.get(user_id, 0) - 1
+            if remaining > 0:
+                self._active[user_id] = remaining
+            else:
+                self._active.pop(user_id, None)
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def _serialize(fmt: str, columns: List[str], rows) -> str:
+    if fmt == "ndjson":
+        return "".join(
+            json.dumps(dict(zip(columns, row)), default=_json_default, ensure_ascii=False) + "\n" for row in rows
+        )
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(
+        [value.isoformat() if isinstance(value, datetime) else value for value in row] for row in rows
+    )
+    return buffer.getvalue()
+
+
+def stream_export(
+    session_factory,
+    statement,
+    columns: List[str],
+    fmt: str,
+    compress: bool,
+    throttle: ExportThrottle,
+    batch_rows: int = 1000,
+) -> Iterator[bytes]:
+    """Yield the encoded export chunk by chunk.
+
+    Rows come from a server-side cursor ``batch_rows`` at a time, so memory use
+    does not depend on the size of the export. The session is owned by the
+    generator because the response outlives the request's own session.
+    """
+    session = session_factory()
+    compressor = zlib.compressobj(wbits=31) if compress else None  # gzip container
+    started = time.monotonic()
+    sent = 0
+    try:
+        header = _serialize("csv", columns, [columns]) if fmt == "csv" else ""
+        if header:
+            data = header.encode("utf-8")
+            yield compressor.compress(data) if compressor else data
+
+        result = session.execute(statement.execution_options(stream_results=True, yield_per=batch_rows))
+        for rows in result.partitions():
+            data = _serialize(fmt, columns, rows).encode("utf-8")
+            chunk = compressor.compress(data) if compressor else data
+            if chunk:
+                yield chunk
+
+            sent += len(rows)
+            if throttle.rows_per_second:
+                ahead = sent / throttle.rows_per_second - (time.monotonic() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+        if compressor:
+            yield compressor.flush()
+    finally:
+        session.close()
+
+
+class ExportResponse(StreamingResponse):
+    """Streaming export that gives the user's throttle slot back however the response ends.
+
+    The slot is taken by the handler so it can still answer 429. Releasing it
+    here rather than in the generator also covers a client that disconnects
+    before the body starts, when the generator never runs at all.
+    """
+
+    def __init__(self, content, throttle: ExportThrottle, user_id: str, **kwargs):
+        super().__init__(content, **kwargs)
+        self.throttle = throttle
+        self.user_id = user_id
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.throttle.release(self.user_id)
+
+
+def create_export_throttle() -> ExportThrottle:
+    return ExportThrottle(
+        max_concurrent=int(os.getenv("EXPORT_MAX_CONCURRENT_PER_USER", "1")),
+        rows_per_second=int(os.getenv("EXPORT_MAX_ROWS_PER_SECOND", "0")),
+    )
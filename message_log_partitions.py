@@ -0,0 +1,444 @@
+"""
+Message log partitions and retention
+Помесячное секционирование message_logs (PostgreSQL), создание будущих секций и архивирование старых в gzip CSV
+"""
+
+import asyncio
+import csv
+import gzip
+import io
+import logging
+import os
+import re
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table
+from sqlalchemy import delete, func, select, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateColumn, CreateIndex
+
+logger = logging.getLogger(__name__)
+
+metadata = MetaData()
+
+# A partitioned table cannot have a unique index without the partition key, so
+# redelivered webhooks are caught here instead of by uq_message_logs_bot_platform_message.
+# Redeliveries arrive within hours; keys are kept for KEY_WINDOW only.
+message_log_keys = Table(
+    "message_log_keys",
+    metadata,
+    Column("bot_id", Integer, primary_key=True),
+    Column("platform", String, primary_key=True),
+    Column("message_id", String, primary_key=True),
+    Column("created_at", DateTime, nullable=False, index=True),
+)
+
+# Arbitrary, shared by all workers: only one of them runs maintenance at a time
+ADVISORY_LOCK_ID = 0x6D736770
+
+
+def month_start(moment: datetime) -> datetime:
+    return datetime(moment.year, moment.month, 1)
+
+
+def add_months(moment: datetime, months: int) -> datetime:
+    index = moment.year * 12 + moment.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def _csv_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+class MessageLogPartitions:
+    """Monthly range partitions of message_logs by created_at, plus retention.
+
+    On PostgreSQL with ``enabled`` a new database gets message_logs as a
+    partitioned table (``prepare``, before create_all); an existing one is
+    moved over with ``convert`` while the app is stopped. A maintenance task
+    keeps ``months_ahead`` future partitions created and, when
+    ``retention_months`` is set, detaches partitions older than that, writes
+    each to ``archive_dir`` as gzip CSV and drops it.
+
+    A logged row whose month has no partition yet (back-dated, or further
+    ahead than ``months_ahead``) gets one created by ``claim`` in the write's
+    transaction, so one such row does not fail the writer's whole batch.
+
+    Elsewhere (SQLite, or partitioning disabled) retention still applies:
+    old months are archived the same way and deleted row-wise, in batches of
+    ``DELETE_BATCH_ROWS`` so no transaction holds a whole month's row locks.
+    An archive file is never overwritten; a retry after an interrupted run
+    writes the month's remaining rows to a numbered file next to it.
+    ``on_retire`` callbacks receive (connection, select of the rows) in the
+    transaction that removes them, e.g. to keep totals of archived months.
+    """
+
+    KEY_WINDOW = timedelta(days=7)
+    DELETE_BATCH_ROWS = 10000
+
+    def __init__(
+        self,
+        engine,
+        table,
+        enabled: bool = False,
+        months_ahead: int = 3,
+        retention_months: int = 0,
+        archive_dir: Optional[str] = "message_log_archive",
+        interval: float = 3600.0,
+        on_retire: Optional[List[Callable]] = None,
+    ):
+        self.engine = engine
+        self.table = table
+        self.enabled = enabled and engine.dialect.name == "postgresql"
+        self.months_ahead = months_ahead
+        self.retention_months = retention_months
+        self.archive_dir = archive_dir
+        self.interval = interval
+        self.on_retire = on_retire or []
+        self.partitioned = False
+        # Months from the current one on are never dropped, so once seen they need no check
+        self._months = set()
+        self._name_pattern = re.compile(rf"^{re.escape(table.name)}_(\d{{4}})_(\d{{2}})$")
+        self._task: Optional[asyncio.Task] = None
+        self._stats = {"runs": 0, "failed_runs": 0, "created": 0, "archived": 0, "archived_rows": 0,
+                       "last_run": None}
+
+    def partition_name(self, start: datetime) -> str:
+        return f"{self.table.name}_{start.year:04d}_{start.month:02d}"
+
+    # Schema
+    def prepare(self) -> None:
+        """Create message_logs partitioned if it does not exist yet; call before create_all."""
+        if self.engine.dialect.name != "postgresql":
+            return
+        with self.engine.begin() as connection:
+            exists = connection.execute(text("SELECT to_regclass(:name)"), {"name": self.table.name}).scalar()
+            if exists is None and self.enabled:
+                self._create_partitioned(connection)
+            self.partitioned = self._is_partitioned(connection)
+        if self.partitioned:
+            self.ensure_partitions()
+        elif self.enabled:
+            logger.warning("%s is not partitioned; run convert() with the app stopped", self.table.name)
+
+    def _is_partitioned(self, connection) -> bool:
+        return connection.execute(text(
+            "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:name))"
+        ), {"name": self.table.name}).scalar()
+
+    def _create_partitioned(self, connection) -> None:
+        dialect = connection.dialect
+        definitions = []
+        for column in self.table.columns:
+            definition = str(CreateColumn(column).compile(dialect=dialect))
+            if column.name == "created_at":
+                # Rows are routed by it, so it can never be missing
+                definition += " NOT NULL DEFAULT now()"
+            definitions.append(definition)
+        # The partition key has to be part of every unique constraint
+        definitions.append("PRIMARY KEY (id, created_at)")
+        for constraint in self.table.foreign_key_constraints:
+            definitions.append("FOREIGN KEY ({}) REFERENCES {} ({})".format(
+                ", ".join(column.name for column in constraint.columns),
+                constraint.referred_table.name,
+                ", ".join(element.column.name for element in constraint.elements),
+            ))
+        connection.exec_driver_sql(
+            f"CREATE TABLE {self.table.name} (\n    " + ",\n    ".join(definitions) + "\n) PARTITION BY RANGE (created_at)"
+        )
+        # Indexes on the parent are created on every partition, present and future
+        for index in self.table.indexes:
+            if not index.unique:
+                connection.exec_driver_sql(str(CreateIndex(index).compile(dialect=dialect)))
+        logger.info("Created %s partitioned by month", self.table.name)
+
+    def _create_partition(self, connection, start: datetime) -> bool:
+        name = self.partition_name(start)
+        if connection.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar() is not None:
+            return False
+        connection.exec_driver_sql(
+            f"CREATE TABLE {name} PARTITION OF {self.table.name} "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{add_months(start, 1).isoformat()}')"
+        )
+        logger.info("Created partition %s", name)
+        return True
+
+    def ensure_partitions(self, now: Optional[datetime] = None) -> int:
+        """Create partitions from the current month to ``months_ahead`` months ahead."""
+        if not self.partitioned:
+            return 0
+        current = month_start(now or datetime.utcnow())
+        created = 0
+        with self.engine.begin() as connection:
+            for offset in range(self.months_ahead + 1):
+                created += self._create_partition(connection, add_months(current, offset))
+        self._months.update(add_months(current, offset) for offset in range(self.months_ahead + 1))
+        self._stats["created"] += created
+        return created
+
+    def _ensure_months(self, connection, rows: List[dict]) -> None:
+        current = month_start(datetime.utcnow())
+        months = {month_start(row["created_at"]) for row in rows if row.get("created_at") is not None}
+        for start in sorted(months - self._months):
+            try:
+                # A savepoint: if another worker created it first, only this statement is undone
+                with connection.begin_nested():
+                    created = self._create_partition(connection, start)
+            except DBAPIError:
+                created = False
+            if created:
+                self._stats["created"] += 1
+            elif start >= current:
+                # Only cached once it was there before this transaction, which may still roll back
+                self._months.add(start)
+
+    def convert(self) -> None:
+        """Move an existing unpartitioned message_logs into a partitioned one.
+
+        Run with the app stopped. Rows are copied month by month; the old table
+        is kept as message_logs_unpartitioned for the operator to drop.
+        """
+        if self.engine.dialect.name != "postgresql":
+            raise RuntimeError("Partitioning needs PostgreSQL")
+        name = self.table.name
+        old = f"{name}_unpartitioned"
+        with self.engine.begin() as connection:
+            if self._is_partitioned(connection):
+                return
+            connection.exec_driver_sql(f"UPDATE {name} SET created_at = now() WHERE created_at IS NULL")
+            oldest, newest = connection.execute(text(f"SELECT min(created_at), max(created_at) FROM {name}")).first()
+            # Index names are per schema, so the old ones make way for the new table's
+            connection.exec_driver_sql(f"ALTER TABLE {name} RENAME TO {old}")
+            for index in [f"{name}_pkey", *(index.name for index in self.table.indexes)]:
+                # ix_message_logs_bot_created_id -> ix_message_logs_unpartitioned_bot_created_id
+                renamed = index.replace(name, old, 1) if name in index else f"{old}_{index}"
+                connection.exec_driver_sql(f"ALTER INDEX IF EXISTS {index} RENAME TO {renamed}")
+
+            self._create_partitioned(connection)
+            now = datetime.utcnow()
+            first = month_start(oldest or now)
+            last = add_months(month_start(max(newest or now, now)), self.months_ahead)
+            columns = ", ".join(column.name for column in self.table.columns)
+            start = first
+            while start <= last:
+                end = add_months(start, 1)
+                self._create_partition(connection, start)
+                connection.execute(text(
+                    f"INSERT INTO {name} ({columns}) SELECT {columns} FROM {old} "
+                    "WHERE created_at >= :start AND created_at < :end"
+                ), {"start": start, "end": end})
+                start = end
+            connection.exec_driver_sql(
+                f"SELECT setval(pg_get_serial_sequence('{name}', 'id'), (SELECT coalesce(max(id), 0) + 1 FROM {old}), false)"
+            )
+            connection.execute(postgresql.insert(message_log_keys).from_select(
+                ["bot_id", "platform", "message_id", "created_at"],
+                select(self.table.c.bot_id, self.table.c.platform, self.table.c.message_id, self.table.c.created_at)
+                .where(self.table.c.bot_id.is_not(None), self.table.c.message_id.is_not(None),
+                       self.table.c.created_at >= now - self.KEY_WINDOW)
+            ).on_conflict_do_nothing())
+        self.partitioned = True
+        logger.info("Converted %s to monthly partitions; %s can be dropped", name, old)
+
+    # Deduplication on partitioned tables
+    def claim(self, connection, rows: List[dict]) -> List[dict]:
+        """The rows of a log batch that are not redeliveries; the writer inserts only these."""
+        if not self.partitioned:
+            return rows
+        self._ensure_months(connection, rows)
+        keyed = [row for row in rows if row.get("bot_id") is not None and row.get("message_id") is not None]
+        if not keyed:
+            return rows
+        statement = postgresql.insert(message_log_keys).on_conflict_do_nothing().returning(
+            message_log_keys.c.bot_id, message_log_keys.c.platform, message_log_keys.c.message_id
+        )
+        claimed = {tuple(key) for key in connection.execute(statement, [
+            {"bot_id": row["bot_id"], "platform": row["platform"], "message_id": row["message_id"],
+             "created_at": row["created_at"]}
+            for row in keyed
+        ])}
+        kept = []
+        for row in rows:
+            key = (row.get("bot_id"), row.get("platform"), row.get("message_id"))
+            if key[0] is None or key[2] is None:
+                kept.append(row)
+            elif key in claimed:
+                # A key repeated within one batch is claimed once
+                claimed.discard(key)
+                kept.append(row)
+        return kept
+
+    # Retention
+    def _archive(
+        self, connection, source, start: datetime, end: Optional[datetime], name: str, max_id: Optional[int] = None
+    ) -> int:
+        if not self.archive_dir:
+            return 0
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = os.path.join(self.archive_dir, f"{name}.csv.gz")
+        retry = 0
+        while os.path.exists(path):
+            retry += 1
+            path = os.path.join(self.archive_dir, f"{name}.{retry}.csv.gz")
+        columns = [column.name for column in self.table.columns]
+        statement = select(*(source.c[column] for column in columns)).order_by(source.c.created_at, source.c.id)
+        if end is not None:
+            statement = statement.where(source.c.created_at >= start, source.c.created_at < end)
+        if max_id is not None:
+            statement = statement.where(source.c.id <= max_id)
+        count = 0
+        with open(path + ".tmp", "wb") as raw:
+            with io.TextIOWrapper(gzip.GzipFile(fileobj=raw, mode="wb"), encoding="utf-8", newline="") as sink:
+                writer = csv.writer(sink)
+                writer.writerow(columns)
+                result = connection.execute(statement.execution_options(stream_results=True, yield_per=1000))
+                for rows in result.partitions():
+                    writer.writerows([_csv_value(value) for value in row] for row in rows)
+                    count += len(rows)
+            raw.flush()
+            # The rows are dropped next, so the archive has to be on disk first
+            os.fsync(raw.fileno())
+        if count:
+            os.replace(path + ".tmp", path)
+        else:
+            os.remove(path + ".tmp")
+        return count
+
+    def _expired_partitions(self, connection, cutoff: datetime) -> List[Tuple[str, datetime, bool]]:
+        """(name, month, attached) of partitions and leftover detached ones ending before ``cutoff``."""
+        rows = connection.execute(text(
+            "SELECT c.relname, c.relispartition FROM pg_class c "
+            "WHERE c.relkind = 'r' AND pg_table_is_visible(c.oid) AND c.relname LIKE :prefix"
+        ), {"prefix": self.table.name.replace("_", r"\_") + r"\_%"}).all()
+        expired = []
+        for name, attached in rows:
+            match = self._name_pattern.match(name)
+            if match is None:
+                continue
+            start = datetime(int(match.group(1)), int(match.group(2)), 1)
+            if add_months(start, 1) <= cutoff:
+                expired.append((name, start, attached))
+        return sorted(expired, key=lambda item: item[1])
+
+    def apply_retention(self, now: Optional[datetime] = None) -> int:
+        """Archive and remove whole months older than ``retention_months``; returns months removed."""
+        if not self.retention_months:
+            return 0
+        cutoff = add_months(month_start(now or datetime.utcnow()), -self.retention_months)
+        if self.partitioned:
+            return self._retire_partitions(cutoff)
+        return self._retire_rows(cutoff)
+
+    def _retire_partitions(self, cutoff: datetime) -> int:
+        with self.engine.connect() as connection:
+            expired = self._expired_partitions(connection, cutoff)
+        for name, start, attached in expired:
+            if attached:
+                # Only a brief lock on the parent; no rows move
+                with self.engine.begin() as connection:
+                    connection.exec_driver_sql(f"ALTER TABLE {self.table.name} DETACH PARTITION {name}")
+            partition = Table(name, MetaData(), *(Column(column.name, column.type) for column in self.table.columns))
+            with self.engine.connect() as connection:
+                archived = self._archive(connection, partition, start, None, name)
+            with self.engine.begin() as connection:
+                for hook in self.on_retire:
+                    hook(connection, select(partition))
+                connection.exec_driver_sql(f"DROP TABLE {name}")
+            self._stats["archived"] += 1
+            self._stats["archived_rows"] += archived
+            logger.info("Archived and dropped partition %s (%d rows)", name, archived)
+        return len(expired)
+
+    def _retire_rows(self, cutoff: datetime) -> int:
+        months = 0
+        while True:
+            # Jumps straight to the next month that has rows
+            with self.engine.connect() as connection:
+                oldest = connection.execute(
+                    select(func.min(self.table.c.created_at)).where(self.table.c.created_at < cutoff)
+                ).scalar()
+            if oldest is None:
+                return months
+            start = month_start(oldest)
+            end = add_months(start, 1)
+            name = self.partition_name(start)
+            in_month = (self.table.c.created_at >= start, self.table.c.created_at < end)
+            with self.engine.connect() as connection:
+                # Rows back-dated into the month after this point wait for the next run
+                max_id = connection.execute(select(func.max(self.table.c.id)).where(*in_month)).scalar()
+                archived = self._archive(connection, self.table, start, end, name, max_id)
+            while True:
+                with self.engine.begin() as connection:
+                    batch = select(self.table.c.id).where(*in_month, self.table.c.id <= max_id)
+                    batch = batch.order_by(self.table.c.id).limit(self.DELETE_BATCH_ROWS)
+                    for hook in self.on_retire:
+                        hook(connection, select(self.table).where(self.table.c.id.in_(batch)))
+                    deleted = connection.execute(delete(self.table).where(self.table.c.id.in_(batch))).rowcount
+                if deleted < self.DELETE_BATCH_ROWS:
+                    break
+            self._stats["archived"] += 1
+            self._stats["archived_rows"] += archived
+            logger.info("Archived and deleted message logs of %s (%d rows)", name, archived)
+            months += 1
+
+    # Maintenance
+    def run_maintenance(self, now: Optional[datetime] = None) -> None:
+        now = now or datetime.utcnow()
+        with self.engine.connect() as lock:
+            if self.engine.dialect.name == "postgresql":
+                if not lock.execute(text("SELECT pg_try_advisory_lock(:id)"), {"id": ADVISORY_LOCK_ID}).scalar():
+                    return
+            try:
+                self.ensure_partitions(now)
+                self.apply_retention(now)
+                if self.partitioned:
+                    with self.engine.begin() as connection:
+                        connection.execute(delete(message_log_keys).where(message_log_keys.c.created_at < now - self.KEY_WINDOW))
+            finally:
+                if self.engine.dialect.name == "postgresql":
+                    lock.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": ADVISORY_LOCK_ID})
+                    lock.commit()
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.run_maintenance)
+                self._stats["runs"] += 1
+                self._stats["last_run"] = datetime.utcnow().isoformat()
+            except Exception:
+                logger.exception("Message log maintenance failed")
+                self._stats["failed_runs"] += 1
+            await asyncio.sleep(self.interval)
+
+    def metrics(self) -> dict:
+        return {
+            **self._stats,
+            "partitioned": self.partitioned,
+            "months_ahead": self.months_ahead,
+            "retention_months": self.retention_months,
+            "archive_dir": self.archive_dir,
+        }
+
+
+def create_message_log_partitions(engine, table, on_retire: Optional[List[Callable]] = None) -> MessageLogPartitions:
+    return MessageLogPartitions(
+        engine,
+        table,
+        enabled=os.getenv("MESSAGE_LOG_PARTITIONING", "0") == "1",
+        months_ahead=int(os.getenv("MESSAGE_LOG_PARTITIONS_AHEAD", "3")),
+        retention_months=int(os.getenv("MESSAGE_LOG_RETENTION_MONTHS", "0")),
+        archive_dir=os.getenv("MESSAGE_LOG_ARCHIVE_DIR", "message_log_archive") or None,
+        interval=float(os.getenv("MESSAGE_LOG_MAINTENANCE_SECONDS", "3600")),
+        on_retire=on_retire,
+    )
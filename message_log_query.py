@@ -0,0 +1,89 @@
+"""
+Message log queries
+Фильтры и keyset-пагинация по (created_at, id) для истории сообщений
+"""
+
+import base64
+import json
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable, Optional, Tuple
+
+from sqlalchemy import and_, or_, select, tuple_, union_all
+
+
+@dataclass
+class MessageLogFilters:
+    bot_id: Optional[int] = None
+    platform: Optional[str] = None
+    sender_id: Optional[str] = None
+    since: Optional[datetime] = None
+    until: Optional[datetime] = None
+
+
+def encode_cursor(created_at: Optional[datetime], log_id: int) -> str:
+    raw = json.dumps([created_at.isoformat() if created_at else None, log_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Optional[Tuple[Optional[datetime], int]]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, log_id = json.loads(raw)
+        return datetime.fromisoformat(created_at) if created_at is not None else None, int(log_id)
+    except (ValueError, TypeError):
+        return None
+
+
+def apply_filters(query, model, filters: MessageLogFilters):
+    if filters.bot_id is not None:
+        query = query.filter(model.bot_id == filters.bot_id)
+    if filters.platform:
+        query = query.filter(model.platform == filters.platform)
+    if filters.sender_id:
+        query = query.filter(model.sender_id == filters.sender_id)
+    if filters.since:
+        query = query.filter(model.created_at >= filters.since)
+    if filters.until:
+        query = query.filter(model.created_at < filters.until)
+    return query
+
+
+def newest_first(query, model, after: Optional[Tuple[Optional[datetime], int]] = None):
+    """Order by (created_at, id) descending, continuing strictly after ``after``.
+
+    Rows without created_at come first, where PostgreSQL's DESC index keeps
+    them. Within one bot the row-value comparison lets the (bot_id, created_at
+    DESC, id DESC) index serve each page as a single range scan; pages across
+    bots go through ``newest_per_bot``.
+    """
+    if after is not None:
+        created_at, log_id = after
+        if created_at is None:
+            query = query.filter(or_(and_(model.created_at.is_(None), model.id < log_id), model.created_at.isnot(None)))
+        else:
+            query = query.filter(tuple_(model.created_at, model.id) < tuple_(created_at, log_id))
+    return query.order_by(model.created_at.desc().nulls_first(), model.id.desc())
+
+
+def newest_per_bot(
+    model,
+    bot_ids: Iterable[int],
+    limit: int,
+    filters: Optional[MessageLogFilters] = None,
+    after: Optional[Tuple[Optional[datetime], int]] = None,
+):
+    """Ids of the newest ``limit`` rows of each of ``bot_ids``, for ``model.id.in_(...)``.
+
+    The index orders rows within a bot only, so a page across a user's bots
+    is a merge: one short range scan per bot, UNION ALL, and the caller
+    orders and cuts the union with ``newest_first``. ``bot_ids`` must not be empty.
+    """
+    branches = []
+    for bot_id in bot_ids:
+        branch = select(model.id).where(model.bot_id == bot_id)
+        if filters is not None:
+            branch = apply_filters(branch, model, filters)
+        branch = newest_first(branch, model, after).limit(limit).subquery()
+        branches.append(select(branch.c.id))
+    return union_all(*branches)
@@ -0,0 +1,171 @@
+"""
+Buffered message log writer
+Копит записи MessageLog в памяти и пишет их в базу пачками
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime
+from typing import Callable, Deque, List, Optional
+
+from sqlalchemy import insert
+from sqlalchemy.dialects import postgresql, sqlite
+
+logger = logging.getLogger(__name__)
+
+
+class MessageLogWriter:
+    """Collects message log records and inserts them with one executemany per batch.
+
+    A batch is flushed when ``batch_size`` records are buffered or every
+    ``flush_interval`` seconds, whichever comes first. ``after_write`` hooks run
+    on the same connection and transaction as the insert (e.g. rollup updates).
+    ``before_write`` runs there first and returns the rows to insert.
+
+    Rows that collide with a unique index (a redelivered webhook already
+    logged) are skipped; hooks only see the rows actually inserted.
+    """
+
+    def __init__(
+        self,
+        engine,
+        table,
+        batch_size: int = 500,
+        flush_interval: float = 1.0,
+        max_buffer: int = 50000,
+        before_write: Optional[Callable] = None,
+        after_write: Optional[List[Callable]] = None,
+    ):
+        self.engine = engine
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.before_write = before_write
+        self.after_write = after_write or []
+        self._buffer: Deque[dict] = deque(maxlen=max_buffer)
+        self._wake = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self._stats = {
+            "written": 0,
+            "dropped": 0,
+            "flushes": 0,
+            "failed_flushes": 0,
+            "last_batch_size": 0,
+            "duplicates": 0,
+        }
+        self._flush_ms_total = 0.0
+        self._flush_ms_last = 0.0
+        self._flush_ms_max = 0.0
+
+    def add(self, record) -> None:
+        row = record.dict() if hasattr(record, "dict") else dict(record)
+        row.setdefault("created_at", datetime.utcnow())
+        if len(self._buffer) == self.max_buffer:
+            self._stats["dropped"] += 1
+        self._buffer.append(row)
+        if len(self._buffer) >= self.batch_size:
+            self._wake.set()
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._stopping = True
+            self._wake.set()
+            await self._task
+            self._task = None
+        while self._buffer:
+            if not await self.flush():
+                logger.error("Dropping %d message logs on shutdown", len(self._buffer))
+                break
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def flush(self) -> bool:
+        async with self._lock:
+            if not self._buffer:
+                return True
+            batch = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+            started = time.perf_counter()
+            try:
+                written = await asyncio.to_thread(self._write, batch)
+            except Exception:
+                logger.exception("Failed to flush %d message logs", len(batch))
+                self._stats["failed_flushes"] += 1
+                # Put the batch back in front; the newest records give way if the buffer overflows
+                overflow = max(len(self._buffer) + len(batch) - self.max_buffer, 0)
+                self._stats["dropped"] += overflow
+                self._buffer.extendleft(reversed(batch))
+                return False
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self._stats["flushes"] += 1
+            self._stats["written"] += written
+            self._stats["last_batch_size"] = len(batch)
+            self._flush_ms_last = elapsed_ms
+            self._flush_ms_max = max(self._flush_ms_max, elapsed_ms)
+            self._flush_ms_total += elapsed_ms
+            if len(self._buffer) >= self.batch_size:
+                self._wake.set()
+            return True
+
+    def _insert_statement(self, connection, columns):
+        dialect = connection.dialect
+        if dialect.name not in ("postgresql", "sqlite"):
+            return insert(self.table), False
+        # No conflict target: any unique violation is skipped, and the statement
+        # stays valid if the unique index could not be built on an old database
+        statement = (postgresql.insert if dialect.name == "postgresql" else sqlite.insert)(self.table).on_conflict_do_nothing()
+        if not dialect.insert_executemany_returning:
+            return statement, False
+        return statement.returning(*(self.table.c[name] for name in columns)), True
+
+    def _write(self, rows: List[dict]) -> int:
+        with self.engine.begin() as connection:
+            inserted = self.before_write(connection, rows) if self.before_write else rows
+            if inserted:
+                statement, returning = self._insert_statement(connection, inserted[0].keys())
+                result = connection.execute(statement, inserted)
+                if returning:
+                    inserted = [dict(row._mapping) for row in result]
+            for hook in self.after_write:
+                hook(connection, inserted)
+        self._stats["duplicates"] += len(rows) - len(inserted)
+        return len(inserted)
+
+    def metrics(self) -> dict:
+        flushes = self._stats["flushes"]
+        return {
+            **self._stats,
+            "queue_depth": len(self._buffer),
+            "last_flush_ms": round(self._flush_ms_last, 2),
+            "max_flush_ms": round(self._flush_ms_max, 2),
+            "avg_flush_ms": round(self._flush_ms_total / flushes, 2) if flushes else 0,
+        }
+
+
+def create_message_log_writer(
+    engine, table, before_write: Optional[Callable] = None, after_write: Optional[List[Callable]] = None
+) -> MessageLogWriter:
+    return MessageLogWriter(
+        engine,
+        table,
+        batch_size=int(os.getenv("MESSAGE_LOG_BATCH_SIZE", "500")),
+        flush_interval=float(os.getenv("MESSAGE_LOG_FLUSH_INTERVAL", "1.0")),
+        max_buffer=int(os.getenv("MESSAGE_LOG_MAX_BUFFER", "50000")),
+        before_write=before_write,
+        after_write=after_write,
+    )
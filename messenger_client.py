@@ -0,0 +1,327 @@
+"""
+Outbound messenger client
+Отправка ответов ботов в Telegram, WhatsApp и Instagram: пул соединений, лимиты на бота и чат, Retry-After
+"""
+
+import asyncio
+import importlib.util
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Set, Tuple
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# HTTP/2 multiplexes a bot's sends over one connection per host; it needs the optional h2 package
+HTTP2 = importlib.util.find_spec("h2") is not None
+
+DEFAULT_BASE_URLS = {
+    "telegram": "https://api.telegram.org",
+    "whatsapp": "https://graph.facebook.com/v19.0",
+    "instagram": "https://graph.facebook.com/v19.0",
+}
+
+
+@dataclass
+class PlatformLimits:
+    bot_rate: float   # messages per second per bot
+    bot_burst: int
+    chat_rate: float  # messages per second per chat
+    chat_burst: int
+    max_text: int
+
+
+# Published platform limits, slightly under the documented ceilings
+DEFAULT_LIMITS = {
+    "telegram": PlatformLimits(bot_rate=25, bot_burst=25, chat_rate=1, chat_burst=3, max_text=4096),
+    "whatsapp": PlatformLimits(bot_rate=70, bot_burst=70, chat_rate=1 / 6, chat_burst=10, max_text=4096),
+    "instagram": PlatformLimits(bot_rate=90, bot_burst=90, chat_rate=1, chat_burst=5, max_text=1000),
+}
+
+
+class TokenBucket:
+    """Reservation based: every caller takes a token at once and is told how long to wait for it.
+
+    Waiters never poll or hold a lock, and they are served in arrival order.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self) -> float:
+        self._refill(time.monotonic())
+        self._tokens -= 1
+        return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def full(self) -> bool:
+        self._refill(time.monotonic())
+        return self._tokens >= self.burst
+
+
+class _Pending:
+    __slots__ = ("texts", "size")
+
+    def __init__(self, text: str):
+        self.texts = [text]
+        self.size = len(text)
+
+
+class MessengerClient:
+    """Shared sender for bot replies.
+
+    ``dispatch`` schedules a send and returns immediately, so a slow or rate
+    limited bot never holds up the caller or other bots. Each send waits for
+    its chat's token bucket, then its bot's, then any Retry-After pause of
+    that bot. Replies that pile up for one chat while it waits are coalesced
+    into a single message, up to the platform's text limit. 429 responses
+    pause only the bot that got them; 5xx and network errors are retried with
+    backoff.
+    """
+
+    SEPARATOR = "\n\n"
+
+    def __init__(
+        self,
+        base_urls: Optional[Dict[str, str]] = None,
+        limits: Optional[Dict[str, PlatformLimits]] = None,
+        max_pending: int = 10000,
+        max_retries: int = 3,
+        max_connections: int = 20,
+        timeout: float = 10.0,
+        coalesce: bool = True,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.base_urls = {**DEFAULT_BASE_URLS, **(base_urls or {})}
+        self.limits = {**DEFAULT_LIMITS, **(limits or {})}
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.coalesce = coalesce
+        # Tests point this at a fake messenger (httpx.ASGITransport / MockTransport)
+        self.transport = transport
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._bot_buckets: Dict[Tuple[str, int], TokenBucket] = {}
+        self._chat_buckets: Dict[Tuple[str, int, str], TokenBucket] = {}
+        self._paused_until: Dict[Tuple[str, int], float] = {}
+        self._pending: Dict[Tuple[str, int, str], _Pending] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._stats = {"sent": 0, "coalesced": 0, "retries": 0, "rate_limited": 0, "failed": 0, "dropped": 0}
+
+    # Connections: one pooled client per API host, shared by every bot on it
+    def _client(self, base_url: str) -> httpx.AsyncClient:
+        url = httpx.URL(base_url)
+        key = f"{url.scheme}://{url.host}:{url.port}"
+        client = self._clients.get(key)
+        if client is None:
+            client = self._clients[key] = httpx.AsyncClient(
+                http2=HTTP2 and self.transport is None,
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+                timeout=self.timeout,
+                transport=self.transport,
+            )
+        return client
+
+    def _request(self, platform: str, token: str, chat_id: str, text: str, sender_id: Optional[str]):
+        base_url = self.base_urls[platform].rstrip("/")
+        if platform == "telegram":
+            return base_url, f"{base_url}/bot{token}/sendMessage", {}, {"chat_id": chat_id, "text": text}
+        headers = {"Authorization": f"Bearer {token}"}
+        if platform == "whatsapp":
+            if not sender_id:
+                raise ValueError("WhatsApp bots need phone_number_id in their config")
+            return base_url, f"{base_url}/{sender_id}/messages", headers, {
+                "messaging_product": "whatsapp",
+                "recipient_type": "individual",
+                "to": chat_id,
+                "type": "text",
+                "text": {"body": text},
+            }
+        if platform == "instagram":
+            return base_url, f"{base_url}/me/messages", headers, {"recipient": {"id": chat_id}, "message": {"text": text}}
+        raise ValueError(f"Unknown platform: {platform}")
+
+    # Rate limiting
+    def _bucket(self, buckets: dict, key, rate: float, burst: int) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= self.max_pending:
+                # Refilled buckets carry no state worth keeping
+                for stale in [name for name, value in buckets.items() if value.full()]:
+                    del buckets[stale]
+            bucket = buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    async def _wait_for_bot(self, platform: str, bot_id: int, limits: PlatformLimits) -> None:
+        await asyncio.sleep(self._bucket(self._bot_buckets, (platform, bot_id), limits.bot_rate, limits.bot_burst).reserve())
+        while True:
+            delay = self._paused_until.get((platform, bot_id), 0.0) - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    def pause(self, platform: str, bot_id: int, seconds: float) -> None:
+        key = (platform, bot_id)
+        self._paused_until[key] = max(self._paused_until.get(key, 0.0), time.monotonic() + seconds)
+
+    # Sending
+    def dispatch(self, platform: str, bot_id: int, token: str, chat_id: str, text: str,
+                 sender_id: Optional[str] = None) -> bool:
+        """Schedule a message; False when too many sends are already pending."""
+        if len(self._tasks) >= self.max_pending:
+            self._stats["dropped"] += 1
+            logger.warning("Outbound queue full, dropping reply of bot %s", bot_id)
+            return False
+        task = asyncio.create_task(self.send(platform, bot_id, token, str(chat_id), text, sender_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def send(self, platform: str, bot_id: int, token: str, chat_id: str, text: str,
+                   sender_id: Optional[str] = None) -> bool:
+        limits = self.limits[platform]
+        text = text[:limits.max_text]
+        key = (platform, bot_id, chat_id)
+
+        pending = self._pending.get(key)
+        if (self.coalesce and pending is not None
+                and pending.size + len(self.SEPARATOR) + len(text) <= limits.max_text):
+            # A send to this chat is still waiting for its turn; ride along with it
+            pending.texts.append(text)
+            pending.size += len(self.SEPARATOR) + len(text)
+            self._stats["coalesced"] += 1
+            return True
+
+        pending = _Pending(text)
+        self._pending[key] = pending
+        try:
+            await asyncio.sleep(self._bucket(self._chat_buckets, key, limits.chat_rate, limits.chat_burst).reserve())
+        finally:
+            if self._pending.get(key) is pending:
+                del self._pending[key]
+        return await self._deliver(platform, bot_id, token, chat_id, self.SEPARATOR.join(pending.texts), sender_id, limits)
+
+    async def _deliver(self, platform: str, bot_id: int, token: str, chat_id: str, text: str,
+                       sender_id: Optional[str], limits: PlatformLimits) -> bool:
+        try:
+            base_url, url, headers, payload = self._request(platform, token, chat_id, text, sender_id)
+        except ValueError as error:
+            self._stats["failed"] += 1
+            logger.warning("Cannot send reply of bot %s: %s", bot_id, error)
+            return False
+        client = self._client(base_url)
+
+        for attempt in range(self.max_retries + 1):
+            await self._wait_for_bot(platform, bot_id, limits)
+            try:
+                response = await client.post(url, json=payload, headers=headers)
+            except httpx.HTTPError as error:
+                retry_after, reason = 2 ** attempt, repr(error)
+            else:
+                if response.status_code < 400:
+                    self._stats["sent"] += 1
+                    return True
+                if response.status_code == 429:
+                    self._stats["rate_limited"] += 1
+                    retry_after = self._retry_after(response, 2 ** attempt)
+                    # Flood control applies to the whole bot; its other chats wait too, other bots do not
+                    self.pause(platform, bot_id, retry_after)
+                elif response.status_code >= 500:
+                    retry_after = 2 ** attempt
+                else:
+                    self._stats["failed"] += 1
+                    logger.warning("%s rejected reply of bot %s: %s %s", platform, bot_id,
+                                   response.status_code, response.text[:200])
+                    return False
+                reason = f"HTTP {response.status_code}"
+            if attempt == self.max_retries:
+                break
+            self._stats["retries"] += 1
+            logger.info("Retrying reply of bot %s in %.1fs (%s)", bot_id, retry_after, reason)
+            if not self._paused_until.get((platform, bot_id), 0.0) > time.monotonic():
+                await asyncio.sleep(retry_after)
+
+        self._stats["failed"] += 1
+        logger.warning("Giving up on reply of bot %s after %d attempts", bot_id, self.max_retries + 1)
+        return False
+
+    @staticmethod
+    def _retry_after(response: httpx.Response, default: float) -> float:
+        header = response.headers.get("retry-after")
+        if header is not None:
+            try:
+                return float(header)
+            except ValueError:
+                pass
+        # Telegram puts it in the body: {"parameters": {"retry_after": 5}}
+        try:
+            return float(response.json()["parameters"]["retry_after"])
+        except (ValueError, KeyError, TypeError):
+            return default
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        if self._tasks:
+            _, unfinished = await asyncio.wait(list(self._tasks), timeout=timeout)
+            for task in unfinished:
+                task.cancel()
+            if unfinished:
+                logger.warning("Dropping %d unsent replies on shutdown", len(unfinished))
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients = {}
+
+    def metrics(self) -> dict:
+        now = time.monotonic()
+        return {
+            **self._stats,
+            "pending": len(self._tasks),
+            "paused_bots": sum(1 for until in self._paused_until.values() if until > now),
+            "http2": HTTP2 and self.transport is None,
+            "hosts": len(self._clients),
+        }
+
+
+def _limits_from_env() -> Dict[str, PlatformLimits]:
+    """Platform limits as this process's share of them.
+
+    Buckets live in each uvicorn worker and any worker may answer any bot or
+    chat, so every one of the WEB_CONCURRENCY workers gets an equal slice.
+    """
+    workers = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+    limits = {}
+    for platform, default in DEFAULT_LIMITS.items():
+        prefix = platform.upper()
+        limits[platform] = PlatformLimits(
+            bot_rate=float(os.getenv(f"{prefix}_BOT_RATE", default.bot_rate)) / workers,
+            bot_burst=max(1, int(os.getenv(f"{prefix}_BOT_BURST", default.bot_burst)) // workers),
+            chat_rate=float(os.getenv(f"{prefix}_CHAT_RATE", default.chat_rate)) / workers,
+            chat_burst=max(1, int(os.getenv(f"{prefix}_CHAT_BURST", default.chat_burst)) // workers),
+            max_text=default.max_text,
+        )
+    return limits
+
+
+def create_messenger_client() -> MessengerClient:
+    base_urls: Dict[str, str] = {}
+    for platform in DEFAULT_BASE_URLS:
+        url = os.getenv(f"{platform.upper()}_API_URL")
+        if url:
+            base_urls[platform] = url
+    return MessengerClient(
+        base_urls=base_urls,
+        limits=_limits_from_env(),
+        max_pending=int(os.getenv("MESSENGER_MAX_PENDING", "10000")),
+        max_retries=int(os.getenv("MESSENGER_MAX_RETRIES", "3")),
+        max_connections=int(os.getenv("MESSENGER_MAX_CONNECTIONS", "20")),
+        coalesce=os.getenv("MESSENGER_COALESCE", "1") == "1",
+    )
@@ -0,0 +1,135 @@
+"""
+Prometheus metrics
+HTTP-запросы, время в БД и обработка вебхуков в текстовом формате Prometheus (/metrics)
+"""
+
+import os
+import time
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram
+from prometheus_client import generate_latest, multiprocess
+from sqlalchemy import event
+
+# With PROMETHEUS_MULTIPROC_DIR set every uvicorn worker writes its samples
+# to files there and /metrics aggregates them, whichever worker serves it.
+MULTIPROCESS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REQUESTS = Counter("http_requests_total", "HTTP requests", ["method", "route", "status"])
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency", ["method", "route", "status"], buckets=LATENCY_BUCKETS
+)
+IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests being served", multiprocess_mode="livesum")
+REQUEST_DB_TIME = Histogram(
+    "http_request_db_seconds", "Time spent in database queries per request", ["route"], buckets=LATENCY_BUCKETS
+)
+REQUEST_DB_QUERIES = Counter("http_request_db_queries_total", "Database queries issued by requests", ["route"])
+WEBHOOK_LATENCY = Histogram(
+    "webhook_processing_seconds", "Webhook update processing time", ["platform"], buckets=LATENCY_BUCKETS
+)
+RESPONSE_CACHE_LOOKUPS = Counter("response_cache_lookups_total", "Auto-response cache lookups", ["result"])
+
+# [seconds, queries] of the request being served; None outside requests
+_request_db: ContextVar[Optional[list]] = ContextVar("request_db", default=None)
+
+# Label children are resolved once per label combination, not per request
+_request_children: Dict[Tuple[str, str, int], tuple] = {}
+_webhook_children: Dict[str, object] = {}
+
+
+def _children_for(method: str, route: str, status: int) -> tuple:
+    key = (method, route, status)
+    children = _request_children.get(key)
+    if children is None:
+        children = _request_children[key] = (
+            REQUESTS.labels(method, route, str(status)),
+            REQUEST_LATENCY.labels(method, route, str(status)),
+            REQUEST_DB_TIME.labels(route),
+            REQUEST_DB_QUERIES.labels(route),
+        )
+    return children
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware; routes are labelled by template (``/bots/{bot_id}``), never by raw path."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        db = [0.0, 0]
+        token = _request_db.set(db)
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            IN_FLIGHT.dec()
+            _request_db.reset(token)
+            route = scope.get("route")
+            requests, latency, db_time, db_queries = _children_for(
+                scope["method"], route.path if route is not None else "unmatched", status
+            )
+            requests.inc()
+            latency.observe(elapsed)
+            db_time.observe(db[0])
+            if db[1]:
+                db_queries.inc(db[1])
+
+
+def instrument_engine(engine) -> None:
+    """Charge query time on ``engine`` to the request that issued it."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(connection, cursor, statement, parameters, context, executemany):
+        if _request_db.get() is not None:
+            connection.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(connection, cursor, statement, parameters, context, executemany):
+        db = _request_db.get()
+        started = connection.info.get("query_started")
+        if db is not None and started:
+            db[0] += time.perf_counter() - started.pop()
+            db[1] += 1
+
+
+def observe_webhook(platform: str, seconds: float) -> None:
+    child = _webhook_children.get(platform)
+    if child is None:
+        child = _webhook_children[platform] = WEBHOOK_LATENCY.labels(platform)
+    child.observe(seconds)
+
+
+def observe_response_cache(hit: bool) -> None:
+    RESPONSE_CACHE_LOOKUPS.labels("hit" if hit else "miss").inc()
+
+
+def render() -> Tuple[bytes, str]:
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def shutdown() -> None:
+    # Drops this worker's live gauges from the aggregate
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
@@ -0,0 +1,73 @@
+"""
+Password hashing
+bcrypt в отдельном ограниченном пуле потоков, чтобы хеширование не блокировало event loop
+"""
+
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+# bcrypt only looks at the first 72 bytes; newer releases reject longer input instead of truncating
+BCRYPT_MAX_BYTES = 72
+
+
+class HasherBusy(Exception):
+    pass
+
+
+def _encode(password: str) -> bytes:
+    return password.encode("utf-8")[:BCRYPT_MAX_BYTES]
+
+
+class PasswordHasher:
+    """Runs bcrypt on ``workers`` dedicated threads (bcrypt releases the GIL while hashing).
+
+    At most ``max_pending`` hash/verify calls may be running or queued; beyond
+    that HasherBusy is raised immediately instead of queueing more CPU work
+    behind a login burst.
+    """
+
+    def __init__(self, rounds: int = 12, workers: int = 2, max_pending: int = 8):
+        self.rounds = rounds
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    async def _run(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+        finally:
+            self._slots.release()
+
+    async def hash(self, password: str) -> str:
+        salt = bcrypt.gensalt(rounds=self.rounds)
+        return (await self._run(bcrypt.hashpw, _encode(password), salt)).decode("utf-8")
+
+    async def verify(self, password: str, hashed: str) -> bool:
+        try:
+            return await self._run(bcrypt.checkpw, _encode(password), hashed.encode("utf-8"))
+        except ValueError:
+            # Not a bcrypt hash
+            return False
+
+    def needs_rehash(self, hashed: str) -> bool:
+        """True when ``hashed`` was made with a different cost factor than the configured one."""
+        try:
+            return int(hashed.split("$")[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
+
+
+def create_password_hasher() -> PasswordHasher:
+    return PasswordHasher(
+        rounds=int(os.getenv("BCRYPT_ROUNDS", "12")),
+        workers=int(os.getenv("PASSWORD_HASH_WORKERS", "2")),
+        max_pending=int(os.getenv("PASSWORD_HASH_MAX_PENDING", "8")),
+    )
@@ -0,0 +1,145 @@
+"""
+Request profiling
+Выборочное профилирование запросов (cProfile + SQL) в кольцевой буфер для администратора
+"""
+
+import cProfile
+import hmac
+import os
+import pstats
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import List, Optional
+
+from sqlalchemy import event
+
+# SQL of the request being profiled; None everywhere else
+_profiled_sql: ContextVar[Optional[list]] = ContextVar("profiled_sql", default=None)
+
+
+class RequestProfiler:
+    """Profiles one request in ``sample_rate`` (0 = only on demand) and keeps the last ``buffer_size``.
+
+    A request carrying ``X-Profile-Token: <token>`` is always profiled. cProfile
+    allows one active profiler per process, so a request arriving while
+    another is profiled runs unprofiled. Other coroutines interleaving on the
+    event loop during a profiled request show up in its profile too.
+    """
+
+    HEADER = b"x-profile-token"
+
+    def __init__(self, sample_rate: int = 0, token: Optional[str] = None, top: int = 25,
+                 buffer_size: int = 50, max_statements: int = 100):
+        self.sample_rate = sample_rate
+        self.token = token.encode() if token else None
+        self.top = top
+        self.max_statements = max_statements
+        self.profiles: deque = deque(maxlen=buffer_size)
+        self._counter = 0
+        self.busy = threading.Lock()
+
+    def wanted(self, scope) -> bool:
+        if self.token is not None:
+            for name, value in scope["headers"]:
+                if name == self.HEADER:
+                    return hmac.compare_digest(value, self.token)
+        if self.sample_rate:
+            self._counter += 1
+            return self._counter % self.sample_rate == 0
+        return False
+
+    def is_admin(self, token: Optional[str]) -> bool:
+        return self.token is not None and token is not None and hmac.compare_digest(token.encode(), self.token)
+
+    def instrument_engine(self, engine) -> None:
+        @event.listens_for(engine, "before_cursor_execute")
+        def _before(connection, cursor, statement, parameters, context, executemany):
+            if _profiled_sql.get() is not None:
+                connection.info.setdefault("profile_started", []).append(time.perf_counter())
+
+        @event.listens_for(engine, "after_cursor_execute")
+        def _after(connection, cursor, statement, parameters, context, executemany):
+            statements = _profiled_sql.get()
+            started = connection.info.get("profile_started")
+            if statements is None or not started:
+                return
+            duration = time.perf_counter() - started.pop()
+            if len(statements) < self.max_statements:
+                statements.append({"statement": statement, "ms": round(duration * 1000, 3), "executemany": executemany})
+
+    def hot_functions(self, profile: cProfile.Profile) -> List[dict]:
+        stats = pstats.Stats(profile)
+        entries = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:self.top]
+        return [
+            {
+                "function": f"{path}:{line}({name})",
+                "calls": calls,
+                "own_ms": round(own * 1000, 3),
+                "cumulative_ms": round(cumulative * 1000, 3),
+            }
+            for (path, line, name), (_, calls, own, cumulative, _) in entries
+        ]
+
+
+class ProfilingMiddleware:
+    def __init__(self, app, profiler: RequestProfiler):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        profiler = self.profiler
+        if scope["type"] != "http" or not profiler.wanted(scope) or not profiler.busy.acquire(blocking=False):
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        statements: list = []
+        token = _profiled_sql.set(statements)
+        profile = cProfile.Profile()
+        started_at = time.time()
+        started = time.perf_counter()
+        try:
+            profile.enable()
+            try:
+                await self.app(scope, receive, send_with_status)
+            finally:
+                profile.disable()
+        finally:
+            duration = time.perf_counter() - started
+            _profiled_sql.reset(token)
+            profiler.busy.release()
+            route = scope.get("route")
+            profiler.profiles.append({
+                "method": scope["method"],
+                "path": scope["path"],
+                "route": route.path if route is not None else None,
+                "status": status,
+                "started_at": started_at,
+                "duration_ms": round(duration * 1000, 3),
+                "sql_ms": round(sum(item["ms"] for item in statements), 3),
+                "hot_functions": profiler.hot_functions(profile),
+                "sql": statements,
+            })
+
+
+def create_request_profiler() -> Optional[RequestProfiler]:
+    """None unless PROFILING_SAMPLE_RATE or PROFILING_TOKEN is set; then nothing is installed at all."""
+    sample_rate = int(os.getenv("PROFILING_SAMPLE_RATE", "0"))
+    token = os.getenv("PROFILING_TOKEN") or None
+    if not sample_rate and token is None:
+        return None
+    return RequestProfiler(
+        sample_rate=sample_rate,
+        token=token,
+        top=int(os.getenv("PROFILING_TOP_FUNCTIONS", "25")),
+        buffer_size=int(os.getenv("PROFILING_BUFFER_SIZE", "50")),
+    )
@@ -0,0 +1,170 @@
+"""
+Per-bot response cache
+Кэш ответов на повторяющиеся вопросы: точное совпадение + близкие дубликаты (MinHash/LSH), LRU + TTL
+"""
+
+import os
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional, Tuple
+
+import numpy as np
+
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16  # 16 bands x 4 rows: pairs at similarity 0.8 collide in a band >99.9% of the time
+_PRIME = (1 << 61) - 1
+_random = np.random.RandomState(20240101)
+_A = _random.randint(1, 1 << 31, size=MINHASH_PERMUTATIONS).astype(np.uint64)
+_B = _random.randint(0, 1 << 31, size=MINHASH_PERMUTATIONS).astype(np.uint64)
+
+
+def normalize(text: str) -> str:
+    """Case, punctuation and spacing do not change the question."""
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+
+def minhash(normalized: str) -> np.ndarray:
+    padded = f" {normalized} "
+    shingles = {padded[i:i + 3] for i in range(max(len(padded) - 2, 1))}
+    hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles), dtype=np.uint64)
+    # a < 2^31 and x < 2^32, so a*x + b stays below 2^64
+    return ((np.outer(_A, hashes) + _B[:, None]) % _PRIME).min(axis=1)
+
+
+class ResponseCache:
+    """Answers keyed by (bot_id, normalized question).
+
+    With ``near_duplicates`` enabled a miss on the exact key falls back to
+    MinHash LSH over the bot's cached questions and accepts the best candidate
+    whose estimated Jaccard similarity reaches ``similarity``.
+
+    ``epoch`` is bumped on every invalidation; an answer generated before the
+    bump is dropped by ``set`` instead of resurrecting stale content.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 600.0, near_duplicates: bool = False, similarity: float = 0.8):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.near_duplicates = near_duplicates
+        self.similarity = similarity
+        self.epoch = 0
+        self._data: "OrderedDict[Tuple[int, str], tuple]" = OrderedDict()
+        self._bot_keys: Dict[int, set] = {}
+        self._user_bots: Dict[str, set] = {}
+        self._buckets: Dict[Hashable, set] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def _bands(self, bot_id: int, signature: np.ndarray):
+        rows = MINHASH_PERMUTATIONS // LSH_BANDS
+        for band in range(LSH_BANDS):
+            yield bot_id, band, signature[band * rows:(band + 1) * rows].tobytes()
+
+    def _remove(self, key: Tuple[int, str]) -> None:
+        _, _, signature = self._data.pop(key)
+        keys = self._bot_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._bot_keys[key[0]]
+        if signature is not None:
+            for band in self._bands(key[0], signature):
+                bucket = self._buckets.get(band)
+                if bucket is not None:
+                    bucket.discard(key)
+                    if not bucket:
+                        del self._buckets[band]
+
+    def _live(self, key: Tuple[int, str], now: float) -> Optional[str]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[1] < now:
+            self._remove(key)
+            return None
+        self._data.move_to_end(key)
+        return entry[0]
+
+    def get(self, bot_id: int, question: str) -> Optional[str]:
+        normalized = normalize(question)
+        now = time.monotonic()
+        with self._lock:
+            answer = self._live((bot_id, normalized), now)
+            if answer is not None:
+                self.hits += 1
+                return answer
+            if not self.near_duplicates or bot_id not in self._bot_keys:
+                self.misses += 1
+                return None
+
+        signature = minhash(normalized)
+        with self._lock:
+            candidates = set()
+            for band in self._bands(bot_id, signature):
+                candidates |= self._buckets.get(band, set())
+            best_key, best_score = None, self.similarity
+            for key in candidates:
+                entry = self._data.get(key)
+                score = float(np.mean(entry[2] == signature)) if entry else 0.0
+                if score >= best_score:
+                    best_key, best_score = key, score
+            answer = self._live(best_key, now) if best_key else None
+            if answer is None:
+                self.misses += 1
+                return None
+            self.near_hits += 1
+            return answer
+
+    def set(self, bot_id: int, user_id: str, question: str, answer: str, epoch: int) -> None:
+        normalized = normalize(question)
+        signature = minhash(normalized) if self.near_duplicates else None
+        key = (bot_id, normalized)
+        with self._lock:
+            if epoch != self.epoch:
+                return
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (answer, time.monotonic() + self.ttl, signature)
+            self._bot_keys.setdefault(bot_id, set()).add(key)
+            self._user_bots.setdefault(user_id, set()).add(bot_id)
+            if signature is not None:
+                for band in self._bands(bot_id, signature):
+                    self._buckets.setdefault(band, set()).add(key)
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+
+    def invalidate_bot(self, bot_id: int) -> None:
+        with self._lock:
+            self.epoch += 1
+            for key in list(self._bot_keys.get(bot_id, ())):
+                self._remove(key)
+
+    def invalidate_user(self, user_id: str) -> None:
+        with self._lock:
+            self.epoch += 1
+            for bot_id in self._user_bots.pop(user_id, ()):
+                for key in list(self._bot_keys.get(bot_id, ())):
+                    self._remove(key)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+        }
+
+
+def create_response_cache() -> ResponseCache:
+    return ResponseCache(
+        maxsize=int(os.getenv("RESPONSE_CACHE_SIZE", "10000")),
+        ttl=float(os.getenv("RESPONSE_CACHE_TTL", "600")),
+        near_duplicates=os.getenv("RESPONSE_CACHE_NEAR_DUPLICATES", "0") == "1",
+        similarity=float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.8")),
+    )
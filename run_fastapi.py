@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 import uvicorn
 import os
+import subprocess
+import sys
 
 def main():
     # Get port from environment or default to 8000
     port = int(os.getenv("PORT", "8000"))
+
+    # Index builds run once here, not on every reload of the app module
+    subprocess.run([sys.executable, "main.py", "migrate"], check=True)
     
     # Run FastAPI server
     uvicorn.run(
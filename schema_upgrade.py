@@ -0,0 +1,78 @@
+"""
+In-place schema upgrades
+create_all() только создаёт отсутствующие таблицы; здесь догоняем колонки и индексы на уже существующих
+"""
+
+import logging
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary, shared by every process that migrates: only one builds indexes at a time
+ADVISORY_LOCK_ID = 0x6D696772
+
+
+def _index_valid(connection, name: str):
+    """True if the index exists and is usable, False if a failed build left it INVALID, None if absent."""
+    row = connection.execute(text(
+        "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid"
+        " WHERE c.relname = :name AND pg_table_is_visible(c.oid)"
+    ), {"name": name}).first()
+    return None if row is None else row[0]
+
+
+def ensure_indexes(engine, table) -> None:
+    """Create any index declared on ``table`` that the database does not have yet.
+
+    A migration step: run it once per deploy, not on import in every worker.
+    On PostgreSQL the index is built CONCURRENTLY so writes to a large
+    existing table are not blocked while it builds. A build that failed
+    midway leaves an INVALID index behind, which IF NOT EXISTS would skip
+    forever; those are dropped and built again.
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        postgres = connection.dialect.name == "postgresql"
+        if postgres:
+            connection.execute(text("SELECT pg_advisory_lock(:id)"), {"id": ADVISORY_LOCK_ID})
+        try:
+            for index in table.indexes:
+                statement = str(CreateIndex(index, if_not_exists=True).compile(dialect=connection.dialect))
+                try:
+                    if postgres:
+                        valid = _index_valid(connection, index.name)
+                        if valid:
+                            continue
+                        if valid is False:
+                            logger.warning("Rebuilding invalid index %s", index.name)
+                            connection.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {index.name}")
+                        statement = statement.replace("CREATE INDEX", "CREATE INDEX CONCURRENTLY", 1)
+                        statement = statement.replace("CREATE UNIQUE INDEX", "CREATE UNIQUE INDEX CONCURRENTLY", 1)
+                    connection.exec_driver_sql(statement)
+                except Exception:
+                    logger.exception("Could not create index %s", index.name)
+        finally:
+            if postgres:
+                connection.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": ADVISORY_LOCK_ID})
+
+
+def ensure_columns(engine, table) -> None:
+    """Add columns declared on ``table`` but missing from an existing database table.
+
+    Only nullable columns (or ones with a server default) can be added this way.
+    """
+    existing = {column["name"] for column in inspect(engine).get_columns(table.name)}
+    missing = [column for column in table.columns if column.name not in existing]
+    if not missing:
+        return
+    with engine.begin() as connection:
+        for column in missing:
+            column_type = column.type.compile(dialect=connection.dialect)
+            # IF NOT EXISTS keeps concurrently starting workers from tripping over each other
+            if_not_exists = "IF NOT EXISTS " if connection.dialect.name == "postgresql" else ""
+            statement = f"ALTER TABLE {table.name} ADD COLUMN {if_not_exists}{column.name} {column_type}"
+            if column.server_default is not None:
+                statement += f" DEFAULT {column.server_default.arg}"
+            connection.exec_driver_sql(statement)
+            logger.info("Added column %s.%s", table.name, column.name)
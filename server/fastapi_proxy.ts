@@ -78,6 +78,8 @@ export function setupFastAPIProxy(app: Express) {
   app.use('/api/knowledge-files', apiProxy);
   app.use('/api/stats', apiProxy);
   app.use('/api/recent-activity', apiProxy);
+  app.use('/api/dashboard', apiProxy);
+  app.use('/api/message-logs', apiProxy);
   app.use('/api/webhooks', apiProxy);
 }
 
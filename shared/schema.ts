@@ -8,6 +8,10 @@ import {
   serial,
   boolean,
   integer,
+  bigint,
+  unique,
+  uniqueIndex,
+  primaryKey,
 } from "drizzle-orm/pg-core";
 import { createInsertSchema } from "drizzle-zod";
 import { z } from "zod";
@@ -30,6 +34,7 @@ export const users = pgTable("users", {
   firstName: varchar("first_name"),
   lastName: varchar("last_name"),
   profileImageUrl: varchar("profile_image_url"),
+  passwordHash: varchar("password_hash"), // bcrypt
   createdAt: timestamp("created_at").defaultNow(),
   updatedAt: timestamp("updated_at").defaultNow(),
 });
@@ -58,10 +63,15 @@ export const knowledgeFiles = pgTable("knowledge_files", {
   fileSize: integer("file_size").notNull(),
   mimeType: varchar("mime_type").notNull(),
   isProcessed: boolean("is_processed").default(false),
+  contentHash: varchar("content_hash", { length: 64 }),
+  processingStartedAt: timestamp("processing_started_at"),
+  processingError: text("processing_error"),
   createdAt: timestamp("created_at").defaultNow(),
-});
+}, (table) => [
+  index("ix_knowledge_files_content_hash").on(table.contentHash),
+]);
 
-// Message logs for analytics
+// Message logs for analytics; monthly partitions by created_at with MESSAGE_LOG_PARTITIONING=1 (created by the API, not drizzle)
 export const messageLogs = pgTable("message_logs", {
   id: serial("id").primaryKey(),
   botId: integer("bot_id").notNull().references(() => bots.id),
@@ -72,9 +82,128 @@ export const messageLogs = pgTable("message_logs", {
   responseText: text("response_text"),
   responseTime: integer("response_time"), // in milliseconds
   isAutoResponse: boolean("is_auto_response").default(true),
+  isCached: boolean("is_cached").default(false), // answered from the response cache, left out of latency stats
   createdAt: timestamp("created_at").defaultNow(),
+}, (table) => [
+  index("ix_message_logs_bot_created_id").on(table.botId, table.createdAt.desc(), table.id.desc()),
+  uniqueIndex("uq_message_logs_bot_platform_message").on(table.botId, table.platform, table.messageId),
+]);
+
+// Text chunks extracted from knowledge files, shared by files with identical content
+export const knowledgeChunks = pgTable("knowledge_chunks", {
+  id: serial("id").primaryKey(),
+  contentHash: varchar("content_hash", { length: 64 }).notNull(),
+  chunkIndex: integer("chunk_index").notNull(),
+  content: text("content").notNull(),
+}, (table) => [
+  index("ix_knowledge_chunks_content_hash").on(table.contentHash),
+  unique("uq_knowledge_chunks_hash_index").on(table.contentHash, table.chunkIndex),
+]);
+
+// Per-bot message counters, maintained on every message log insert
+export const botStats = pgTable("bot_stats", {
+  botId: integer("bot_id").primaryKey(),
+  messageCount: bigint("message_count", { mode: "number" }).notNull().default(0),
+  responseTimeSum: bigint("response_time_sum", { mode: "number" }).notNull().default(0),
+  responseTimeCount: bigint("response_time_count", { mode: "number" }).notNull().default(0),
+  updatedAt: timestamp("updated_at").defaultNow(),
+});
+
+// Hourly/daily message counters per bot and platform, maintained on every message log insert
+const messageStatsColumns = () => ({
+  botId: integer("bot_id").notNull(),
+  platform: varchar("platform").notNull(),
+  bucket: timestamp("bucket").notNull(),
+  messageCount: bigint("message_count", { mode: "number" }).notNull().default(0),
+  autoResponseCount: bigint("auto_response_count", { mode: "number" }).notNull().default(0),
+  responseTimeSum: bigint("response_time_sum", { mode: "number" }).notNull().default(0),
+  responseTimeCount: bigint("response_time_count", { mode: "number" }).notNull().default(0),
+});
+
+export const messageStatsHourly = pgTable("message_stats_hourly", messageStatsColumns(), (table) => [
+  primaryKey({ columns: [table.botId, table.platform, table.bucket] }),
+]);
+
+export const messageStatsDaily = pgTable("message_stats_daily", messageStatsColumns(), (table) => [
+  primaryKey({ columns: [table.botId, table.platform, table.bucket] }),
+]);
+
+// Per-bot DDSketch bins of response times (1% relative accuracy), merged to get percentiles
+export const responseTimeSketches = pgTable("response_time_sketches", {
+  botId: integer("bot_id").notNull(),
+  binKey: integer("bin_key").notNull(),
+  binCount: bigint("bin_count", { mode: "number" }).notNull().default(0),
+}, (table) => [
+  primaryKey({ columns: [table.botId, table.binKey] }),
+]);
+
+// The same sketch bins per hourly/daily bucket, for timeseries percentiles
+const bucketSketchColumns = () => ({
+  botId: integer("bot_id").notNull(),
+  platform: varchar("platform").notNull(),
+  bucket: timestamp("bucket").notNull(),
+  binKey: integer("bin_key").notNull(),
+  binCount: bigint("bin_count", { mode: "number" }).notNull().default(0),
+});
+
+export const responseTimeSketchesHourly = pgTable("response_time_sketches_hourly", bucketSketchColumns(), (table) => [
+  primaryKey({ columns: [table.botId, table.platform, table.bucket, table.binKey] }),
+]);
+
+export const responseTimeSketchesDaily = pgTable("response_time_sketches_daily", bucketSketchColumns(), (table) => [
+  primaryKey({ columns: [table.botId, table.platform, table.bucket, table.binKey] }),
+]);
+
+// Totals and sketch bins of message logs archived and removed by retention; rebuilds start from them
+export const archivedBotStats = pgTable("archived_bot_stats", {
+  botId: integer("bot_id").primaryKey(),
+  messageCount: bigint("message_count", { mode: "number" }).notNull().default(0),
+  responseTimeSum: bigint("response_time_sum", { mode: "number" }).notNull().default(0),
+  responseTimeCount: bigint("response_time_count", { mode: "number" }).notNull().default(0),
 });
 
+export const archivedResponseTimeSketches = pgTable("archived_response_time_sketches", {
+  botId: integer("bot_id").notNull(),
+  binKey: integer("bin_key").notNull(),
+  binCount: bigint("bin_count", { mode: "number" }).notNull().default(0),
+}, (table) => [
+  primaryKey({ columns: [table.botId, table.binKey] }),
+]);
+
+// Refresh tokens (SHA-256 only), one chain of rotations per login session
+export const refreshTokens = pgTable("refresh_tokens", {
+  tokenHash: varchar("token_hash", { length: 64 }).primaryKey(),
+  sessionId: varchar("session_id", { length: 36 }).notNull(),
+  userId: varchar("user_id").notNull(),
+  expiresAt: timestamp("expires_at").notNull(),
+  usedAt: timestamp("used_at"),
+}, (table) => [
+  index("ix_refresh_tokens_session_id").on(table.sessionId),
+  index("ix_refresh_tokens_expires_at").on(table.expiresAt),
+]);
+
+// Revoked sessions, synced into each API worker's memory
+export const tokenRevocations = pgTable("token_revocations", {
+  id: serial("id").primaryKey(),
+  sessionId: varchar("session_id", { length: 36 }).notNull(),
+  expiresAt: timestamp("expires_at").notNull(),
+  revokedAt: timestamp("revoked_at").notNull(),
+}, (table) => [
+  index("ix_token_revocations_expires_at").on(table.expiresAt),
+  index("ix_token_revocations_revoked_at").on(table.revokedAt),
+]);
+
+// Recent message ids, the redelivery check when message_logs is partitioned by month
+export const messageLogKeys = pgTable("message_log_keys", {
+  botId: integer("bot_id").notNull(),
+  platform: varchar("platform").notNull(),
+  messageId: varchar("message_id").notNull(),
+  createdAt: timestamp("created_at").notNull(),
+}, (table) => [
+  primaryKey({ columns: [table.botId, table.platform, table.messageId] }),
+  index("ix_message_log_keys_created_at").on(table.createdAt),
+]);
+
 // Insert schemas
 export const insertUserSchema = createInsertSchema(users).pick({
   email: true,
@@ -0,0 +1,469 @@
+"""
+Message statistics rollup
+Счётчики сообщений по ботам и почасовые/посуточные ряды, обновляемые при каждой записи в message_logs
+"""
+
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional
+
+from sqlalchemy import BigInteger, Boolean, Column, DateTime, Integer, MetaData, String, Table, column, event, table
+from sqlalchemy import case, cast, delete, func, insert, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from quantile_sketch import DDSketch
+
+metadata = MetaData()
+
+bot_stats = Table(
+    "bot_stats",
+    metadata,
+    Column("bot_id", Integer, primary_key=True),
+    Column("message_count", BigInteger, nullable=False, default=0),
+    Column("response_time_sum", BigInteger, nullable=False, default=0),
+    Column("response_time_count", BigInteger, nullable=False, default=0),
+    Column("updated_at", DateTime, default=func.now(), onupdate=func.now()),
+)
+
+def _timeseries_table(name: str) -> Table:
+    return Table(
+        name,
+        metadata,
+        Column("bot_id", Integer, primary_key=True),
+        Column("platform", String, primary_key=True),
+        Column("bucket", DateTime, primary_key=True),
+        Column("message_count", BigInteger, nullable=False, default=0),
+        Column("auto_response_count", BigInteger, nullable=False, default=0),
+        Column("response_time_sum", BigInteger, nullable=False, default=0),
+        Column("response_time_count", BigInteger, nullable=False, default=0),
+    )
+
+
+# One row per bot, platform and hour (or day): a 90 day chart reads 90 rows per bot and platform
+message_stats_hourly = _timeseries_table("message_stats_hourly")
+message_stats_daily = _timeseries_table("message_stats_daily")
+
+TIMESERIES = {"hour": message_stats_hourly, "day": message_stats_daily}
+# Longest range one request may ask for
+MAX_TIMESERIES_SPAN = {"hour": timedelta(days=31), "day": timedelta(days=366)}
+
+# Per-bot DDSketch of response times, one row per non-empty bin. Bins of any set of
+# bots add up to the sketch of their union, so percentiles never scan message_logs.
+SKETCH_ACCURACY = 0.01
+
+response_time_sketches = Table(
+    "response_time_sketches",
+    metadata,
+    Column("bot_id", Integer, primary_key=True),
+    Column("bin_key", Integer, primary_key=True),
+    Column("bin_count", BigInteger, nullable=False, default=0),
+)
+
+
+def _bucket_sketch_table(name: str) -> Table:
+    return Table(
+        name,
+        metadata,
+        Column("bot_id", Integer, primary_key=True),
+        Column("platform", String, primary_key=True),
+        Column("bucket", DateTime, primary_key=True),
+        Column("bin_key", Integer, primary_key=True),
+        Column("bin_count", BigInteger, nullable=False, default=0),
+    )
+
+
+# The same sketches per timeseries bucket, so a chart's percentiles match those of /stats
+response_time_sketches_hourly = _bucket_sketch_table("response_time_sketches_hourly")
+response_time_sketches_daily = _bucket_sketch_table("response_time_sketches_daily")
+
+BUCKET_SKETCHES = {"hour": response_time_sketches_hourly, "day": response_time_sketches_daily}
+SKETCH_BUCKET_KEYS = ("bot_id", "platform", "bin_key")
+
+# Totals and sketch bins of message logs that retention archived and removed. Kept
+# apart from the live rollups so ``rebuild`` can start from them: the raw rows are gone.
+archived_bot_stats = Table(
+    "archived_bot_stats",
+    metadata,
+    Column("bot_id", Integer, primary_key=True),
+    Column("message_count", BigInteger, nullable=False, default=0),
+    Column("response_time_sum", BigInteger, nullable=False, default=0),
+    Column("response_time_count", BigInteger, nullable=False, default=0),
+)
+
+archived_response_time_sketches = Table(
+    "archived_response_time_sketches",
+    metadata,
+    Column("bot_id", Integer, primary_key=True),
+    Column("bin_key", Integer, primary_key=True),
+    Column("bin_count", BigInteger, nullable=False, default=0),
+)
+
+# Lightweight handle on the raw log table, used only for rebuilds
+message_logs = table(
+    "message_logs",
+    column("bot_id", Integer),
+    column("platform", String),
+    column("response_time", Integer),
+    column("is_auto_response", Boolean),
+    column("is_cached", Boolean),
+    column("created_at", DateTime),
+)
+
+
+def truncate(moment: datetime, interval: str) -> datetime:
+    if interval == "day":
+        return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def utc_naive(moment: Optional[datetime]) -> Optional[datetime]:
+    # Logs are stored as naive UTC
+    if moment is None or moment.tzinfo is None:
+        return moment
+    return moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _latency(row) -> Optional[int]:
+    # Cache hits answer in no time; counting them would hide how fast answers are generated
+    return None if row.get("is_cached") else row.get("response_time")
+
+
+def _latency_column(rows):
+    return case((rows.c.is_cached.is_(True), None), else_=rows.c.response_time)
+
+
+def _aggregate(rows: Iterable[dict]) -> List[dict]:
+    totals = {}
+    for row in rows:
+        bot_id = row["bot_id"]
+        if bot_id is None:
+            continue
+        entry = totals.setdefault(bot_id, {"bot_id": bot_id, "message_count": 0,
+                                           "response_time_sum": 0, "response_time_count": 0})
+        entry["message_count"] += 1
+        latency = _latency(row)
+        if latency is not None:
+            entry["response_time_sum"] += latency
+            entry["response_time_count"] += 1
+    return list(totals.values())
+
+
+def _aggregate_hours(rows: Iterable[dict]) -> List[dict]:
+    totals: Dict[tuple, dict] = {}
+    for row in rows:
+        bot_id = row["bot_id"]
+        if bot_id is None:
+            continue
+        bucket = truncate(row.get("created_at") or datetime.utcnow(), "hour")
+        entry = totals.get((bot_id, row["platform"], bucket))
+        if entry is None:
+            entry = {"bot_id": bot_id, "platform": row["platform"], "bucket": bucket, "message_count": 0,
+                     "auto_response_count": 0, "response_time_sum": 0, "response_time_count": 0}
+            totals[(bot_id, row["platform"], bucket)] = entry
+        entry["message_count"] += 1
+        if row.get("is_auto_response"):
+            entry["auto_response_count"] += 1
+        latency = _latency(row)
+        if latency is not None:
+            entry["response_time_sum"] += latency
+            entry["response_time_count"] += 1
+    return list(totals.values())
+
+
+def _aggregate_hour_sketch_bins(rows: Iterable[dict], weight: Optional[str] = None) -> List[dict]:
+    sketch = DDSketch(SKETCH_ACCURACY)
+    totals: Dict[tuple, int] = {}
+    for row in rows:
+        latency = _latency(row)
+        if row["bot_id"] is None or latency is None:
+            continue
+        bucket = truncate(row.get("created_at") or datetime.utcnow(), "hour")
+        key = (row["bot_id"], row["platform"], bucket, sketch.key(latency))
+        totals[key] = totals.get(key, 0) + (row[weight] if weight else 1)
+    return [
+        {"bot_id": bot_id, "platform": platform, "bucket": bucket, "bin_key": bin_key, "bin_count": count}
+        for (bot_id, platform, bucket, bin_key), count in totals.items()
+    ]
+
+
+def _aggregate_sketch_bins(rows: Iterable[dict], weight: Optional[str] = None) -> List[dict]:
+    sketch = DDSketch(SKETCH_ACCURACY)
+    totals: Dict[tuple, int] = {}
+    for row in rows:
+        latency = _latency(row)
+        if row["bot_id"] is None or latency is None:
+            continue
+        key = (row["bot_id"], sketch.key(latency))
+        totals[key] = totals.get(key, 0) + (row[weight] if weight else 1)
+    return [{"bot_id": bot_id, "bin_key": bin_key, "bin_count": count} for (bot_id, bin_key), count in totals.items()]
+
+
+def _merge_buckets(deltas: List[dict], interval: str, keys: tuple = ("bot_id", "platform")) -> List[dict]:
+    """Hourly deltas summed into ``interval`` buckets; ``keys`` and the bucket identify a row."""
+    totals: Dict[tuple, dict] = {}
+    for delta in deltas:
+        bucket = truncate(delta["bucket"], interval)
+        identity = (*(delta[key] for key in keys), bucket)
+        entry = totals.get(identity)
+        if entry is None:
+            totals[identity] = {**delta, "bucket": bucket}
+            continue
+        for name, value in delta.items():
+            if name not in keys and name != "bucket":
+                entry[name] += value
+    return list(totals.values())
+
+
+def _increment(connection, target: Table, deltas: List[dict]) -> None:
+    if not deltas:
+        return
+    keys = [key.name for key in target.primary_key.columns]
+    counters = [name for name in deltas[0] if name not in keys]
+    dialect = connection.dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        insert_stmt = (postgresql.insert if dialect == "postgresql" else sqlite.insert)(target)
+        changes = {name: target.c[name] + insert_stmt.excluded[name] for name in counters}
+        if "updated_at" in target.c:
+            changes["updated_at"] = func.now()
+        connection.execute(insert_stmt.on_conflict_do_update(index_elements=keys, set_=changes), deltas)
+        return
+
+    for delta in deltas:
+        result = connection.execute(
+            update(target)
+            .where(*(target.c[key] == delta[key] for key in keys))
+            .values({name: target.c[name] + delta[name] for name in counters})
+        )
+        if result.rowcount == 0:
+            connection.execute(insert(target).values(**delta))
+
+
+def record_messages(connection, rows: Iterable[dict]) -> None:
+    """Add a batch of message log rows (dicts with bot_id/platform/response_time/
+    is_auto_response/is_cached/created_at) to the rollups.
+
+    Must run on the same connection/transaction as the insert into message_logs.
+    """
+    rows = list(rows)
+    _increment(connection, bot_stats, _aggregate(rows))
+    hours = _aggregate_hours(rows)
+    for interval, target in TIMESERIES.items():
+        _increment(connection, target, _merge_buckets(hours, interval))
+    _increment(connection, response_time_sketches, _aggregate_sketch_bins(rows))
+    sketch_hours = _aggregate_hour_sketch_bins(rows)
+    for interval, target in BUCKET_SKETCHES.items():
+        _increment(connection, target, _merge_buckets(sketch_hours, interval, SKETCH_BUCKET_KEYS))
+
+
+def track(message_log_model) -> None:
+    """Keep the rollup in sync with ORM inserts of ``message_log_model``."""
+
+    @event.listens_for(message_log_model, "after_insert")
+    def _after_insert(mapper, connection, target):
+        created_at = target.__dict__.get("created_at")
+        record_messages(connection, [{
+            "bot_id": target.bot_id,
+            "platform": target.platform,
+            "response_time": target.response_time,
+            "is_auto_response": target.is_auto_response,
+            "is_cached": target.is_cached,
+            # A server-side default is not loaded back yet
+            "created_at": created_at if isinstance(created_at, datetime) else None,
+        }])
+
+
+def _totals(rows):
+    """Per-bot message count and response time sum/count of ``rows`` (message_logs or a subquery of it)."""
+    return select(
+        rows.c.bot_id,
+        func.count().label("message_count"),
+        func.coalesce(func.sum(_latency_column(rows)), 0).label("response_time_sum"),
+        func.count(_latency_column(rows)).label("response_time_count"),
+    ).where(rows.c.bot_id.is_not(None)).group_by(rows.c.bot_id)
+
+
+def _response_time_counts(rows):
+    # Response times are whole milliseconds, so grouping by value keeps this small
+    latency = _latency_column(rows)
+    return select(
+        rows.c.bot_id, latency.label("response_time"), func.count().label("observations"),
+    ).where(rows.c.bot_id.is_not(None), latency.is_not(None)).group_by(rows.c.bot_id, latency)
+
+
+def carry_over(connection, rows) -> None:
+    """Add message logs that retention is about to remove to the archived totals.
+
+    ``rows`` selects the message_logs columns of those rows. Must run in the
+    transaction that removes them, so a row is counted either here or in
+    message_logs, never both.
+    """
+    rows = rows.subquery()
+    _increment(connection, archived_bot_stats, [dict(row) for row in connection.execute(_totals(rows)).mappings()])
+    _increment(connection, archived_response_time_sketches, _aggregate_sketch_bins(
+        connection.execute(_response_time_counts(rows)).mappings(), weight="observations"
+    ))
+
+
+def forget_bot(connection, bot_id: int) -> None:
+    connection.execute(delete(bot_stats).where(bot_stats.c.bot_id == bot_id))
+    connection.execute(delete(response_time_sketches).where(response_time_sketches.c.bot_id == bot_id))
+    connection.execute(delete(archived_bot_stats).where(archived_bot_stats.c.bot_id == bot_id))
+    connection.execute(
+        delete(archived_response_time_sketches).where(archived_response_time_sketches.c.bot_id == bot_id)
+    )
+    for target in (*TIMESERIES.values(), *BUCKET_SKETCHES.values()):
+        connection.execute(delete(target).where(target.c.bot_id == bot_id))
+
+
+def _rebuild_timeseries(connection, bot_id: int) -> None:
+    # Buckets older than the oldest raw row stay: their logs may have been archived by retention
+    oldest = connection.execute(select(func.min(message_logs.c.created_at)).where(message_logs.c.bot_id == bot_id)).scalar()
+    for target in (*TIMESERIES.values(), *BUCKET_SKETCHES.values()):
+        clear = delete(target).where(target.c.bot_id == bot_id)
+        if oldest is not None:
+            clear = clear.where(target.c.bucket >= truncate(oldest, "day"))
+        connection.execute(clear)
+    if oldest is None:
+        return
+    source = select(
+        message_logs.c.bot_id, message_logs.c.platform, message_logs.c.response_time,
+        message_logs.c.is_auto_response, message_logs.c.is_cached, message_logs.c.created_at,
+    ).where(message_logs.c.bot_id == bot_id).execution_options(stream_results=True, yield_per=5000)
+    hours = _aggregate_hours(connection.execute(source).mappings())
+    for interval, target in TIMESERIES.items():
+        deltas = _merge_buckets(hours, interval)
+        if deltas:
+            connection.execute(insert(target), deltas)
+    sketch_hours = _aggregate_hour_sketch_bins(connection.execute(source).mappings())
+    for interval, target in BUCKET_SKETCHES.items():
+        deltas = _merge_buckets(sketch_hours, interval, SKETCH_BUCKET_KEYS)
+        if deltas:
+            connection.execute(insert(target), deltas)
+
+
+def rebuild(connection, bot_ids: Optional[List[int]] = None) -> None:
+    """Recompute rollup rows from the raw message logs (all bots if ``bot_ids`` is None).
+
+    Totals and sketches start from what retention archived; timeseries buckets
+    older than a bot's oldest raw row are kept as they are.
+    """
+    source = _totals(message_logs)
+    sketch_source = _response_time_counts(message_logs)
+    archived = select(archived_bot_stats)
+    archived_sketches = select(archived_response_time_sketches)
+    clear = delete(bot_stats)
+    clear_sketches = delete(response_time_sketches)
+    if bot_ids is not None:
+        if not bot_ids:
+            return
+        source = source.where(message_logs.c.bot_id.in_(bot_ids))
+        sketch_source = sketch_source.where(message_logs.c.bot_id.in_(bot_ids))
+        archived = archived.where(archived_bot_stats.c.bot_id.in_(bot_ids))
+        archived_sketches = archived_sketches.where(archived_response_time_sketches.c.bot_id.in_(bot_ids))
+        clear = clear.where(bot_stats.c.bot_id.in_(bot_ids))
+        clear_sketches = clear_sketches.where(response_time_sketches.c.bot_id.in_(bot_ids))
+
+    connection.execute(clear)
+    connection.execute(insert(bot_stats).from_select(
+        ["bot_id", "message_count", "response_time_sum", "response_time_count"], source
+    ))
+    _increment(connection, bot_stats, [dict(row) for row in connection.execute(archived).mappings()])
+    connection.execute(clear_sketches)
+    sketch_bins = _aggregate_sketch_bins(connection.execute(sketch_source).mappings(), weight="observations")
+    if sketch_bins:
+        connection.execute(insert(response_time_sketches), sketch_bins)
+    _increment(connection, response_time_sketches, [dict(row) for row in connection.execute(archived_sketches).mappings()])
+
+    if bot_ids is None:
+        bot_ids = [bot_id for (bot_id,) in connection.execute(
+            select(message_logs.c.bot_id).where(message_logs.c.bot_id.is_not(None)).distinct()
+        )]
+    # One bot at a time keeps the buckets being rebuilt in memory small (a year is ~9k hours)
+    for bot_id in bot_ids:
+        _rebuild_timeseries(connection, bot_id)
+
+
+def load_sketch(connection, bot_ids) -> DDSketch:
+    """Merged response time sketch of ``bot_ids`` (a list or a select of bot ids)."""
+    sketch = DDSketch(SKETCH_ACCURACY)
+    sketch.add_bins(connection.execute(
+        select(response_time_sketches.c.bin_key, func.sum(response_time_sketches.c.bin_count))
+        .where(response_time_sketches.c.bot_id.in_(bot_ids))
+        .group_by(response_time_sketches.c.bin_key)
+    ))
+    return sketch
+
+
+def sketch_bins(bot_id):
+    """Correlated subquery with the bins of the bot ``bot_id`` refers to, as "key:count,key:count".
+
+    Lets a query that already lists bots carry their sketches along instead of
+    needing a second round trip; decode the values with ``merge_sketch_bins``.
+    """
+    pair = cast(response_time_sketches.c.bin_key, String) + ":" + cast(response_time_sketches.c.bin_count, String)
+    return (
+        select(func.aggregate_strings(pair, ","))
+        .where(response_time_sketches.c.bot_id == bot_id)
+        .scalar_subquery()
+    )
+
+
+def merge_sketch_bins(encoded_bins: Iterable[Optional[str]]) -> DDSketch:
+    sketch = DDSketch(SKETCH_ACCURACY)
+    for encoded in encoded_bins:
+        if encoded:
+            sketch.add_bins(map(int, pair.split(":")) for pair in encoded.split(","))
+    return sketch
+
+
+def response_time_percentiles(sketch: DDSketch) -> dict:
+    percentiles = {}
+    for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+        value = sketch.quantile(fraction)
+        percentiles[f"{name}_response_time"] = None if value is None else round(value)
+    return percentiles
+
+
+def load_timeseries(
+    connection,
+    interval: str,
+    bot_ids: List[int],
+    since: datetime,
+    until: datetime,
+    platform: Optional[str] = None,
+) -> List[dict]:
+    """Points of ``interval`` buckets in [since, until) per bot and platform, oldest first."""
+    if not bot_ids:
+        return []
+    target = TIMESERIES[interval]
+    sketches = BUCKET_SKETCHES[interval]
+    statement = select(target).where(
+        target.c.bot_id.in_(bot_ids),
+        target.c.bucket >= truncate(since, interval),
+        target.c.bucket < until,
+    ).order_by(target.c.bucket, target.c.bot_id, target.c.platform)
+    sketch_statement = select(sketches).where(
+        sketches.c.bot_id.in_(bot_ids),
+        sketches.c.bucket >= truncate(since, interval),
+        sketches.c.bucket < until,
+    )
+    if platform is not None:
+        statement = statement.where(target.c.platform == platform)
+        sketch_statement = sketch_statement.where(sketches.c.platform == platform)
+    bucket_sketches: Dict[tuple, DDSketch] = {}
+    for row in connection.execute(sketch_statement):
+        key = (row.bot_id, row.platform, row.bucket)
+        bucket_sketches.setdefault(key, DDSketch(SKETCH_ACCURACY)).add_bins([(row.bin_key, row.bin_count)])
+    return [
+        {
+            "bucket": row.bucket,
+            "bot_id": row.bot_id,
+            "platform": row.platform,
+            "message_count": row.message_count,
+            "auto_response_ratio": round(row.auto_response_count / row.message_count, 4) if row.message_count else 0.0,
+            "avg_response_time": int(row.response_time_sum / row.response_time_count) if row.response_time_count else None,
+            **response_time_percentiles(
+                bucket_sketches.get((row.bot_id, row.platform, row.bucket)) or DDSketch(SKETCH_ACCURACY)
+            ),
+        }
+        for row in connection.execute(statement)
+    ]
@@ -0,0 +1,59 @@
+import importlib
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+@pytest.fixture(scope="session")
+def app_module(tmp_path_factory):
+    """main.py against a throwaway SQLite database.
+
+    The app reads its configuration and creates tables at import time, and
+    keeps uploads and indexes relative to the working directory, so both are
+    pointed at a temporary directory first.
+    """
+    workdir = tmp_path_factory.mktemp("app")
+    previous_cwd = os.getcwd()
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{workdir / 'app.db'}",
+        "BCRYPT_ROUNDS": "4",
+        "KNOWLEDGE_INDEX_DIR": str(workdir / "indexes"),
+        "MESSAGE_LOG_ARCHIVE_DIR": str(workdir / "archive"),
+        "WEBHOOK_QUEUE_BACKEND": "memory",
+    })
+    os.chdir(workdir)
+    try:
+        yield importlib.import_module("main")
+    finally:
+        os.chdir(previous_cwd)
+
+
+@pytest.fixture(scope="session")
+def client(app_module):
+    from fastapi.testclient import TestClient
+
+    # Entering the client runs the lifespan: queue workers, log writer, revocation sync
+    with TestClient(app_module.app) as client:
+        yield client
+
+
+@pytest.fixture
+def register(client):
+    """Registers a fresh user; returns (auth headers, token response)."""
+    def register_user():
+        response = client.post("/auth/register", json={
+            "email": f"user-{uuid.uuid4().hex[:12]}@example.com",
+            "password": "secret-password",
+            "firstName": "Test",
+            "lastName": "User",
+        })
+        assert response.status_code == 200, response.text
+        body = response.json()
+        return {"Authorization": f"Bearer {body['access_token']}"}, body
+    return register_user
@@ -0,0 +1,41 @@
+def refresh(client, token):
+    return client.post("/auth/refresh", json={"refresh_token": token})
+
+
+def test_refresh_rotates_the_token(client, register):
+    _, session = register()
+
+    response = refresh(client, session["refresh_token"])
+    assert response.status_code == 200, response.text
+    rotated = response.json()
+    assert rotated["refresh_token"] != session["refresh_token"]
+    assert client.get("/user", headers={"Authorization": f"Bearer {rotated['access_token']}"}).status_code == 200
+
+
+def test_reused_refresh_token_revokes_the_session(client, register):
+    headers, session = register()
+    rotated = refresh(client, session["refresh_token"]).json()
+
+    # The spent token comes back: whoever holds it, the session is no longer trusted
+    assert refresh(client, session["refresh_token"]).status_code == 401
+    assert refresh(client, rotated["refresh_token"]).status_code == 401
+    assert client.get("/user", headers={"Authorization": f"Bearer {rotated['access_token']}"}).status_code == 401
+    assert client.get("/user", headers=headers).status_code == 401
+
+
+def test_reuse_leaves_other_sessions_alone(client, register):
+    _, session = register()
+    login = client.post("/auth/login", json={"email": session["user"]["email"], "password": "secret-password"})
+    assert login.status_code == 200, login.text
+    other = login.json()
+
+    refresh(client, session["refresh_token"])
+    assert refresh(client, session["refresh_token"]).status_code == 401
+
+    response = refresh(client, other["refresh_token"])
+    assert response.status_code == 200, response.text
+    assert client.get("/user", headers={"Authorization": f"Bearer {other['access_token']}"}).status_code == 200
+
+
+def test_unknown_refresh_token_is_rejected(client):
+    assert refresh(client, "not-a-token").status_code == 401
@@ -0,0 +1,104 @@
+import time
+import uuid
+from pathlib import Path
+
+from sqlalchemy import func, select
+
+from knowledge_processing import knowledge_chunks
+
+
+def upload(client, headers, content: bytes, name: str = "faq.txt") -> dict:
+    response = client.post("/knowledge-files", headers=headers, files={"file": (name, content, "text/plain")})
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+def wait_until_processed(app_module, file_id: int, timeout: float = 10.0) -> None:
+    files = app_module.KnowledgeFile.__table__
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with app_module.engine.connect() as connection:
+            if connection.execute(select(files.c.is_processed).where(files.c.id == file_id)).scalar():
+                return
+        time.sleep(0.02)
+    raise AssertionError(f"knowledge file {file_id} was not processed")
+
+
+def wait_until_idle(app_module, timeout: float = 10.0) -> None:
+    # A worker between taking a file off the queue and claiming it shows up nowhere, so idle must hold a while
+    processor = app_module.knowledge_processor
+    deadline = time.monotonic() + timeout
+    idle_since = None
+    while time.monotonic() < deadline:
+        if processor.queue.empty() and not processor.metrics()["in_progress"]:
+            idle_since = idle_since or time.monotonic()
+            if time.monotonic() - idle_since > 0.3:
+                return
+        else:
+            idle_since = None
+        time.sleep(0.02)
+    raise AssertionError("knowledge processing did not finish")
+
+
+def chunk_count(app_module, content_hash: str) -> int:
+    with app_module.engine.connect() as connection:
+        return connection.execute(
+            select(func.count()).select_from(knowledge_chunks).where(knowledge_chunks.c.content_hash == content_hash)
+        ).scalar()
+
+
+def search(client, headers, query: str) -> list:
+    response = client.get("/knowledge-files/search", headers=headers, params={"q": query})
+    assert response.status_code == 200, response.text
+    return response.json()["results"]
+
+
+def test_blob_is_kept_until_its_last_reference_is_deleted(client, app_module, register):
+    alice, _ = register()
+    bob, _ = register()
+    marker = uuid.uuid4().hex
+    content = f"Opening hours {marker}: we are open from nine to six.".encode()
+
+    first = upload(client, alice, content)
+    wait_until_processed(app_module, first["id"])
+    second = upload(client, alice, content, "copy.txt")
+    shared = upload(client, bob, content)
+    blob = Path(first["file_path"])
+    assert first["content_hash"] == second["content_hash"] == shared["content_hash"]
+    assert second["file_path"] == shared["file_path"] == first["file_path"]
+    # Identical bytes are processed once and reused by every later upload
+    assert second["is_processed"] and shared["is_processed"]
+    assert search(client, bob, marker)
+
+    assert client.delete(f"/knowledge-files/{first['id']}", headers=alice).status_code == 200
+    assert blob.exists() and chunk_count(app_module, first["content_hash"])
+    # Alice still has a copy, so her index keeps the content
+    assert search(client, alice, marker)
+
+    assert client.delete(f"/knowledge-files/{second['id']}", headers=alice).status_code == 200
+    assert blob.exists()
+    assert not search(client, alice, marker)
+    assert search(client, bob, marker)
+
+    assert client.delete(f"/knowledge-files/{shared['id']}", headers=bob).status_code == 200
+    assert not blob.exists()
+    assert chunk_count(app_module, first["content_hash"]) == 0
+
+
+def test_file_deleted_while_processing_leaves_nothing_behind(client, app_module, register):
+    headers, _ = register()
+    record = upload(client, headers, f"Delivery takes two days {uuid.uuid4().hex}".encode())
+
+    assert client.delete(f"/knowledge-files/{record['id']}", headers=headers).status_code == 200
+    wait_until_idle(app_module)
+    assert not Path(record["file_path"]).exists()
+    assert chunk_count(app_module, record["content_hash"]) == 0
+
+
+def test_other_users_file_cannot_be_deleted(client, register):
+    owner, _ = register()
+    stranger, _ = register()
+    record = upload(client, owner, uuid.uuid4().hex.encode())
+
+    assert client.delete(f"/knowledge-files/{record['id']}", headers=stranger).status_code == 404
+    assert Path(record["file_path"]).exists()
@@ -0,0 +1,77 @@
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert, select
+
+
+def create_bots(client, headers, count):
+    bots = []
+    for index in range(count):
+        response = client.post("/bots", headers=headers, json={
+            "platform": "telegram", "name": f"bot-{index}", "token": "TOKEN", "is_active": True,
+        })
+        assert response.status_code == 200, response.text
+        bots.append(response.json()["id"])
+    return bots
+
+
+def seed_logs(app_module, bots, count):
+    table = app_module.MessageLog.__table__
+    rng = random.Random(3)
+    start = datetime(2026, 1, 1)
+    rows = [
+        {
+            "bot_id": rng.choice(bots),
+            "platform": "telegram",
+            "message_id": f"m-{bots[0]}-{index}",
+            # Few distinct timestamps, so pages have to break ties on id; some rows have none at all
+            "created_at": None if index % 37 == 0 else start + timedelta(minutes=rng.randrange(40)),
+        }
+        for index in range(count)
+    ]
+    with app_module.engine.begin() as connection:
+        connection.execute(insert(table), rows)
+    with app_module.engine.connect() as connection:
+        logged = connection.execute(
+            select(table.c.id, table.c.bot_id, table.c.created_at).where(table.c.bot_id.in_(bots))
+        ).all()
+    # Newest first with undated rows ahead of everything, ties broken by id
+    logged.sort(key=lambda row: (row.created_at is None, row.created_at or start, row.id), reverse=True)
+    return logged
+
+
+def read_all_pages(client, headers, limit, **params):
+    ids, cursor, pages = [], None, 0
+    while True:
+        response = client.get("/message-logs", headers=headers, params={
+            "limit": limit, **params, **({"cursor": cursor} if cursor else {}),
+        })
+        assert response.status_code == 200, response.text
+        page = response.json()
+        assert len(page["items"]) <= limit
+        ids += [item["id"] for item in page["items"]]
+        pages += 1
+        cursor = page["next_cursor"]
+        if not cursor:
+            return ids, pages
+
+
+def test_keyset_pages_merge_every_bot_of_the_user(client, app_module, register):
+    headers, _ = register()
+    bots = create_bots(client, headers, 3)
+    logged = seed_logs(app_module, bots, 300)
+
+    ids, pages = read_all_pages(client, headers, 17)
+    assert ids == [row.id for row in logged]
+    assert pages == -(-len(logged) // 17)
+
+    ids, _ = read_all_pages(client, headers, 17, bot_id=bots[1])
+    assert ids == [row.id for row in logged if row.bot_id == bots[1]]
+
+
+def test_pages_are_limited_to_the_users_bots(client, app_module, register):
+    owner_headers, _ = register()
+    seed_logs(app_module, create_bots(client, owner_headers, 1), 20)
+    other_headers, _ = register()
+
+    assert read_all_pages(client, other_headers, 10) == ([], 1)
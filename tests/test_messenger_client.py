@@ -0,0 +1,97 @@
+import asyncio
+
+import httpx
+import pytest
+
+from benchmarks import fake_messenger
+from messenger_client import MessengerClient, PlatformLimits
+
+BASE_URLS = {platform: "http://fake-messenger" for platform in ("telegram", "whatsapp", "instagram")}
+
+
+@pytest.fixture(autouse=True)
+def fresh_fake():
+    fake_messenger.sent.clear()
+    fake_messenger.last_sent.clear()
+    yield
+    fake_messenger.sent.clear()
+    fake_messenger.last_sent.clear()
+
+
+def messenger(**options) -> MessengerClient:
+    return MessengerClient(transport=httpx.ASGITransport(app=fake_messenger.app), base_urls=BASE_URLS, **options)
+
+
+def sent():
+    return [(message["platform"], message["bot"], message["chat_id"], message["text"]) for message in fake_messenger.sent]
+
+
+def test_sends_each_platforms_request_shape():
+    async def run():
+        client = messenger()
+        results = [
+            await client.send("telegram", 1, "TG-TOKEN", "100", "hello telegram"),
+            await client.send("whatsapp", 2, "WA-TOKEN", "15550001", "hello whatsapp", sender_id="PHONE-ID"),
+            await client.send("instagram", 3, "IG-TOKEN", "IGSID", "hello instagram"),
+        ]
+        await client.stop()
+        return results, client.metrics()
+
+    results, metrics = asyncio.run(run())
+    assert results == [True, True, True]
+    assert sent() == [
+        ("telegram", "TG-TOKEN", "100", "hello telegram"),
+        ("whatsapp", "PHONE-ID", "15550001", "hello whatsapp"),
+        ("instagram", "Bearer IG-TOKEN", "IGSID", "hello instagram"),
+    ]
+    assert metrics["sent"] == 3 and metrics["failed"] == 0
+
+
+def test_flood_control_pauses_the_bot_and_retries(monkeypatch):
+    monkeypatch.setattr(fake_messenger, "CHAT_INTERVAL", 0.1)
+    monkeypatch.setattr(fake_messenger, "RETRY_AFTER", 0.2)
+
+    async def run():
+        client = messenger()
+        results = [await client.send("telegram", 1, "TOKEN", "100", text) for text in ("first", "second")]
+        await client.stop()
+        return results, client.metrics()
+
+    results, metrics = asyncio.run(run())
+    assert results == [True, True]
+    assert [text for *_, text in sent()] == ["first", "second"]
+    assert metrics["rate_limited"] == 1 and metrics["retries"] == 1 and metrics["sent"] == 2
+
+
+def test_replies_waiting_for_a_chat_are_coalesced():
+    limits = {"telegram": PlatformLimits(bot_rate=100, bot_burst=100, chat_rate=20, chat_burst=1, max_text=4096)}
+
+    async def run():
+        client = messenger(limits=limits)
+        for text in ("one", "two", "three"):
+            client.dispatch("telegram", 1, "TOKEN", "100", text)
+        # Another chat has its own bucket and is not merged
+        client.dispatch("telegram", 1, "TOKEN", "200", "elsewhere")
+        await client.stop()
+        return client.metrics()
+
+    metrics = asyncio.run(run())
+    by_chat = {}
+    for _, _, chat_id, text in sent():
+        by_chat.setdefault(chat_id, []).extend(text.split(MessengerClient.SEPARATOR))
+    assert by_chat == {"100": ["one", "two", "three"], "200": ["elsewhere"]}
+    sends_to_chat = len([message for message in sent() if message[2] == "100"])
+    assert sends_to_chat < 3 and metrics["coalesced"] == 3 - sends_to_chat
+    assert metrics["pending"] == 0
+
+
+def test_whatsapp_reply_without_phone_number_id_fails_without_sending():
+    async def run():
+        client = messenger()
+        result = await client.send("whatsapp", 1, "TOKEN", "15550001", "hello")
+        await client.stop()
+        return result, client.metrics()
+
+    result, metrics = asyncio.run(run())
+    assert result is False
+    assert sent() == [] and metrics["failed"] == 1
@@ -0,0 +1,143 @@
+import random
+from datetime import datetime
+
+import pytest
+from sqlalchemy import Boolean, Column, DateTime, Integer, MetaData, String, Table, create_engine, insert, select
+
+import stats_rollup
+from message_log_partitions import MessageLogPartitions
+
+ROLLUPS = (
+    stats_rollup.bot_stats,
+    stats_rollup.response_time_sketches,
+    stats_rollup.message_stats_hourly,
+    stats_rollup.message_stats_daily,
+    stats_rollup.response_time_sketches_hourly,
+    stats_rollup.response_time_sketches_daily,
+)
+
+
+# The columns of message_logs the rollups read
+metadata = MetaData()
+message_logs = Table(
+    "message_logs", metadata,
+    Column("id", Integer, primary_key=True),
+    Column("bot_id", Integer),
+    Column("platform", String),
+    Column("response_time", Integer),
+    Column("is_auto_response", Boolean),
+    Column("is_cached", Boolean),
+    Column("created_at", DateTime),
+)
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://")
+    metadata.create_all(engine)
+    stats_rollup.metadata.create_all(engine)
+    return engine
+
+
+def message_rows(count: int) -> list:
+    rng = random.Random(1)
+    return [
+        {
+            "bot_id": rng.choice([1, 2, None]),
+            "platform": rng.choice(["telegram", "whatsapp"]),
+            "response_time": rng.choice([None, rng.randint(1, 5000)]),
+            "is_auto_response": rng.random() < 0.7,
+            "is_cached": index % 5 == 0,
+            "created_at": datetime(2026, 1 + index % 4, 1 + index % 27, index % 24),
+        }
+        for index in range(count)
+    ]
+
+
+def record(engine, rows) -> None:
+    with engine.begin() as connection:
+        connection.execute(insert(message_logs), rows)
+        stats_rollup.record_messages(connection, rows)
+
+
+def snapshot(engine) -> dict:
+    # updated_at is the only column expected to differ between the two paths
+    with engine.connect() as connection:
+        return {
+            table.name: sorted(
+                tuple(row) for row in connection.execute(
+                    select(*(column for column in table.c if column.name != "updated_at"))
+                )
+            )
+            for table in ROLLUPS
+        }
+
+
+def test_rebuild_matches_incremental_rollups(engine):
+    rows = message_rows(3000)
+    # In batches, like the log writer, so increments land on existing rows too
+    for start in range(0, len(rows), 500):
+        record(engine, rows[start:start + 500])
+    incremental = snapshot(engine)
+
+    with engine.begin() as connection:
+        stats_rollup.rebuild(connection)
+    assert snapshot(engine) == incremental
+
+    with engine.begin() as connection:
+        stats_rollup.rebuild(connection, [1])
+    assert snapshot(engine) == incremental
+
+
+def test_cache_hits_count_as_messages_but_not_latency(engine):
+    rows = message_rows(1000)
+    record(engine, rows)
+
+    with engine.connect() as connection:
+        totals = connection.execute(
+            select(stats_rollup.bot_stats).where(stats_rollup.bot_stats.c.bot_id == 1)
+        ).one()
+    bot_rows = [row for row in rows if row["bot_id"] == 1]
+    timed = [row["response_time"] for row in bot_rows if row["response_time"] is not None and not row["is_cached"]]
+    assert totals.message_count == len(bot_rows)
+    assert (totals.response_time_count, totals.response_time_sum) == (len(timed), sum(timed))
+
+
+def test_rollups_survive_retention_and_rebuild(engine, tmp_path):
+    record(engine, message_rows(3000))
+    before = snapshot(engine)
+
+    partitions = MessageLogPartitions(
+        engine, message_logs, retention_months=2,
+        archive_dir=str(tmp_path / "archive"), on_retire=[stats_rollup.carry_over],
+    )
+    assert partitions.apply_retention(datetime(2026, 4, 20))
+    assert snapshot(engine) == before
+
+    # The retired months are gone from message_logs but not from the rebuilt totals
+    with engine.begin() as connection:
+        stats_rollup.rebuild(connection)
+    after = snapshot(engine)
+    for table in (stats_rollup.bot_stats, stats_rollup.response_time_sketches, stats_rollup.message_stats_daily):
+        assert after[table.name] == before[table.name]
+
+
+def test_timeseries_percentiles_come_from_the_bucket(engine):
+    rows = message_rows(3000)
+    record(engine, rows)
+    day = datetime(2026, 3, 1)
+
+    with engine.connect() as connection:
+        (point,) = stats_rollup.load_timeseries(connection, "day", [1], day, datetime(2026, 3, 2), "telegram")
+
+    in_bucket = [
+        row for row in rows
+        if row["bot_id"] == 1 and row["platform"] == "telegram" and row["created_at"].date() == day.date()
+    ]
+    sketch = stats_rollup.DDSketch()
+    for row in in_bucket:
+        if row["response_time"] is not None and not row["is_cached"]:
+            sketch.add(row["response_time"])
+    assert point["message_count"] == len(in_bucket)
+    assert {key: point[key] for key in ("p50_response_time", "p95_response_time", "p99_response_time")} == \
+        stats_rollup.response_time_percentiles(sketch)
@@ -0,0 +1,106 @@
+import asyncio
+import subprocess
+import sys
+
+from webhook_queue import SQLiteOutbox, WebhookItem, WebhookQueue
+
+
+def dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return process.pid
+
+
+def outbox_rows(path):
+    outbox = SQLiteOutbox(str(path))
+    try:
+        return (
+            outbox.conn.execute("SELECT id, attempts FROM webhook_outbox").fetchall(),
+            outbox.conn.execute("SELECT id, attempts, error FROM webhook_dead_letters").fetchall(),
+        )
+    finally:
+        outbox.close()
+
+
+def persist_as_crashed_worker(path, update: dict) -> int:
+    outbox = SQLiteOutbox(str(path))
+    outbox.pid = dead_pid()
+    item = WebhookItem(platform="telegram", bot_id=1, update=update, received_at=0.0)
+    outbox.persist(item)
+    outbox.close()
+    return item.outbox_id
+
+
+def test_recovers_updates_of_dead_process_and_acks_them(tmp_path):
+    path = tmp_path / "outbox.db"
+    outbox_id = persist_as_crashed_worker(path, {"update_id": 7})
+    handled = []
+
+    async def handler(item):
+        handled.append((item.outbox_id, item.update))
+
+    async def run():
+        queue = WebhookQueue(handler, backend=SQLiteOutbox(str(path)))
+        await queue.start()
+        await queue.stop()
+        return queue.metrics()
+
+    metrics = asyncio.run(run())
+    assert handled == [(outbox_id, {"update_id": 7})]
+    assert metrics["recovered"] == 1 and metrics["processed"] == 1
+    assert outbox_rows(path) == ([], [])
+
+
+def test_failing_update_is_retried_then_dead_lettered(tmp_path):
+    path = tmp_path / "outbox.db"
+    attempts = []
+
+    async def handler(item):
+        attempts.append(item.attempts)
+        raise RuntimeError("boom")
+
+    async def run():
+        queue = WebhookQueue(handler, backend=SQLiteOutbox(str(path)), max_attempts=3, retry_delay=0.01)
+        await queue.start()
+        item = queue.submit("telegram", 1, {"update_id": 1})
+        await queue.stop()
+        return item, queue.metrics()
+
+    item, metrics = asyncio.run(run())
+    assert attempts == [0, 1, 2]
+    assert metrics["retried"] == 2 and metrics["failed"] == 1 and metrics["depth"] == 0
+    assert outbox_rows(path) == ([], [(item.outbox_id, 3, "RuntimeError: boom")])
+
+
+def test_update_interrupted_by_stop_is_replayed(tmp_path):
+    path = tmp_path / "outbox.db"
+
+    async def hang(item):
+        await asyncio.Event().wait()
+
+    async def run():
+        queue = WebhookQueue(hang, backend=SQLiteOutbox(str(path)))
+        await queue.start()
+        item = queue.submit("telegram", 1, {"update_id": 2})
+        await asyncio.sleep(0)
+        await queue.stop(timeout=0.05)
+        return item
+
+    item = asyncio.run(run())
+    rows, dead_letters = outbox_rows(path)
+    assert rows == [(item.outbox_id, 0)] and dead_letters == []
+
+    # Same process, so the row is still ours: the next start replays it
+    replayed = []
+
+    async def handler(replayed_item):
+        replayed.append(replayed_item.update)
+
+    async def restart():
+        queue = WebhookQueue(handler, backend=SQLiteOutbox(str(path)))
+        await queue.start()
+        await queue.stop()
+
+    asyncio.run(restart())
+    assert replayed == [{"update_id": 2}]
+    assert outbox_rows(path) == ([], [])
@@ -0,0 +1,77 @@
+"""
+Knowledge file storage
+Потоковая запись загрузок на диск и хранилище по содержимому (SHA-256)
+"""
+
+import asyncio
+import hashlib
+import os
+from pathlib import Path
+from typing import AsyncIterator, Tuple
+
+from fastapi import UploadFile
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+async def iter_upload(upload: UploadFile, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    while True:
+        chunk = await upload.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+async def save_stream(chunks: AsyncIterator[bytes], path: Path, max_bytes: int = 0) -> Tuple[int, str]:
+    """Write ``chunks`` to ``path`` without holding the whole file in memory.
+
+    File writes are offloaded to a thread so the event loop keeps serving
+    other requests. Returns (size, sha256 hex digest). Raises UploadTooLarge,
+    leaving nothing on disk, as soon as more than ``max_bytes`` arrive.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    handle = await asyncio.to_thread(open, path, "wb")
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if max_bytes and size > max_bytes:
+                raise UploadTooLarge()
+            digest.update(chunk)
+            await asyncio.to_thread(handle.write, chunk)
+    except BaseException:
+        await asyncio.to_thread(handle.close)
+        await asyncio.to_thread(remove_file, path)
+        raise
+    await asyncio.to_thread(handle.close)
+    return size, digest.hexdigest()
+
+
+def blob_path(root: Path, content_hash: str) -> Path:
+    """Content-addressed location of a blob: <root>/blobs/ab/abcdef..."""
+    return root / "blobs" / content_hash[:2] / content_hash
+
+
+def publish_blob(temp_path: Path, path: Path) -> None:
+    """Move a finished upload into the blob store unless identical content is already there.
+
+    Blocking: callers run it in a thread, under the blob's lock, so a delete of
+    the last reference cannot remove the file between this and the new record.
+    """
+    if path.exists():
+        # Same bytes are already stored, the fresh copy is redundant
+        os.remove(temp_path)
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    os.replace(temp_path, path)
+
+
+def remove_file(path: Path) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
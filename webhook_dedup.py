@@ -0,0 +1,70 @@
+"""
+Webhook deduplication
+Отбрасывает повторные доставки вебхуков (ретраи Telegram/Meta) по id обновления или сообщения
+"""
+
+import os
+import time
+from collections import OrderedDict
+from typing import Hashable, List
+
+from webhook_queue import extract_messages
+
+
+class WebhookDeduplicator:
+    """Remembers the last ``maxsize`` update keys seen by this worker for ``window`` seconds.
+
+    Keys are (bot_id, platform, id): Telegram's update_id, or the message ids
+    for Meta platforms. Only redeliveries to the same worker are caught here;
+    the unique index on message_logs catches the rest when logs are written.
+    """
+
+    def __init__(self, window: float = 3600.0, maxsize: int = 100000):
+        self.window = window
+        self.maxsize = maxsize
+        # Insertion ordered, so the oldest keys are always at the front
+        self._seen: "OrderedDict[Hashable, float]" = OrderedDict()
+        self._stats = {"duplicates": 0, "evicted": 0}
+
+    @staticmethod
+    def keys(platform: str, bot_id: int, update: dict) -> List[tuple]:
+        if platform == "telegram":
+            return [(bot_id, platform, update.get("update_id"))]
+        # Status-only updates carry no messages and are never treated as duplicates
+        return [(bot_id, platform, message["message_id"])
+                for message in extract_messages(platform, update) if message["message_id"]]
+
+    def is_duplicate(self, keys: List[tuple]) -> bool:
+        """True when every key was seen within the window."""
+        if not keys:
+            return False
+        now = time.monotonic()
+        for key in keys:
+            seen_at = self._seen.get(key)
+            if seen_at is None or now - seen_at > self.window:
+                return False
+        self._stats["duplicates"] += 1
+        return True
+
+    def remember(self, keys: List[tuple]) -> None:
+        now = time.monotonic()
+        seen = self._seen
+        for key in keys:
+            seen[key] = now
+            seen.move_to_end(key)
+        while seen:
+            oldest_key, oldest_at = next(iter(seen.items()))
+            if len(seen) <= self.maxsize and now - oldest_at <= self.window:
+                break
+            del seen[oldest_key]
+            self._stats["evicted"] += 1
+
+    def metrics(self) -> dict:
+        return {**self._stats, "size": len(self._seen), "maxsize": self.maxsize, "window": self.window}
+
+
+def create_webhook_deduplicator() -> WebhookDeduplicator:
+    return WebhookDeduplicator(
+        window=float(os.getenv("WEBHOOK_DEDUP_WINDOW", "3600")),
+        maxsize=int(os.getenv("WEBHOOK_DEDUP_SIZE", "100000")),
+    )
@@ -0,0 +1,401 @@
+"""
+Webhook ingestion queue
+Принимает обновления мессенджеров в HTTP-обработчике и обрабатывает их в фоне
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class WebhookItem:
+    platform: str
+    bot_id: int
+    update: dict
+    received_at: float
+    outbox_id: Optional[int] = None
+    attempts: int = 0
+
+
+class QueueFull(Exception):
+    pass
+
+
+def validate_update(platform: str, update: dict) -> bool:
+    """Cheap structural check so garbage is rejected before it is queued."""
+    if not update:
+        return False
+    if platform == "telegram":
+        return isinstance(update.get("update_id"), int)
+    if platform in ("whatsapp", "instagram"):
+        return isinstance(update.get("entry"), list)
+    return False
+
+
+def extract_messages(platform: str, update: dict) -> List[dict]:
+    """Pull inbound messages out of a platform update as message_id/sender_id/message_text dicts.
+
+    ``chat_id`` is where a reply goes; it is not part of the message log.
+    """
+    messages = []
+    if platform == "telegram":
+        message = update.get("message") or update.get("edited_message") or update.get("channel_post")
+        if isinstance(message, dict):
+            chat_id = (message.get("chat") or {}).get("id")
+            sender_id = (message.get("from") or {}).get("id", chat_id)
+            messages.append({
+                # Telegram message ids are only unique within a chat
+                "message_id": f"{chat_id}:{message.get('message_id')}",
+                "sender_id": str(sender_id) if sender_id is not None else None,
+                "message_text": message.get("text") or message.get("caption"),
+                "chat_id": str(chat_id) if chat_id is not None else None,
+            })
+    elif platform == "whatsapp":
+        for entry in update.get("entry") or []:
+            for change in entry.get("changes") or []:
+                for message in (change.get("value") or {}).get("messages") or []:
+                    messages.append({
+                        "message_id": message.get("id"),
+                        "sender_id": message.get("from"),
+                        "message_text": (message.get("text") or {}).get("body"),
+                        "chat_id": message.get("from"),
+                    })
+    elif platform == "instagram":
+        for entry in update.get("entry") or []:
+            for event in entry.get("messaging") or []:
+                message = event.get("message") or {}
+                if not message or message.get("is_echo"):
+                    continue
+                messages.append({
+                    "message_id": message.get("mid"),
+                    "sender_id": (event.get("sender") or {}).get("id"),
+                    "message_text": message.get("text"),
+                    "chat_id": (event.get("sender") or {}).get("id"),
+                })
+    return messages
+
+
+# Backends
+class MemoryBackend:
+    """Items live only in the asyncio queue and are lost on restart."""
+
+    def persist(self, item: WebhookItem) -> None:
+        pass
+
+    def ack(self, item: WebhookItem) -> None:
+        pass
+
+    def retry(self, item: WebhookItem, error: str) -> None:
+        pass
+
+    def dead_letter(self, item: WebhookItem, error: str) -> None:
+        pass
+
+    def recover(self) -> List[WebhookItem]:
+        return []
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteOutbox:
+    """Local outbox: every accepted update is written before the 200 is returned
+    and deleted once a worker has processed it. Rows owned by a dead process
+    (crash, restart) are claimed and replayed on startup. A failed attempt is
+    counted on the row; an update that keeps failing is moved to
+    webhook_dead_letters for inspection instead of being dropped."""
+
+    def __init__(self, path: str):
+        self.pid = os.getpid()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS webhook_outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " owner INTEGER NOT NULL,"
+            " platform TEXT NOT NULL,"
+            " bot_id INTEGER NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " received_at REAL NOT NULL)"
+        )
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(webhook_outbox)")}
+        if "attempts" not in columns:
+            self.conn.execute("ALTER TABLE webhook_outbox ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+            self.conn.execute("ALTER TABLE webhook_outbox ADD COLUMN last_error TEXT")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS webhook_dead_letters ("
+            " id INTEGER PRIMARY KEY,"
+            " platform TEXT NOT NULL,"
+            " bot_id INTEGER NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " received_at REAL NOT NULL,"
+            " attempts INTEGER NOT NULL,"
+            " error TEXT,"
+            " failed_at REAL NOT NULL)"
+        )
+
+    def persist(self, item: WebhookItem) -> None:
+        cursor = self.conn.execute(
+            "INSERT INTO webhook_outbox (owner, platform, bot_id, payload, received_at) VALUES (?, ?, ?, ?, ?)",
+            (self.pid, item.platform, item.bot_id, json.dumps(item.update), item.received_at),
+        )
+        item.outbox_id = cursor.lastrowid
+
+    def ack(self, item: WebhookItem) -> None:
+        if item.outbox_id is not None:
+            self.conn.execute("DELETE FROM webhook_outbox WHERE id = ?", (item.outbox_id,))
+
+    def retry(self, item: WebhookItem, error: str) -> None:
+        if item.outbox_id is not None:
+            self.conn.execute(
+                "UPDATE webhook_outbox SET attempts = ?, last_error = ? WHERE id = ?",
+                (item.attempts, error, item.outbox_id),
+            )
+
+    def dead_letter(self, item: WebhookItem, error: str) -> None:
+        if item.outbox_id is None:
+            return
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.execute(
+                "INSERT INTO webhook_dead_letters (id, platform, bot_id, payload, received_at, attempts, error, failed_at)"
+                " SELECT id, platform, bot_id, payload, received_at, ?, ?, ? FROM webhook_outbox WHERE id = ?",
+                (item.attempts, error, time.time(), item.outbox_id),
+            )
+            self.conn.execute("DELETE FROM webhook_outbox WHERE id = ?", (item.outbox_id,))
+
+    def recover(self) -> List[WebhookItem]:
+        owners = [row[0] for row in self.conn.execute("SELECT DISTINCT owner FROM webhook_outbox")]
+        dead = [owner for owner in owners if owner != self.pid and not _process_alive(owner)]
+        for owner in dead:
+            self.conn.execute("UPDATE webhook_outbox SET owner = ? WHERE owner = ?", (self.pid, owner))
+        rows = self.conn.execute(
+            "SELECT id, platform, bot_id, payload, received_at, attempts FROM webhook_outbox WHERE owner = ? ORDER BY id",
+            (self.pid,),
+        ).fetchall()
+        return [
+            WebhookItem(platform=platform, bot_id=bot_id, update=json.loads(payload),
+                        received_at=received_at, outbox_id=outbox_id, attempts=attempts)
+            for outbox_id, platform, bot_id, payload, received_at, attempts in rows
+        ]
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# Queue
+class WebhookQueue:
+    """Bounded in-process queue drained by a pool of worker tasks.
+
+    ``submit`` never awaits: it either accepts the update or raises
+    ``QueueFull`` so the caller can answer with 503 and let the platform retry.
+    Each bot may have at most ``per_bot_concurrency`` updates in processing.
+    Only updates of bots below that limit are handed to workers; the rest wait
+    in a per-bot deque, so a burst from one bot cannot occupy every worker.
+
+    An update is acked only once its handler returns. A failed one is retried
+    after ``retry_delay`` seconds, doubling each time, and handed to the
+    backend's dead letters after ``max_attempts``. One interrupted by
+    ``stop`` stays in the backend and is replayed by ``recover`` on restart.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[WebhookItem], Awaitable[None]],
+        maxsize: int = 1000,
+        workers: int = 4,
+        per_bot_concurrency: int = 2,
+        backend=None,
+        max_attempts: int = 3,
+        retry_delay: float = 5.0,
+    ):
+        self.handler = handler
+        self.maxsize = maxsize
+        self.workers = workers
+        self.per_bot_concurrency = per_bot_concurrency
+        self.backend = backend or MemoryBackend()
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        # Updates ready for a worker; ``maxsize`` bounds everything accepted and not yet done
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self._tasks: List[asyncio.Task] = []
+        self._pending: Dict[int, Deque[WebhookItem]] = {}
+        self._dispatched: Dict[int, int] = {}
+        self._depth = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._in_flight = 0
+        self._retries: Dict[int, asyncio.TimerHandle] = {}
+        self._stats = {
+            "accepted": 0,
+            "rejected": 0,
+            "processed": 0,
+            "retried": 0,
+            "failed": 0,
+            "recovered": 0,
+            "max_depth": 0,
+        }
+        self._processing_ms_total = 0.0
+        self._queue_wait_ms_total = 0.0
+
+    async def start(self) -> None:
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+        # Replayed updates were accepted before the restart, so they may exceed maxsize
+        for item in self.backend.recover():
+            self._enqueue(item)
+            self._stats["recovered"] += 1
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Webhook queue stopped with %d pending updates", self._depth)
+        for handle in self._retries.values():
+            # Still in the backend with its attempt count; replayed after the restart
+            handle.cancel()
+        self._retries = {}
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self.backend.close()
+
+    def submit(self, platform: str, bot_id: int, update: dict) -> WebhookItem:
+        if self._depth >= self.maxsize:
+            self._stats["rejected"] += 1
+            raise QueueFull()
+        item = WebhookItem(platform=platform, bot_id=bot_id, update=update, received_at=time.time())
+        self.backend.persist(item)
+        self._enqueue(item)
+        self._stats["accepted"] += 1
+        return item
+
+    def _enqueue(self, item: WebhookItem) -> None:
+        self._depth += 1
+        self._idle.clear()
+        if self._depth > self._stats["max_depth"]:
+            self._stats["max_depth"] = self._depth
+        self._dispatch(item)
+
+    def _dispatch(self, item: WebhookItem) -> None:
+        dispatched = self._dispatched.get(item.bot_id, 0)
+        if dispatched < self.per_bot_concurrency:
+            self._dispatched[item.bot_id] = dispatched + 1
+            self.queue.put_nowait(item)
+        else:
+            self._pending.setdefault(item.bot_id, deque()).append(item)
+
+    def _release(self, item: WebhookItem) -> None:
+        # Hand the bot's slot to its next waiting update, or give it back
+        pending = self._pending.get(item.bot_id)
+        if pending:
+            self.queue.put_nowait(pending.popleft())
+            if not pending:
+                del self._pending[item.bot_id]
+        elif self._dispatched[item.bot_id] > 1:
+            self._dispatched[item.bot_id] -= 1
+        else:
+            del self._dispatched[item.bot_id]
+        self._depth -= 1
+        if not self._depth:
+            self._idle.set()
+
+    async def _worker(self) -> None:
+        while True:
+            item = await self.queue.get()
+            retry = False
+            try:
+                retry = await self._process(item)
+            finally:
+                if retry:
+                    # Still counted in the depth while it waits, so stop() waits for it too
+                    self._depth += 1
+                    delay = self.retry_delay * 2 ** (item.attempts - 1)
+                    self._retries[id(item)] = asyncio.get_running_loop().call_later(delay, self._retry, item)
+                self._release(item)
+
+    def _retry(self, item: WebhookItem) -> None:
+        del self._retries[id(item)]
+        self._dispatch(item)
+
+    async def _process(self, item: WebhookItem) -> bool:
+        """Run the handler once; True if the update should be tried again."""
+        started = time.time()
+        self._queue_wait_ms_total += (started - item.received_at) * 1000
+        self._in_flight += 1
+        # Cancellation skips the ack: the update stays in the backend for recover()
+        try:
+            await self.handler(item)
+        except Exception as exc:
+            item.attempts += 1
+            error = f"{type(exc).__name__}: {exc}"
+            if item.attempts < self.max_attempts:
+                self._stats["retried"] += 1
+                logger.warning("Retrying %s update for bot %s after attempt %d: %s",
+                               item.platform, item.bot_id, item.attempts, error)
+                self.backend.retry(item, error)
+                return True
+            self._stats["failed"] += 1
+            logger.exception("Failed to process %s update for bot %s", item.platform, item.bot_id)
+            self.backend.dead_letter(item, error)
+        else:
+            self._stats["processed"] += 1
+            self.backend.ack(item)
+        finally:
+            self._in_flight -= 1
+            self._processing_ms_total += (time.time() - started) * 1000
+        return False
+
+    def metrics(self) -> dict:
+        done = self._stats["processed"] + self._stats["retried"] + self._stats["failed"]
+        return {
+            **self._stats,
+            "depth": self._depth,
+            "waiting_for_bot": sum(len(pending) for pending in self._pending.values()),
+            "capacity": self.maxsize,
+            "in_flight": self._in_flight,
+            "retry_scheduled": len(self._retries),
+            "workers": len(self._tasks),
+            "avg_queue_wait_ms": round(self._queue_wait_ms_total / done, 2) if done else 0,
+            "avg_processing_ms": round(self._processing_ms_total / done, 2) if done else 0,
+        }
+
+
+def create_webhook_queue(handler: Callable[[WebhookItem], Awaitable[None]]) -> WebhookQueue:
+    backend_name = os.getenv("WEBHOOK_QUEUE_BACKEND", "memory")
+    if backend_name == "sqlite":
+        backend = SQLiteOutbox(os.getenv("WEBHOOK_OUTBOX_PATH", "webhook_outbox.db"))
+    elif backend_name == "memory":
+        backend = MemoryBackend()
+    else:
+        raise ValueError(f"Unknown WEBHOOK_QUEUE_BACKEND: {backend_name}")
+
+    return WebhookQueue(
+        handler,
+        maxsize=int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000")),
+        workers=int(os.getenv("WEBHOOK_WORKERS", "4")),
+        per_bot_concurrency=int(os.getenv("WEBHOOK_BOT_CONCURRENCY", "2")),
+        backend=backend,
+        max_attempts=int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "3")),
+        retry_delay=float(os.getenv("WEBHOOK_RETRY_SECONDS", "5")),
+    )